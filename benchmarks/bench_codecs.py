@@ -0,0 +1,74 @@
+"""Encode and decode cost of each available serializer on typical frames.
+
+Builds a MESSAGE, a USER_LIST of a busy room and a full MESSAGE_HISTORY the way
+the server does, then times every serializer ``shared.protocol`` has (JSON
+always; msgpack and CBOR when ``msgpack`` / ``cbor2`` are installed) encoding
+each into a v3 frame and decoding the body back, and prints the frame sizes.
+
+    python benchmarks/bench_codecs.py [--users 50] [--history 100] [--number 20000]
+"""
+
+import argparse
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared import constants  # noqa: E402
+from shared import helpers  # noqa: E402
+from shared import protocol  # noqa: E402
+
+
+def frames(users, history):
+    """The objects behind a MESSAGE, a USER_LIST and a MESSAGE_HISTORY frame."""
+    now = int(time.time())
+    color = constants.Colors.BLACK.hex
+    rows = [
+        (n, f'user{n % 20}', color, f'message number {n}, hello', now - n) for n in range(history)
+    ]
+    roster = [
+        {'id': f'{n:08x}-0000-4000-8000-000000000000', 'nickname': f'user{n}', 'color': color}
+        for n in range(users)
+    ]
+    return {
+        'MESSAGE': helpers.prepare_message('alice', 'see you at lunch?', color, 123456, now),
+        'USER_LIST': helpers.prepare_user_list(roster),
+        'MESSAGE_HISTORY': helpers.prepare_message_history(rows),
+    }
+
+
+def per_call(statement, number):
+    """Best-of-five wall time of one call, in microseconds."""
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50, help='members in the USER_LIST')
+    parser.add_argument('--history', type=int, default=100, help='messages in the history')
+    parser.add_argument('--number', type=int, default=20_000, help='calls per MESSAGE timing')
+    args = parser.parse_args()
+
+    print(f'serializers: {", ".join(protocol.serializers())}')
+    print(
+        f'{"frame":>16}  {"serializer":>10}  {"bytes":>7}  {"encode (us)":>11}  {"decode (us)":>11}'
+    )
+    for name, frame in frames(args.users, args.history).items():
+        message = frame.message
+        # Scale the call count to the frame, so every row takes about as long.
+        number = max(100, args.number * 200 // len(frame))
+        for serializer in protocol.serializers():
+            encoded = protocol.encode(message, 3, serializer)
+            kind, _ = protocol.parse_header(encoded[: protocol.BINARY_HEADER.size], 3)
+            body = encoded[protocol.BINARY_HEADER.size :]
+            encode = per_call(lambda: protocol.encode(message, 3, serializer), number)
+            decode = per_call(lambda: protocol.decode(body, kind), number)
+            print(
+                f'{name:>16}  {serializer:>10}  {len(encoded):>7}  {encode:>11.2f}  {decode:>11.2f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Chat message delivery latency under each durability mode.
+
+One client sends messages through the real handler path (Client.dispatch) into a
+scratch database, and the time until a roommate's socket has the broadcast frame
+is measured. Under ``sync`` that includes the commit and its fsync; ``async`` and
+``none`` deliver first and leave the write to the writer thread.
+
+    python benchmarks/bench_durability.py [--messages 2000]
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import db  # noqa: E402
+from server.handler import Client  # noqa: E402
+from server.registry import ConnectionRegistry  # noqa: E402
+from shared import constants  # noqa: E402
+from shared import protocol  # noqa: E402
+
+
+def make_client(clients, nickname):
+    server_end, peer = socket.socketpair()
+    client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False)
+    client.nickname = nickname
+    client.room = constants.DEFAULT_ROOM
+    clients.add(client)
+    return client, peer
+
+
+def run(durability, messages):
+    with tempfile.TemporaryDirectory() as scratch:
+        constants.SERVER_DATABASE = os.path.join(scratch, 'server.db')
+        db.shared_writer().durability = durability
+        clients = ConnectionRegistry()
+        alice, alice_peer = make_client(clients, 'alice')
+        _, bob_peer = make_client(clients, 'bob')
+        alice.connect_database()
+
+        latencies = []
+        for n in range(messages):
+            started = time.perf_counter()
+            alice.dispatch({'type': constants.Types.MESSAGE, 'content': f'message {n}'})
+            protocol.read_message(bob_peer)
+            latencies.append(time.perf_counter() - started)
+            protocol.read_message(alice_peer)  # the sender's own copy
+        db.close_writers()
+        db.close_pools()
+
+    ms = sorted(latency * 1000 for latency in latencies)
+    print(
+        f'{durability:>6}  {statistics.median(ms):>9.3f}  '
+        f'{ms[int(len(ms) * 0.99)]:>9.3f}  {ms[-1]:>9.3f}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=2000)
+    args = parser.parse_args()
+    print(f'{"mode":>6}  {"p50 (ms)":>9}  {"p99 (ms)":>9}  {"max (ms)":>9}')
+    for durability in db.DURABILITY_MODES:
+        run(durability, args.messages)
+
+
+if __name__ == '__main__':
+    main()
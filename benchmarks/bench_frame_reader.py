@@ -0,0 +1,98 @@
+"""recv syscalls per frame: read_message (header, then body) against FrameReader.
+
+A writer thread sends chat frames over a socket pair in bursts -- several frames
+written at once, as a busy room's fan-out or a history stream delivers them --
+waiting for the reader to take each burst before sending the next. The reader
+takes them either with ``protocol.read_message`` (two ``recv`` calls or more a
+frame) or with one ``protocol.FrameReader``, and the table shows the ``recv``
+calls and wall time per frame for each burst size.
+
+    python benchmarks/bench_frame_reader.py [--frames 20000] [--bursts 1,4,16,64]
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared import constants  # noqa: E402
+from shared import helpers  # noqa: E402
+from shared import protocol  # noqa: E402
+
+
+class CountingSocket:
+    """Counts the receive calls made on a socket."""
+
+    def __init__(self, sock):
+        self.sock, self.recvs = sock, 0
+
+    def recv(self, length):
+        self.recvs += 1
+        return self.sock.recv(length)
+
+    def recv_into(self, buffer):
+        self.recvs += 1
+        return self.sock.recv_into(buffer)
+
+
+def run(frame, frames, burst, buffered):
+    """(recv calls, microseconds) per frame, reading ``frames`` sent ``burst`` at a time."""
+    a, b = socket.socketpair()
+    counting = CountingSocket(b)
+    taken = threading.Semaphore(0)
+    bursts = frames // burst
+
+    def writer():
+        for _ in range(bursts):
+            a.sendall(frame * burst)
+            taken.acquire()
+
+    thread = threading.Thread(target=writer)
+    reader = protocol.FrameReader(counting, 3)
+    started = time.perf_counter()
+    thread.start()
+    for _ in range(bursts):
+        for _ in range(burst):
+            if buffered:
+                kind, body = reader.read_frame()
+                protocol.decode(body, kind)
+            else:
+                protocol.read_message(counting, 3)
+        taken.release()
+    thread.join()
+    elapsed = time.perf_counter() - started
+    a.close()
+    b.close()
+    return counting.recvs / (bursts * burst), elapsed / (bursts * burst) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=20_000, help='frames read per run')
+    parser.add_argument('--bursts', default='1,4,16,64', help='frames written at once')
+    args = parser.parse_args()
+
+    frame = protocol.reframe(
+        helpers.prepare_message('alice', 'see you at lunch?', constants.Colors.BLACK.hex, 123456),
+        3,
+    )
+    print(f'{len(frame)}-byte MESSAGE frames, v3 framing')
+    print(
+        f'{"burst":>6}  {"recv/frame (read_message)":>25}  {"recv/frame (FrameReader)":>24}'
+        f'  {"us/frame (read_message)":>23}  {"us/frame (FrameReader)":>22}'
+    )
+    for burst in (int(size) for size in args.bursts.split(',')):
+        old_recvs, old_time = run(frame, args.frames, burst, buffered=False)
+        new_recvs, new_time = run(frame, args.frames, burst, buffered=True)
+        print(
+            f'{burst:>6}  {old_recvs:>25.2f}  {new_recvs:>24.2f}'
+            f'  {old_time:>23.2f}  {new_time:>22.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""send syscalls per frame: one send per frame against FrameWriter's gathered sendmsg.
+
+Queues bursts of chat frames -- several at once, as a busy room's fan-out or a
+system message followed by a USER_LIST leaves them in a client's outbox -- and
+writes each burst to a socket pair either the old way, one ``send`` per frame,
+or with one ``protocol.FrameWriter.write`` call. A reader thread drains the
+other end. The table shows the send calls and wall time per frame for each
+burst size.
+
+    python benchmarks/bench_frame_writer.py [--frames 20000] [--bursts 1,4,16,64]
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared import constants  # noqa: E402
+from shared import helpers  # noqa: E402
+from shared import protocol  # noqa: E402
+
+
+def drain(sock, total):
+    """Read and discard ``total`` bytes."""
+    while total:
+        total -= len(sock.recv(min(total, 1 << 16)))
+
+
+def run(frame, frames, burst, gathered):
+    """(send calls, microseconds) per frame, writing ``frames`` ``burst`` at a time."""
+    a, b = socket.socketpair()
+    bursts = frames // burst
+    reader = threading.Thread(target=drain, args=(b, len(frame) * burst * bursts))
+    writer = protocol.FrameWriter(a)
+    batch = [frame] * burst
+    sends = 0
+    reader.start()
+    started = time.perf_counter()
+    for _ in range(bursts):
+        if gathered:
+            writer.write(batch)
+        else:
+            for item in batch:
+                a.sendall(item)
+                sends += 1
+    reader.join()
+    elapsed = time.perf_counter() - started
+    a.close()
+    b.close()
+    sends = writer.sends if gathered else sends
+    return sends / (bursts * burst), elapsed / (bursts * burst) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=20_000, help='frames written per run')
+    parser.add_argument('--bursts', default='1,4,16,64', help='frames queued at once')
+    args = parser.parse_args()
+
+    frame = protocol.reframe(
+        helpers.prepare_message('alice', 'see you at lunch?', constants.Colors.BLACK.hex, 123456),
+        3,
+    )
+    print(f'{len(frame)}-byte MESSAGE frames, v3 framing')
+    print(
+        f'{"burst":>6}  {"send/frame (send)":>17}  {"send/frame (FrameWriter)":>24}'
+        f'  {"us/frame (send)":>15}  {"us/frame (FrameWriter)":>22}'
+    )
+    for burst in (int(size) for size in args.bursts.split(',')):
+        old_sends, old_time = run(frame, args.frames, burst, gathered=False)
+        new_sends, new_time = run(frame, args.frames, burst, gathered=True)
+        print(
+            f'{burst:>6}  {old_sends:>17.2f}  {new_sends:>24.2f}'
+            f'  {old_time:>15.2f}  {new_time:>22.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
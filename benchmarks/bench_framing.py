@@ -0,0 +1,71 @@
+"""What the frame header costs, in v2's ASCII framing and v3's binary one.
+
+Times, per frame of a typical small chat MESSAGE, parsing the header the way a
+reader does (decode and ``int()`` for v2, one ``struct`` unpack for v3),
+reading whole frames back off a socket pair, and the bytes each framing puts on
+the wire. ``reframe`` is timed too, since a v3 recipient of a broadcast gets its
+copy converted from the v2 frame built for everyone.
+
+    python benchmarks/bench_framing.py [--frames 200000]
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shared import constants  # noqa: E402
+from shared import helpers  # noqa: E402
+from shared import protocol  # noqa: E402
+
+
+def per_call(statement, count):
+    """Best-of-five wall time of one call, in microseconds."""
+    return min(timeit.repeat(statement, number=count, repeat=5)) / count * 1e6
+
+
+def read_back(frame, version, count):
+    """Microseconds per frame to read ``count`` copies of ``frame`` off a socket pair."""
+    a, b = socket.socketpair()
+
+    def writer():
+        a.sendall(frame * count)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    elapsed = timeit.timeit(lambda: protocol.read_message(b, version), number=count)
+    thread.join()
+    a.close()
+    b.close()
+    return elapsed / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', type=int, default=200_000, help='frames per measurement')
+    args = parser.parse_args()
+
+    message = helpers.prepare_message(
+        'alice', 'see you at lunch?', constants.Colors.BLACK.hex, message_id=123456
+    )
+    frames = {version: protocol.reframe(message, version) for version in (2, 3)}
+
+    print(f'{"":>8}  {"header B":>8}  {"frame B":>7}  {"parse (us)":>10}  {"read (us)":>9}')
+    for version, frame in frames.items():
+        header = frame[: protocol.header_length(version)]
+        parse = per_call(lambda: protocol.parse_header(header, version), args.frames)
+        read = read_back(frame, version, args.frames // 4)
+        print(
+            f'{"v" + str(version):>8}  {len(header):>8}  {len(frame):>7}  {parse:>10.3f}  '
+            f'{read:>9.3f}'
+        )
+    reframe = per_call(lambda: protocol.reframe(message, 3), args.frames)
+    print(f'reframe v2 -> v3: {reframe:.3f} us per frame')
+
+
+if __name__ == '__main__':
+    main()
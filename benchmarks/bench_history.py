@@ -0,0 +1,108 @@
+"""How long a GET_MESSAGE_HISTORY query takes as the message table grows.
+
+Fills a scratch database with a page of recent messages per room, then with ever
+more old ones, and after each step times the history query the server runs -- one
+room's messages from the last half hour -- against the indexed, room-aware table,
+and the query it used to run (every room, no index) against a copy without the
+index. The indexed query
+should stay flat; the old one grows with the table.
+
+    python benchmarks/bench_history.py [--rows 1000000] [--steps 5] [--rooms 20]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import db  # noqa: E402
+
+WINDOW = 60 * 30  # the longest history a client may ask for
+LIMIT = 100
+
+
+def fill(conns, start, count, rooms, newest, oldest):
+    """Insert `count` messages sent between `oldest` and `newest` into every conn."""
+    rows = [
+        (
+            f'user{n % 500}',
+            f'hash{n % 500}',
+            '#000000',
+            f'message {n}',
+            random.randint(oldest, newest),
+            f'room{n % rooms}',
+        )
+        for n in range(start, start + count)
+    ]
+    for conn in conns:
+        with conn:
+            conn.executemany(
+                '''INSERT INTO message (nickname, connection_hash, color, message, timestamp, room)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                rows,
+            )
+
+
+def timed(conn, sql, params, repeat):
+    """Best-of-`repeat` wall time of one query, in milliseconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--rooms', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        indexed = db.ServerDatabase(os.path.join(scratch, 'indexed.db'))
+        flat = sqlite3.connect(os.path.join(scratch, 'flat.db'))
+        flat.execute(
+            '''CREATE TABLE message (id INTEGER PRIMARY KEY, nickname TEXT NOT NULL,
+               connection_hash TEXT NOT NULL, color TEXT, message TEXT,
+               timestamp INTEGER NOT NULL, room TEXT NOT NULL)'''
+        )
+
+        now = int(time.time())
+        since = now - WINDOW
+        # A full page of recent history in every room; everything added later is older,
+        # so each step grows the table without changing what the query returns.
+        fill([indexed.conn, flat], 0, LIMIT * args.rooms, args.rooms, now, since)
+        step = args.rows // args.steps
+        print(f'{"rows":>10}  {"room + index (ms)":>18}  {"all rooms, no index (ms)":>24}')
+        for n in range(args.steps):
+            fill([indexed.conn, flat], n * step, step, args.rooms, since - 1, since - 7 * 24 * 3600)
+            new = timed(
+                indexed.conn,
+                '''SELECT id, nickname, color, message, timestamp FROM message
+                   WHERE room = ? AND timestamp >= ? ORDER BY timestamp LIMIT ?''',
+                ['room0', since, LIMIT],
+                args.repeat,
+            )
+            old = timed(
+                flat,
+                '''SELECT id, nickname, color, message, timestamp FROM message
+                   WHERE timestamp >= ? ORDER BY timestamp LIMIT ?''',
+                [since, LIMIT],
+                args.repeat,
+            )
+            print(f'{(n + 1) * step:>10}  {new:>18.3f}  {old:>24.3f}')
+
+        indexed.close()
+        flat.close()
+
+
+if __name__ == '__main__':
+    main()
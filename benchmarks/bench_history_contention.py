@@ -0,0 +1,100 @@
+"""Whether a slow history reader holds up message persistence.
+
+A writer thread records messages through the database's shared writer as fast
+as it can, timing each one, while a reader thread keeps answering history
+requests for a client that reads its socket slowly. In ``locked`` mode the reader
+does what the server used to: query, encode and send the frame all while holding
+the global database lock, so every commit waits for the slow socket. In
+``snapshot`` mode it uses ServerDatabase.recent_messages -- a lock-free read from
+a WAL snapshot -- and sends with no lock held. Compare the writer's latencies.
+
+    python benchmarks/bench_history_contention.py [--seconds 3]
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import db  # noqa: E402
+from shared import helpers  # noqa: E402
+
+QUERY = '''SELECT id, nickname, color, message, timestamp FROM message
+           WHERE room = ? AND timestamp >= ? ORDER BY timestamp LIMIT ?'''
+
+
+def slow_peer(sock):
+    """Read a little every few milliseconds, like a client on a poor link, until closed."""
+    while True:
+        try:
+            if not sock.recv(4096):
+                return
+        except OSError:
+            return
+        time.sleep(0.005)
+
+
+def reader(path, mode, stop):
+    database = db.ServerDatabase(path)
+    server_end, peer = socket.socketpair()
+    server_end.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    threading.Thread(target=slow_peer, args=(peer,), daemon=True).start()
+    try:
+        while not stop.is_set():
+            if mode == 'locked':
+                with db.lock:
+                    rows = database.conn.execute(QUERY, ['general', 0, 100]).fetchall()
+                    server_end.sendall(helpers.prepare_message_history(rows))
+            else:
+                rows = database.recent_messages('general', 0, 100)
+                server_end.sendall(helpers.prepare_message_history(rows))
+    finally:
+        server_end.close()  # the peer reads to the end and stops
+        database.close()
+
+
+def run(mode, seconds):
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'server.db')
+        writer = db.MessageWriter(path)
+        for n in range(100):
+            writer.add_message('seed', 's', '#000000', f'history {n} ' + 'x' * 200, n)
+
+        stop = threading.Event()
+        slow = threading.Thread(target=reader, args=(path, mode, stop))
+        slow.start()
+        latencies = []
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            started = time.perf_counter()
+            writer.add_message('alice', 'a', '#000000', 'hello', int(time.time()))
+            latencies.append(time.perf_counter() - started)
+        stop.set()
+        slow.join()
+        writer.close()
+
+    latencies.sort()
+    ms = [latency * 1000 for latency in latencies]
+    print(
+        f'{mode:>8}  {len(ms) / seconds:>10.0f}  {statistics.median(ms):>9.3f}  '
+        f'{ms[int(len(ms) * 0.99)]:>9.3f}  {ms[-1]:>9.3f}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3.0)
+    args = parser.parse_args()
+    print(f'{"mode":>8}  {"msgs/s":>10}  {"p50 (ms)":>9}  {"p99 (ms)":>9}  {"max (ms)":>9}')
+    for mode in ('locked', 'snapshot'):
+        run(mode, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
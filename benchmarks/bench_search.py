@@ -0,0 +1,107 @@
+"""/search latency over a large message table and its FTS5 index.
+
+A scratch database is filled with ``--rows`` messages of random words from a
+Zipf-ish vocabulary (so a few words are in most messages and most words are
+rare), spread over ``--rooms`` rooms, through the same triggers that index
+messages the server records. Then each kind of query runs ``--repeat`` times
+through MessageStore.search_messages, a page at a time, as /search does.
+
+    python benchmarks/bench_search.py [--rows 2000000] [--rooms 8] [--repeat 50]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import db  # noqa: E402
+from shared import constants  # noqa: E402
+
+VOCABULARY = 50000
+WORDS_PER_MESSAGE = 8
+
+
+def word(rank):
+    return f'w{rank}'
+
+
+def fill(database, rows, rooms, seed=0):
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(VOCABULARY)]
+    started = time.perf_counter()
+    batch = 50000
+    for first in range(0, rows, batch):
+        count = min(batch, rows - first)
+        words = rng.choices(range(VOCABULARY), weights, k=count * WORDS_PER_MESSAGE)
+        with database.conn:
+            database.conn.executemany(
+                'INSERT INTO message (nickname, connection_hash, message, timestamp, room) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (
+                    (
+                        'alice',
+                        'a',
+                        ' '.join(
+                            map(word, words[n * WORDS_PER_MESSAGE : (n + 1) * WORDS_PER_MESSAGE])
+                        ),
+                        first + n,
+                        f'room{(first + n) % rooms}',
+                    )
+                    for n in range(count)
+                ),
+            )
+    return rows / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--rooms', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--page-size', type=int, default=constants.SEARCH_PAGE_SIZE)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        path = os.path.join(scratch, 'server.db')
+        database = db.ServerDatabase(path)
+        rate = fill(database, args.rows, args.rooms)
+        size = os.path.getsize(path) / 2**20
+        print(f'{args.rows:,} rows over {args.rooms} rooms, {rate:,.0f} rows/s, {size:,.0f} MiB')
+
+        store = db.MessageStore(path)
+        queries = {
+            'common word': [word(0)],
+            'mid word': [word(100)],
+            'rare word': [word(20000)],
+            'two common': [word(0), word(1)],
+            'common + rare': [word(0), word(20000)],
+            'page 10 common': [word(0)],
+            'no match': ['nothing'],
+        }
+        print(f'{"query":>15}  {"hits/page":>9}  {"p50 (ms)":>9}  {"p99 (ms)":>9}')
+        for name, terms in queries.items():
+            offset = 9 * args.page_size if name.startswith('page 10') else 0
+            latencies = []
+            for n in range(args.repeat):
+                started = time.perf_counter()
+                hits = store.search_messages(
+                    f'room{n % args.rooms}', terms, offset, args.page_size + 1
+                )
+                latencies.append((time.perf_counter() - started) * 1000)
+            ms = sorted(latencies)
+            print(
+                f'{name:>15}  {len(hits):>9}  {statistics.median(ms):>9.2f}  '
+                f'{ms[int(len(ms) * 0.99)]:>9.2f}'
+            )
+        database.close()
+        db.close_writers()
+        db.close_pools()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Insert throughput and history latency of the sqlite and log storage backends.
+
+Each backend gets a scratch directory and is filled with ``--messages`` chat
+messages spread over ``--rooms`` rooms, recorded one at a time through the
+storage interface as handlers record them. Then ``--reads`` history requests
+ask a random room for its messages from a random point in the last tenth of the
+timeline on, as a client joining late would.
+
+    python benchmarks/bench_storage.py [--messages 50000] [--rooms 8] [--durability sync]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import db  # noqa: E402
+from server import storage  # noqa: E402
+from shared import constants  # noqa: E402
+
+
+def run(backend, messages, rooms, reads, durability, limit):
+    with tempfile.TemporaryDirectory() as scratch:
+        constants.SERVER_DATABASE = os.path.join(scratch, 'server.db')
+        constants.SEGMENT_LOG_DIR = os.path.join(scratch, 'server-log')
+        storage.prepare(backend, durability)
+        store = storage.open_store()
+        names = [f'room{n}' for n in range(rooms)]
+
+        started = time.perf_counter()
+        for n in range(messages):
+            store.add_message('alice', 'hash', '#000000', f'message {n}', n, names[n % rooms])
+        # One last message under sync waits for every write still behind it.
+        storage.prepare(backend, db.SYNC)
+        store.add_message('alice', 'hash', '#000000', 'last', messages, names[0])
+        inserted = messages / (time.perf_counter() - started)
+
+        rng = random.Random(0)
+        latencies = []
+        for _ in range(reads):
+            since = rng.randrange(messages - messages // 10, messages)
+            started = time.perf_counter()
+            store.recent_messages(rng.choice(names), since, limit)
+            latencies.append((time.perf_counter() - started) * 1000)
+        store.close()
+        storage.close_all()
+
+    ms = sorted(latencies)
+    print(
+        f'{backend:>7}  {inserted:>11,.0f}  {statistics.median(ms):>9.3f}  '
+        f'{ms[int(len(ms) * 0.99)]:>9.3f}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--rooms', type=int, default=8)
+    parser.add_argument('--reads', type=int, default=500)
+    parser.add_argument('--limit', type=int, default=constants.HISTORY_BUFFER_SIZE)
+    parser.add_argument('--durability', choices=db.DURABILITY_MODES, default=constants.DURABILITY)
+    args = parser.parse_args()
+    print(f'{"backend":>7}  {"inserts/s":>11}  {"p50 (ms)":>9}  {"p99 (ms)":>9}')
+    for backend in storage.BACKENDS:
+        run(backend, args.messages, args.rooms, args.reads, args.durability, args.limit)
+
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,12 @@ Because there is no Qt here, the same object the GUI runs can be driven headless
 in tests against a real server, so the tests and the UI exercise one code path.
 """
 
-import json
+import itertools
 import logging
+import queue
 import socket
-from typing import Iterator, NamedTuple, Optional
+import threading
+from typing import Dict, FrozenSet, Iterable, Iterator, List, NamedTuple, Optional
 
 from shared import constants
 from shared import handshake
@@ -27,9 +29,17 @@ logger = logging.getLogger('core')
 # Domain event types yielded by ClientCore.events().
 MESSAGE = 'message'  # payload: {nickname, message, color, time, id}
 USER_LIST = 'user_list'  # payload: {users: [...]}
-STATS = 'stats'  # payload: {sent: int, received: int} -- running byte totals
+SEARCH_RESULTS = 'search_results'  # payload: {query, page, more, error, hits: [message...]}
+# payload: {sent, received, sent_uncompressed, received_uncompressed} -- running byte
+# totals, on the wire and before compression (the same on an uncompressed connection)
+STATS = 'stats'
 DISCONNECTED = 'disconnected'  # payload: {error: Exception|None}; terminates the stream
 
+# Optional protocol features this client offers in its HELLO.
+FEATURES = frozenset({constants.Features.PRESENCE, constants.Features.HISTORY_PAGES})
+
+HISTORY_PAGE_TIMEOUT = 10.0  # seconds HistoryPages waits for a page before giving up
+
 
 class Event(NamedTuple):
     type: str
@@ -41,6 +51,10 @@ class ConnectResult(NamedTuple):
     sock: Optional[socket.socket]
     reason: str = ''
     permanent: bool = False  # True when the server stated a refusal, so retrying is pointless
+    features: FrozenSet[str] = frozenset()  # optional features both sides agreed on
+    version: int = protocol.LEGACY_VERSION  # protocol version the connection continues in
+    serializer: str = protocol.JSON  # what the server serializes frames with
+    compressed: bool = False  # True when frames may be compressed both ways
 
 
 def open_connection(
@@ -52,6 +66,8 @@ def open_connection(
     server_hostname: Optional[str] = None,
     timeout: Optional[float] = None,
     is_probe: bool = False,
+    features: Iterable[str] = (),
+    compress: bool = False,
 ) -> ConnectResult:
     """Open a socket and run the client handshake, the one true 'connect' path.
 
@@ -60,6 +76,8 @@ def open_connection(
     bounds both the TCP connect and the handshake; a real connect leaves it unset
     and then streams on a blocking socket. ``is_probe`` tells the server this is a
     reachability check it can answer and close, rather than a client to set up.
+    ``features`` are the optional protocol features to offer the server, and
+    ``compress`` asks it to compress the connection.
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     if timeout is not None:
@@ -79,6 +97,8 @@ def open_connection(
         server_hostname=server_hostname or host,
         timeout=handshake_timeout,
         is_probe=is_probe,
+        features=features,
+        want_compression=compress,
     )
     if not result.ok:
         try:
@@ -89,7 +109,14 @@ def open_connection(
 
     assert result.sock is not None  # ok implies an upgraded, usable socket
     result.sock.settimeout(None)  # the streaming phase blocks on recv
-    return ConnectResult(True, result.sock)
+    return ConnectResult(
+        True,
+        result.sock,
+        features=result.features,
+        version=result.version,
+        serializer=result.serializer,
+        compressed=result.compressed,
+    )
 
 
 class ProbeResult(NamedTuple):
@@ -129,15 +156,32 @@ class ClientCore:
         use_tls: bool = False,
         verify: bool = constants.TLS_VERIFY,
         version: int = protocol.PROTOCOL_VERSION,
+        compress: bool = constants.COMPRESSION,
     ):
         self.host, self.port, self.nickname = host, port, nickname
         self.use_tls, self.verify, self.version = use_tls, verify, version
+        self.compress = compress
         self.sock: Optional[socket.socket] = None
         self.reason = ''
         self.permanent = False
-        self.sent = 0
-        self.received = 0
+        # Bytes on the wire, and what they came to uncompressed.
+        self.sent = self.sent_uncompressed = 0
+        self.received = self.received_uncompressed = 0
+        self._compressor: Optional[protocol.Compressor] = None
+        self._decompressor: Optional[protocol.Decompressor] = None
+        self._writer: Optional[protocol.FrameWriter] = None
+        # Held from compressing a frame until it is written, so frames reach the
+        # wire in the order they went through the zlib stream.
+        self._send_lock = threading.Lock()
         self._delays: Optional[Iterator[float]] = None
+        self.features: FrozenSet[str] = frozenset()
+        self.agreed_version = protocol.LEGACY_VERSION  # framing the server chose to talk in
+        self.serializer = protocol.JSON
+        # The current room's members by id, kept up to date from presence deltas.
+        self.roster: Dict[str, dict] = {}
+        # HistoryPages waiting on HISTORY_PAGE frames, by the ref their requests carry.
+        self._pagers: Dict[str, 'queue.Queue[dict]'] = {}
+        self._refs = itertools.count(1)
 
     def connect(self) -> ConnectResult:
         """(Re)open the connection, recording why it failed for the caller to act on."""
@@ -148,9 +192,16 @@ class ClientCore:
             verify=self.verify,
             version=self.version,
             server_hostname=self.host,
+            features=FEATURES,
+            compress=self.compress,
         )
         if result.ok:
             self.sock = result.sock
+            self.features = result.features
+            self.agreed_version, self.serializer = result.version, result.serializer
+            self._compressor = protocol.Compressor() if result.compressed else None
+            self._decompressor = protocol.Decompressor() if result.compressed else None
+            self.roster = {}
             self.reason, self.permanent = '', False
         else:
             self.reason, self.permanent = result.reason, result.permanent
@@ -162,20 +213,25 @@ class ClientCore:
         Frame reading, the byte-count stats, and protocol control replies all
         happen in here; the view just consumes the events it cares about.
         """
+        reader = protocol.FrameReader(self.sock, self.agreed_version)
+        header = protocol.header_length(self.agreed_version)
         try:
             while True:
                 try:
-                    raw_header = protocol.recv_exact(self.sock, protocol.HEADER_LENGTH)
-                    length = int(raw_header.decode('utf-8'))
-                    raw_body = protocol.recv_exact(self.sock, length)
-                    message = json.loads(raw_body.decode('utf-8'))
+                    kind, body = reader.read_frame()
+                    on_wire = header + len(body)
+                    if kind & protocol.FLAG_COMPRESSED and self._decompressor is not None:
+                        body = self._decompressor.decompress(body)
+                        kind &= ~protocol.FLAG_COMPRESSED
+                    message = protocol.decode(body, kind)
                 except Exception as e:
                     logger.log(logging.INFO, 'Connection closed: %s', e)
                     yield Event(DISCONNECTED, {'error': e})
                     return
 
-                self.received += len(raw_header) + len(raw_body)
-                yield Event(STATS, {'sent': self.sent, 'received': self.received})
+                self.received += on_wire
+                self.received_uncompressed += header + len(body)
+                yield Event(STATS, self.stats())
                 yield from self._dispatch(message)
         finally:
             self.close()
@@ -195,15 +251,67 @@ class ClientCore:
         elif kind == constants.Types.MESSAGE:
             yield Event(MESSAGE, _extract_message(message))
         elif kind == constants.Types.USER_LIST:
-            yield Event(USER_LIST, {'users': message['users']})
+            self.roster = {
+                user.get('id', str(index)): user for index, user in enumerate(message['users'])
+            }
+            yield self._roster_event()
+        elif kind == constants.Types.USER_JOINED:
+            user = message['user']
+            self.roster[user['id']] = user
+            yield self._roster_event()
+        elif kind == constants.Types.USER_LEFT:
+            self.roster.pop(message['id'], None)
+            yield self._roster_event()
+        elif kind == constants.Types.USER_RENAMED:
+            user = self.roster.get(message['id'])
+            if user is not None:
+                self.roster[message['id']] = dict(user, nickname=message['nickname'])
+                yield self._roster_event()
         elif kind == constants.Types.MESSAGE_HISTORY:
             for submessage in message['messages']:
                 yield Event(MESSAGE, _extract_message(submessage))
+        elif kind == constants.Types.SEARCH_RESULTS:
+            yield Event(
+                SEARCH_RESULTS,
+                {
+                    'query': message['query'],
+                    'page': message['page'],
+                    'more': message['more'],
+                    'error': message.get('error'),
+                    'hits': [_extract_message(hit) for hit in message['messages']],
+                },
+            )
+        elif kind == constants.Types.HISTORY_PAGE:
+            pager = self._pagers.get(message.get('ref', ''))
+            if pager is not None:
+                pager.put(message)
+            else:
+                logger.debug('Dropped a history page nobody is waiting for.')
+
+    def _roster_event(self) -> Event:
+        """The whole current roster, so the view renders a delta exactly as a full list."""
+        return Event(USER_LIST, {'users': list(self.roster.values())})
+
+    def stats(self) -> dict:
+        """The running byte totals a STATS event carries."""
+        return {
+            'sent': self.sent,
+            'received': self.received,
+            'sent_uncompressed': self.sent_uncompressed,
+            'received_uncompressed': self.received_uncompressed,
+        }
 
     def _send(self, data: bytes) -> None:
         assert self.sock is not None, 'not connected'
-        self.sent += len(data)
-        self.sock.send(data)
+        data = protocol.reframe(data, self.agreed_version, self.serializer)
+        with self._send_lock:
+            self.sent_uncompressed += len(data)
+            if self._compressor is not None:
+                data = self._compressor.compress(data)
+            self.sent += len(data)
+            if self._writer is None or self._writer.sock is not self.sock:
+                self._writer = protocol.FrameWriter(self.sock)
+            self._writer.write([data])
 
     def send_message(self, text: str) -> None:
         """Send a chat message (or slash command) to the server."""
@@ -211,6 +319,21 @@ class ClientCore:
         if text:
             self._send(helpers.prepare_json({'type': constants.Types.MESSAGE, 'content': text}))
 
+    def history_pages(
+        self,
+        before_id: Optional[int] = None,
+        after_id: Optional[int] = None,
+        page_size: int = 50,
+        prefetch: int = 1,
+    ) -> 'HistoryPages':
+        """Page through the current room's history, fetching each page only when asked for.
+
+        Pages go back from ``before_id`` (or from the newest message), or forward
+        from ``after_id`` when only that is given. The pages arrive on the socket
+        :meth:`events` is reading, so that must be running on another thread.
+        """
+        return HistoryPages(self, before_id, after_id, page_size, prefetch)
+
     def send_quit(self) -> None:
         """Tell the server we are leaving; safe to call on a dead socket."""
         try:
@@ -236,6 +359,84 @@ class ClientCore:
         self._delays = None
 
 
+class HistoryPages:
+    """An iterator over pages of a room's history, each a list of messages oldest first.
+
+    Nothing is requested until the first ``next()``; each GET_HISTORY_PAGE then
+    asks for ``prefetch`` pages, which the server streams as separate frames, and
+    the next request goes out once they have all been handed out. Iteration stops
+    at the end of the history, or at once if the server cannot page.
+    """
+
+    def __init__(
+        self,
+        core: ClientCore,
+        before_id: Optional[int],
+        after_id: Optional[int],
+        page_size: int,
+        prefetch: int = 1,
+        timeout: float = HISTORY_PAGE_TIMEOUT,
+    ) -> None:
+        self.core = core
+        self.before_id, self.after_id = before_id, after_id
+        self.forward = before_id is None and after_id is not None
+        self.page_size, self.timeout = page_size, timeout
+        self.prefetch = min(constants.HISTORY_MAX_PAGES, max(1, prefetch))
+        self.ref = f'history-{next(core._refs)}'
+        self._frames: 'queue.Queue[dict]' = queue.Queue()
+        self._pending = 0  # pages asked for that have not arrived yet
+        self._more = constants.Features.HISTORY_PAGES in core.features
+
+    def __iter__(self) -> 'HistoryPages':
+        return self
+
+    def __next__(self) -> List[dict]:
+        if not self._pending:
+            if not self._more:
+                self.close()
+                raise StopIteration
+            self._request()
+        try:
+            frame = self._frames.get(timeout=self.timeout)
+        except queue.Empty:
+            self.close()
+            raise TimeoutError('no history page arrived in time')
+        self._pending -= 1
+        self._more = frame['more']
+        if not self._more:
+            self._pending = 0  # the server stops streaming at the end
+        messages = [_extract_message(message) for message in frame['messages']]
+        if not messages:
+            self.close()
+            raise StopIteration
+        if self.forward:
+            self.after_id = messages[-1]['id']
+        else:
+            self.before_id = messages[0]['id']
+        return messages
+
+    def _request(self) -> None:
+        self.core._pagers[self.ref] = self._frames
+        self._pending = self.prefetch
+        self.core._send(
+            helpers.prepare_json(
+                {
+                    'type': constants.Types.REQUEST,
+                    'request': constants.Requests.GET_HISTORY_PAGE,
+                    'before_id': self.before_id,
+                    'after_id': self.after_id,
+                    'page_size': self.page_size,
+                    'pages': self.prefetch,
+                    'ref': self.ref,
+                }
+            )
+        )
+
+    def close(self) -> None:
+        """Stop listening for this iterator's pages."""
+        self.core._pagers.pop(self.ref, None)
+
+
 def _extract_message(data: dict) -> dict:
     return {
         'nickname': data['nickname'],
@@ -1,8 +1,9 @@
+import html
 import logging
 from typing import List, Optional
 
 from PyQt5.QtCore import Qt, QEvent, QTimer
-from PyQt5.QtWidgets import QMainWindow, QLabel
+from PyQt5.QtWidgets import QMainWindow, QLabel, QMessageBox
 from sortedcontainers import SortedList
 
 from shared import constants
@@ -30,6 +31,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.core = core.ClientCore(ip, port, nickname, use_tls=use_tls)
         self.closed = False
         self._stability_timer: Optional[QTimer] = None
+        self.search_box: Optional[QMessageBox] = None
 
         # Connect before showing: a failed connection should come back to the
         # caller as an error, not flash a half-built window on screen.
@@ -68,6 +70,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             self.add_message(event.payload)
         elif event.type == core.USER_LIST:
             self.update_connections(event.payload['users'])
+        elif event.type == core.SEARCH_RESULTS:
+            self.show_search_results(event.payload)
         elif event.type == core.STATS:
             self._render_stats()
         elif event.type == core.DISCONNECTED:
@@ -117,6 +121,10 @@ class MainWindow(QMainWindow, Ui_MainWindow):
             f'{helpers.sizeof_fmt(self.core.sent)} Sent, '
             f'{helpers.sizeof_fmt(self.core.received)} Received'
         )
+        self.data_stats.setToolTip(
+            f'Uncompressed: {helpers.sizeof_fmt(self.core.sent_uncompressed)} sent, '
+            f'{helpers.sizeof_fmt(self.core.received_uncompressed)} received'
+        )
 
     def closeEvent(self, event):
         """Handle closing by telling the server goodbye and stopping the receive thread."""
@@ -173,6 +181,23 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.core.send_message(message)
         self._render_stats()
 
+    def show_search_results(self, results: dict) -> None:
+        """Show a page of /search hits in a box of their own, apart from the chat."""
+        query = html.escape(results['query'])
+        if results['error']:
+            body = html.escape(results['error'])
+        elif not results['hits']:
+            body = f'No messages match <i>{query}</i>.'
+        else:
+            body = '<br>'.join(helpers.formatted_message(hit) for hit in results['hits'])
+            if results['more']:
+                body += f'<br><br>More: /search {query} #{results["page"] + 1}'
+        box = QMessageBox(QMessageBox.Information, f'Search: {results["query"]}', body, parent=self)
+        box.setTextFormat(Qt.RichText)
+        box.setModal(False)
+        box.show()
+        self.search_box = box  # keep it alive until the next search replaces it
+
     def update_connections(self, users: List[dict]):
         """Update the Connections List widget"""
         self.connectionsList.clear()
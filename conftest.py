@@ -27,21 +27,24 @@ def _wait_until_listening(host, port, deadline=5.0):
 def boot_server(monkeypatch):
     """Start a real serve() on a daemon thread and wait until it is listening.
 
-    Returns a factory so a test can boot one (optionally TLS) and then drive it
-    over real sockets -- the connection logic the UI actually runs, exercised
+    Returns a factory so a test can boot one (optionally TLS, on either engine)
+    and then drive it over real sockets -- the connection logic the UI actually runs, exercised
     headless rather than faked one side at a time.
     """
     from shared import constants
 
-    def _boot(port, use_tls=False, cert=None, key=None):
+    def _boot(port, use_tls=False, cert=None, key=None, engine='threads', **options):
         if use_tls:
             monkeypatch.setattr(constants, 'TLS_CERT', cert)
             monkeypatch.setattr(constants, 'TLS_KEY', key)
-        from server.main import serve
+        if engine == 'asyncio':
+            from server.aio import serve
+        else:
+            from server.main import serve
 
         thread = threading.Thread(
             target=serve,
-            kwargs={'host': '127.0.0.1', 'port': port, 'use_tls': use_tls},
+            kwargs={'host': '127.0.0.1', 'port': port, 'use_tls': use_tls, **options},
             daemon=True,
         )
         thread.start()
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import sys
+from typing import Any, Callable, Dict
 
 from shared import constants
 from shared import logging_config
@@ -23,6 +25,39 @@ def build_parser() -> argparse.ArgumentParser:
     server.add_argument('--host', default=None)
     server.add_argument('--port', type=int, default=None)
     server.add_argument('--tls', action='store_true', default=None, help='Serve over TLS')
+    server.add_argument(
+        '--engine',
+        choices=constants.ENGINES,
+        default=None,
+        help='Serve with a thread per client or with asyncio coroutines (default: threads)',
+    )
+    server.add_argument(
+        '--max-handshakes',
+        type=int,
+        default=None,
+        help=f'Handshakes negotiated at once (default: {constants.MAX_HANDSHAKES})',
+    )
+
+    archive = sub.add_parser('archive', help='Export or import the message archive')
+    archive_sub = archive.add_subparsers(dest='action')
+    archive_sub.required = True
+    for action, verb in (('export', 'Write messages to'), ('import', 'Add messages from')):
+        command = archive_sub.add_parser(action, help=f'{verb} a gzipped JSON Lines file')
+        command.add_argument('path', help='The archive file (.jsonl.gz); - for stdout/stdin')
+        command.add_argument(
+            '--database', default=None, help='The server database (default: shared/server.db)'
+        )
+        command.add_argument(
+            '--room', action='append', default=[], help='Only this room (may be repeated)'
+        )
+        command.add_argument('--since', default=None, help='From this time (epoch or ISO 8601)')
+        command.add_argument('--until', default=None, help='Before this time (epoch or ISO 8601)')
+        command.add_argument(
+            '--batch',
+            type=int,
+            default=constants.ARCHIVE_BATCH_SIZE,
+            help=f'Messages per batch (default: {constants.ARCHIVE_BATCH_SIZE})',
+        )
 
     client = sub.add_parser('client', aliases=['c', '1'], help='Run the chat client')
     client.add_argument('--host', default=None)
@@ -34,6 +69,25 @@ def build_parser() -> argparse.ArgumentParser:
     return parser
 
 
+def run_archive(args: argparse.Namespace) -> None:
+    """Export or import the message archive, as ``tcp-chat archive export|import`` asked."""
+    from server import archive
+    from server import db
+
+    try:
+        selection = archive.Selection(
+            tuple(args.room),
+            None if args.since is None else archive.parse_time(args.since),
+            None if args.until is None else archive.parse_time(args.until),
+        )
+        run = archive.export_messages if args.action == 'export' else archive.import_messages
+        run(args.path, args.database, selection, args.batch)
+    except (OSError, ValueError) as e:
+        sys.exit(f'Archive {args.action} failed: {e}')
+    finally:
+        db.close_pools()
+
+
 def main(argv=None) -> None:
     args = build_parser().parse_args(argv)
     logging_config.configure(
@@ -41,13 +95,65 @@ def main(argv=None) -> None:
     )
     config = Config.load(args.config) if args.config else Config.load()
 
-    if args.role in ('server', 's', '2'):
+    if args.role == 'archive':
+        run_archive(args)
+    elif args.role in ('server', 's', '2'):
         host = config.get('server', 'host', cli=args.host, default=constants.DEFAULT_IP)
         port = config.get('server', 'port', cli=args.port, default=constants.DEFAULT_PORT)
         use_tls = config.get('server', 'tls', cli=args.tls, default=constants.USE_TLS)
-        from server.main import serve
+        engine = config.get('server', 'engine', cli=args.engine, default=constants.SERVER_ENGINE)
+        max_handshakes = config.get(
+            'server', 'max_handshakes', cli=args.max_handshakes, default=constants.MAX_HANDSHAKES
+        )
+        options: Dict[str, Any] = {
+            'max_handshakes': max_handshakes,
+            'max_pending': config.get(
+                'server', 'max_pending_handshakes', default=constants.MAX_PENDING_HANDSHAKES
+            ),
+            'presence_window': config.get(
+                'server', 'presence_window', default=constants.PRESENCE_WINDOW
+            ),
+            'compression': config.get('server', 'compression', default=constants.COMPRESSION),
+        }
+        from server import db
+        from server import outbox
+        from server import retention
+        from server import storage
+
+        try:
+            options['retention'] = retention.parse_retention(
+                config.get('server', 'retention', default={})
+            )
+            options['durability'] = db.check_durability(
+                config.get('server', 'durability', default=constants.DURABILITY)
+            )
+            options['backend'] = storage.check_backend(
+                config.get('server', 'storage', default=constants.STORAGE_BACKEND)
+            )
+            options['send_queue'] = outbox.check_policy(
+                outbox.QueuePolicy(
+                    size=config.get('server', 'send_queue_size', default=constants.SEND_QUEUE_SIZE),
+                    on_full=config.get(
+                        'server', 'send_queue_policy', default=constants.SEND_QUEUE_POLICY
+                    ),
+                    deadline=config.get(
+                        'server', 'send_block_deadline', default=constants.SEND_BLOCK_DEADLINE
+                    ),
+                )
+            )
+        except ValueError as e:
+            sys.exit(f'Invalid server configuration: {e}')
+
+        serve: Callable[..., None]  # either engine's serve(); they share a signature prefix
+        if engine == 'asyncio':
+            from server import aio
+
+            serve = aio.serve
+        else:
+            from server import main as threaded
 
-        serve(host, port, use_tls)
+            serve = threaded.serve
+        serve(host, port, use_tls, **options)
     else:
         nickname = args.nickname
         if args.random:
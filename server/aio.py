@@ -0,0 +1,399 @@
+"""An asyncio server engine: every connection is a coroutine on one event loop.
+
+The threaded engine in :mod:`server.main` spends an OS thread per client. Here
+the handshake,
+receive loop, command dispatch and room fan-out all run as coroutines instead,
+and a quiet connection sleeps until its next keep-alive deadline rather than
+polling. The wire protocol and the HELLO/WELCOME/REJECT exchange are shared with
+the threaded engine, so existing clients connect to either one unchanged.
+
+Frames go through each client's :class:`server.outbox.AsyncOutbox`, drained by
+a task of its own, so a broadcast never waits on a slow recipient, and one that
+stops reading is held to the same send queue policy as under the threaded
+engine. Messages are recorded by the database's shared writer thread
+(:class:`server.db.MessageWriter`); the loop awaits each one's id instead of
+committing it itself. History requests are mostly answered from the rooms'
+in-memory buffers (:mod:`server.history`); the rest go to one database
+connection shared by the whole loop, as synchronous sqlite calls that stall
+every connection for as long as they take.
+"""
+
+import asyncio
+import logging
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Iterable, Optional
+
+from server import db
+from server import handler
+from server import metrics
+from server import outbox
+from server import resilience
+from server import search
+from server import storage
+from server.registry import ConnectionRegistry
+from server.retention import Retention, start_pruner
+from shared import constants
+from shared import handshake
+from shared import protocol
+from shared.exceptions import DataReceptionException, StopException
+
+logger = logging.getLogger('aio')
+
+
+class AsyncClient(handler.Client):
+    """A :class:`server.handler.Client` driven by coroutines over a stream pair.
+
+    Everything above the transport -- nicknames, rooms, commands, history -- is
+    inherited unchanged; only sending, receiving and closing are overridden.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        address: Any,
+        registry: ConnectionRegistry,
+        stop_flag: Callable[[], bool],
+        database: Optional[storage.Storage] = None,
+        queue_policy: Optional[outbox.QueuePolicy] = None,
+        features: Iterable[str] = (),
+        version: int = protocol.LEGACY_VERSION,
+        serializer: str = protocol.JSON,
+        compressed: bool = False,
+    ) -> None:
+        # The transport owns the socket, so skip BaseClient's timeout and Client's outbox.
+        self.attach(writer.get_extra_info('socket'), registry, address, stop_flag)
+        self.reader, self.writer = reader, writer
+        self.db = database
+        self.init_session(features, version, serializer, compressed)
+        self.outbox = outbox.AsyncOutbox(  # type: ignore[assignment]
+            writer,
+            queue_policy or outbox.QueuePolicy(),
+            on_error=self._writer_failed,
+            name=self.short_id,
+            compressor=protocol.Compressor() if compressed else None,
+        )
+
+    def __repr__(self) -> str:
+        if self.last_nickname_change is None:
+            return f'AsyncClient({self.short_id})'
+        return f'AsyncClient({self.nickname}, {self.short_id})'
+
+    def send_framed(self, frame: bytes, droppable: bool = True) -> None:
+        """Queue a framed message for this client's writer task."""
+        if self.writer.is_closing():
+            raise ConnectionResetError('the connection is already closing')
+        self.outbox.put(frame, droppable)
+
+    def shutdown(self) -> None:
+        """Stop the writer task, then close the transport."""
+        self.outbox.close()
+        self.writer.close()
+
+    def disconnect_database(self) -> None:
+        """Leave the loop's shared database open for everyone else."""
+        self.db = None
+
+    async def receive(self) -> Any:
+        """Wait for the next frame, running the keep-alive whenever a deadline passes.
+
+        Rather than waking on a fixed poll, each wait lasts exactly until the next
+        moment a PING could be due or the client could go stale. Only the header
+        wait is cut short that way: ``readexactly`` consumes nothing until the
+        whole header is buffered, so timing it out can't split a frame.
+        """
+        while True:
+            self.check_stop()
+            due = resilience.seconds_until_due(
+                self.last_seen,
+                self.last_ping,
+                time.time(),
+                constants.PING_INTERVAL,
+                constants.PING_TIMEOUT,
+            )
+            try:
+                header = await asyncio.wait_for(
+                    self.reader.readexactly(protocol.header_length(self.version)), due
+                )
+                break
+            except asyncio.TimeoutError:
+                # No data before the deadline; run the keep-alive.
+                self.heartbeat()
+                continue
+            except EOFError:  # asyncio.IncompleteReadError
+                raise DataReceptionException('The connection closed before a header arrived.')
+
+        try:
+            kind, length = protocol.parse_header(header, self.version)
+        except ValueError:
+            raise DataReceptionException('The socket did not receive the expected header.')
+
+        try:
+            body = await asyncio.wait_for(self.reader.readexactly(length), constants.PING_TIMEOUT)
+            data = protocol.decode(body, kind, self.decompressor)
+        except asyncio.TimeoutError:
+            raise DataReceptionException('The client stalled mid-message.')
+        except EOFError:
+            raise DataReceptionException('The connection closed mid-message.')
+        except ValueError:
+            raise DataReceptionException('The socket received a invalid JSON structure.')
+
+        self.last_seen = time.time()
+        logger.debug(f'Data received/parsed, type: {data["type"]}')
+        return data
+
+    def broadcast_message(self, message: str) -> None:
+        """Send the room a Server message once the writer has recorded it.
+
+        Waiting for its id here would block the whole loop, so the broadcast
+        happens from a callback when the write completes.
+        """
+        assert self.db is not None, 'broadcast_message runs after the database is connected'
+        timestamp = int(time.time())
+        room = self.current_room()
+        members = self.room_members()
+        written = self.db.submit_message(
+            'Server', 'server', constants.Colors.BLACK.hex, message, timestamp, room
+        )
+
+        def deliver(future: 'asyncio.Future[int]') -> None:
+            if future.exception() is not None:
+                logger.error(f'Could not record a server message: {future.exception()}')
+                return
+            self.registry.history.record(
+                room, (future.result(), 'Server', constants.Colors.BLACK.hex, message, timestamp)
+            )
+            self._fan_out(members, self._server_message(message, future.result(), timestamp))
+
+        asyncio.wrap_future(written).add_done_callback(deliver)
+
+    def when_done(self, future: 'Future[Any]', callback: Callable[[Any], None]) -> None:
+        """Call ``callback`` on the event loop once ``future`` resolves on another thread."""
+        asyncio.wrap_future(future).add_done_callback(callback)
+
+    async def handle(self) -> None:  # type: ignore[override]
+        """Coroutine mainloop for one connection, mirroring Client.handle."""
+        self.connect_database()
+
+        while True:
+            try:
+                data = await self.receive()
+                if data['type'] == constants.Types.MESSAGE:
+                    # Client.dispatch would block on the commit; await it instead.
+                    assert self.db is not None
+                    timestamp = int(time.time())
+                    message_id = await asyncio.wrap_future(
+                        self.db.submit_message(
+                            self.nickname,
+                            self.id,
+                            self.color.hex,
+                            data['content'],
+                            timestamp,
+                            self.room,
+                        )
+                    )
+                    self.remember(data['content'], message_id, timestamp)
+                    self.relay(data['content'], message_id)
+                elif not self.dispatch(data):
+                    break
+            except DataReceptionException as e:
+                logger.critical(e)
+                logger.warning('Aborting connection to the client.')
+                self.close()
+                break
+            except ConnectionResetError:
+                logger.critical('Lost connection to the client.')
+                self.close()
+                break
+            except StopException:
+                logger.info('Stop flag received from the event loop.')
+                self.close()
+                break
+            except Exception as e:
+                logger.critical(e, exc_info=True)
+                self.close()
+                break
+
+
+def _on_loop(future: 'Future[int]', callback: Callable[['Future[int]'], None]) -> None:
+    """Call ``callback`` on the event loop once ``future`` resolves on the writer thread."""
+    asyncio.wrap_future(future).add_done_callback(lambda _: callback(future))
+
+
+async def serve_async(
+    host: str = constants.DEFAULT_IP,
+    port: int = constants.DEFAULT_PORT,
+    use_tls: bool = False,
+    max_handshakes: int = constants.MAX_HANDSHAKES,
+    handshakes: Optional[metrics.Counters] = None,
+    presence_window: float = constants.PRESENCE_WINDOW,
+    max_pending: int = constants.MAX_PENDING_HANDSHAKES,
+    send_queue: Optional[outbox.QueuePolicy] = None,
+    durability: str = constants.DURABILITY,
+    retention: Optional[Retention] = None,
+    backend: str = constants.STORAGE_BACKEND,
+    compression: bool = constants.COMPRESSION,
+) -> None:
+    """Bind to host/port and serve clients as coroutines until cancelled.
+
+    Waiting for a HELLO costs a coroutine nothing, so every connection waits for
+    its own, against a deadline that starts when it was accepted; at most
+    ``max_handshakes`` then reply and upgrade at once. Beyond ``max_pending``
+    connections still waiting to speak, new arrivals are closed straight away.
+    Roster updates are coalesced on the event loop itself, so they never leave its
+    thread, and ``send_queue`` bounds each client's outbound queue as it does for
+    the threaded engine. ``durability`` says whether a message waits for its
+    commit before it is delivered (see server.db.MessageWriter), and messages
+    older or more numerous than ``retention`` allows are pruned by a thread (the
+    sqlite ``backend`` only; see server.storage). Clients that ask for a compressed
+    connection get one if ``compression`` allows it.
+    """
+    send_queue = outbox.check_policy(send_queue or outbox.QueuePolicy())
+    durability = db.check_durability(durability)
+    storage.prepare(backend, durability)  # create or migrate the store once, before anyone connects
+    database = storage.open_store()
+    clients = ConnectionRegistry(
+        presence_window,
+        schedule=asyncio.get_running_loop().call_later,
+        when_done=_on_loop,
+    )
+    clients.history.warm(database)
+    pruner = start_pruner(retention, backend, clients.history)
+    stop_flag: bool = False
+    if handshakes is None:
+        handshakes = metrics.handshake_counters()
+    counters = handshakes
+    limiter = asyncio.Semaphore(max(1, max_handshakes))
+
+    async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        address = writer.get_extra_info('peername')
+        deadline = time.monotonic() + handshake.HANDSHAKE_TIMEOUT
+        if counters['in_flight'] >= max_pending:
+            shed = counters.incr('shed')
+            logger.warning(f'Shedding connection from {address}: too many pending ({shed} so far)')
+            writer.close()
+            return
+        client = None
+        try:
+            counters.incr('in_flight')
+            try:
+                negotiation = await handshake.negotiate_server_async(
+                    reader,
+                    writer,
+                    require_tls=use_tls,
+                    supports_tls=use_tls,
+                    version=protocol.PROTOCOL_VERSION,
+                    certfile=constants.TLS_CERT,
+                    keyfile=constants.TLS_KEY,
+                    features=handler.FEATURES,
+                    deadline=deadline,
+                    limiter=limiter,
+                    supports_compression=compression,
+                )
+            finally:
+                counters.incr('in_flight', -1)
+
+            if negotiation.probe:
+                logger.debug(
+                    'Test connection from %s: %s',
+                    address,
+                    'reachable' if negotiation.ok else negotiation.reason,
+                )
+                counters.incr('completed' if negotiation.ok else 'refused')
+                writer.close()
+                return
+
+            if negotiation.timed_out:
+                timed_out = counters.incr('timed_out')
+                logger.info(f'Handshake from {address} timed out ({timed_out} so far)')
+                writer.close()
+                return
+
+            if not negotiation.ok:
+                counters.incr('refused')
+                logger.info(f'Refused connection from {address}: {negotiation.reason}')
+                writer.close()
+                return
+            counters.incr('completed')
+            logger.info(f'New connection from {address}')
+
+            client = AsyncClient(
+                reader,
+                writer,
+                address,
+                clients,
+                lambda: stop_flag,
+                database,
+                queue_policy=send_queue,
+                features=negotiation.features,
+                version=negotiation.version,
+                serializer=negotiation.serializer,
+                compressed=negotiation.compressed,
+            )
+            clients.add(client)
+            client.request_nickname()
+
+            logger.debug('Informing the room of the incoming connection.')
+            client.announce_join(client.room)
+        except Exception as e:
+            counters.incr('failed')
+            logger.warning(f'Dropping connection from {address}: {e}')
+            if client is not None:
+                client.discard()
+            else:
+                writer.close()
+            return
+
+        await client.handle()
+
+    server = await asyncio.start_server(on_connect, host, port, reuse_address=True)
+    logger.info(f'Waiting for connections on {host}:{port} (asyncio engine)...')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        stop_flag = True
+        for client in clients:
+            client.discard()
+        if pruner is not None:
+            pruner.stop()
+        database.close()
+        search.close_searches()
+        storage.close_all()
+
+
+def serve(
+    host: str = constants.DEFAULT_IP,
+    port: int = constants.DEFAULT_PORT,
+    use_tls: bool = False,
+    max_handshakes: int = constants.MAX_HANDSHAKES,
+    handshakes: Optional[metrics.Counters] = None,
+    presence_window: float = constants.PRESENCE_WINDOW,
+    max_pending: int = constants.MAX_PENDING_HANDSHAKES,
+    send_queue: Optional[outbox.QueuePolicy] = None,
+    durability: str = constants.DURABILITY,
+    retention: Optional[Retention] = None,
+    backend: str = constants.STORAGE_BACKEND,
+    compression: bool = constants.COMPRESSION,
+) -> None:
+    """Run the asyncio engine until interrupted; the counterpart of server.main.serve."""
+    try:
+        asyncio.run(
+            serve_async(
+                host,
+                port,
+                use_tls,
+                max_handshakes,
+                handshakes,
+                presence_window,
+                max_pending,
+                send_queue,
+                durability,
+                retention,
+                backend,
+                compression,
+            )
+        )
+    except KeyboardInterrupt:
+        logger.info('User stopped server manually.')
@@ -0,0 +1,187 @@
+"""Streaming export and import of the message archive, as gzipped JSON Lines.
+
+Backing up or moving ``server.db`` used to mean copying the file from under a
+running server. ``tcp-chat archive export`` instead writes the messages out one
+JSON object per line, through gzip, reading them in batches from a single
+snapshot of the database. A read transaction on a WAL database never blocks
+the server's writer (nor is it blocked by it), and sees every message committed
+before it began and none after, so the export is consistent even while the
+server runs. ``archive import`` reads such a file back the same way and inserts
+it ``batch`` rows per transaction with ``executemany``. Both hold one batch in
+memory at a time, however big the archive is.
+
+Each line is one message::
+
+    {"room": "general", "nickname": "ann", "hash": "...", "color": "#000000",
+     "message": "hi", "time": 1700000000, "id": 42}
+
+Imported messages get new ids, appended after those already in the database;
+the ``id`` in the file only orders them. Stop the server before importing: its
+writer hands out ids from memory, counting on from the largest there was when
+it started, and would collide with rows added behind its back.
+"""
+
+import datetime
+import gzip
+import json
+import logging
+import os
+import sys
+from typing import IO, Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, cast
+
+from server import db
+from shared import constants
+
+logger = logging.getLogger('archive')
+
+FIELDS = ('room', 'nickname', 'hash', 'color', 'message', 'time')
+
+
+class Selection(NamedTuple):
+    rooms: Tuple[str, ...] = ()  # no rooms: every room
+    since: Optional[int] = None  # first timestamp included
+    until: Optional[int] = None  # first timestamp excluded
+
+    def includes(self, room: str, timestamp: int) -> bool:
+        return (
+            (not self.rooms or room in self.rooms)
+            and (self.since is None or timestamp >= self.since)
+            and (self.until is None or timestamp < self.until)
+        )
+
+
+def parse_time(value: str) -> int:
+    """An epoch timestamp, given as one or as an ISO 8601 date or time (local time)."""
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return int(datetime.datetime.fromisoformat(value).timestamp())
+    except ValueError:
+        raise ValueError(f'{value!r} is neither an epoch timestamp nor an ISO 8601 date')
+
+
+def _open(path: str, mode: str) -> IO[str]:
+    """A text stream through gzip to or from ``path``; ``-`` is stdout or stdin."""
+    target: Any = path
+    if path == '-':
+        target = sys.stdout.buffer if 'w' in mode else sys.stdin.buffer
+    return cast(IO[str], gzip.open(target, mode + 't', encoding='utf-8'))
+
+
+def _where(selection: Selection) -> Tuple[str, List[Any]]:
+    clauses: List[str] = []
+    parameters: List[Any] = []
+    if selection.rooms:
+        clauses.append(f'room IN ({", ".join("?" * len(selection.rooms))})')
+        parameters.extend(selection.rooms)
+    if selection.since is not None:
+        clauses.append('timestamp >= ?')
+        parameters.append(selection.since)
+    if selection.until is not None:
+        clauses.append('timestamp < ?')
+        parameters.append(selection.until)
+    return (' WHERE ' + ' AND '.join(clauses) if clauses else ''), parameters
+
+
+def export_messages(
+    path: str,
+    database: Optional[str] = None,
+    selection: Selection = Selection(),
+    batch: int = constants.ARCHIVE_BATCH_SIZE,
+) -> int:
+    """Write the selected messages to ``path``, oldest id first; returns how many."""
+    database = database or constants.SERVER_DATABASE
+    if not os.path.exists(database):
+        raise FileNotFoundError(f'no message database at {database}')
+    where, parameters = _where(selection)
+    count = 0
+    with db.shared_pool(database).borrow() as conn, _open(path, 'w') as out:
+        conn.execute('BEGIN')  # one snapshot for the whole export
+        try:
+            cursor = conn.execute(
+                f'''SELECT id, room, nickname, connection_hash, color, message, timestamp
+                            FROM message{where} ORDER BY id''',
+                parameters,
+            )
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                for message_id, *fields in rows:
+                    record = dict(zip(FIELDS, fields), id=message_id)
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += len(rows)
+        finally:
+            conn.execute('COMMIT')
+    logger.info(f'Exported {count} message(s) to {path}.')
+    return count
+
+
+def read_records(lines: Iterable[str]) -> Iterator[Dict[str, Any]]:
+    """Parse archive lines, raising ValueError (with the line number) at the first bad one."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            missing = [field for field in FIELDS if field not in record]
+        except (json.JSONDecodeError, TypeError):
+            raise ValueError(f'line {number} is not a JSON object')
+        if missing:
+            raise ValueError(f'line {number} has no {", ".join(missing)}')
+        if not isinstance(record['time'], int):
+            raise ValueError(f'line {number} has a non-integer time')
+        yield record
+
+
+def import_messages(
+    path: str,
+    database: Optional[str] = None,
+    selection: Selection = Selection(),
+    batch: int = constants.ARCHIVE_BATCH_SIZE,
+) -> int:
+    """Insert the selected messages of the archive at ``path``; returns how many.
+
+    Each batch is its own transaction, so a bad line stops the import with every
+    batch before it committed. The server must not be running; see the module notes.
+    """
+    batch = max(1, batch)
+    store = db.ServerDatabase(database or constants.SERVER_DATABASE)
+    count = 0
+    try:
+        with _open(path, 'r') as source:
+            rows: List[db.Row] = []
+            for record in read_records(source):
+                if not selection.includes(record['room'], record['time']):
+                    continue
+                rows.append(
+                    (
+                        record['nickname'],
+                        record['hash'],
+                        record['color'],
+                        record['message'],
+                        record['time'],
+                        record['room'],
+                    )
+                )
+                if len(rows) == batch:
+                    count += _insert(store, rows)
+                    rows = []
+            count += _insert(store, rows)
+    finally:
+        store.close()
+    logger.info(f'Imported {count} message(s) from {path}.')
+    return count
+
+
+def _insert(store: db.ServerDatabase, rows: List[db.Row]) -> int:
+    if rows:
+        with db.lock, store.conn:
+            store.conn.executemany(
+                '''INSERT INTO message (nickname, connection_hash, color, message, timestamp, room)
+                        VALUES (?, ?, ?, ?, ?, ?)''',
+                rows,
+            )
+    return len(rows)
@@ -2,11 +2,11 @@ from __future__ import annotations
 
 import logging
 import random
+import re
 from typing import Any, Dict, List, Optional, Callable
 from typing import TYPE_CHECKING
 
 from shared import constants
-from server.rooms import room_counts
 
 if TYPE_CHECKING:
     from server.handler import Client
@@ -42,6 +42,13 @@ class CommandHandler:
             'List the active rooms and their member counts.',
             aliases=['channels'],
         )
+        self.__install_command(
+            self.search,
+            'Search',
+            'search',
+            'Search this room\'s messages, e.g. /search release notes (add #2 for page two).',
+            aliases=['find'],
+        )
         self.__install_command(
             self.help,
             'Help',
@@ -136,18 +143,33 @@ class CommandHandler:
         client.broadcast_message(f'{client.nickname} left for {room}.')
         client.room = room
         client.broadcast_message(f'{client.nickname} joined the room.')
-        client.notify_room(old_room)
-        client.notify_room(room)
+        client.announce_leave(old_room)
+        client.announce_join(room)
         return None
 
     def rooms(self, *args) -> Optional[str]:
         """
         List the active rooms and how many people are in each.
         """
-        counts = room_counts(self.client.all_clients)
+        counts = self.client.registry.rooms.counts()
         listing = ', '.join(f'{name} ({count})' for name, count in sorted(counts.items()))
         return f'Active rooms: {listing}'
 
+    def search(self, *words: str) -> Optional[str]:
+        """
+        Look up the room's messages containing every word; only the searcher sees the hits.
+        """
+        terms = list(words)
+        page = 1
+        if terms and re.fullmatch(r'#\d+', terms[-1]):
+            page = int(terms.pop()[1:])
+        if not terms:
+            return 'Usage: /search <words> [#page]'
+
+        # The hits arrive later, as a SEARCH_RESULTS frame; the query runs elsewhere.
+        self.client.search(terms, page)
+        return None
+
     def help(self, command: Optional[str] = None) -> Optional[str]:
         """
         Print information about a given command
@@ -1,17 +1,33 @@
 import abc
+import collections
 import datetime
 import logging
 import os
 import sqlite3
 import threading
-from typing import List, Optional
+import contextlib
+import queue
+import time
+import urllib.request
+from concurrent.futures import Future
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
 
+from server import storage
 from shared import constants
 
 logger = logging.getLogger('database')
 
 lock = threading.Lock()
 
+SCHEMA_VERSION = 4  # the message table's layout; see ServerDatabase.migrate
+AUTO_VACUUM_INCREMENTAL = 2  # what PRAGMA auto_vacuum reports for INCREMENTAL
+
+HistoryRow = storage.HistoryRow
+
+# When a message's sender learns its id, and so when it is delivered; see MessageWriter.
+SYNC, ASYNC, NONE = 'sync', 'async', 'none'
+DURABILITY_MODES = (SYNC, ASYNC, NONE)
+
 
 class Database(abc.ABC):
     def __init__(self, database: str):
@@ -154,46 +170,530 @@ class ClientDatabase(Database):
         }
 
 
-class ServerDatabase(Database):
-    def __init__(self):
-        super().__init__(constants.SERVER_DATABASE)
+class MessageStore(storage.Storage):
+    """
+    A handler's store backed by the server's sqlite database: the ``sqlite`` backend.
+
+    A store owns no connection. Messages are written by the file's shared
+    MessageWriter and history is read on a connection borrowed from the file's
+    shared ConnectionPool, so a handler costs no file handle, page cache or
+    schema check of its own, and opening one is free.
+    """
+
+    def __init__(self, database: Optional[str] = None):
+        self.path = database or constants.SERVER_DATABASE
+        self._closed = False
+
+    @property
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        """Stop using the store; the shared writer and pool stay open for everyone else."""
+        self._closed = True
+
+    def recent_messages(self, room: str, since: int, limit: int) -> List[HistoryRow]:
+        """
+        The first `limit` messages sent to `room` at or after `since`, oldest first.
+
+        :return: HistoryRow tuples, as sent in MESSAGE_HISTORY.
+        """
+        with shared_pool(self.path).borrow() as conn:
+            return conn.execute(
+                '''SELECT id, nickname, color, message, timestamp
+                            FROM message
+                            WHERE room = ? AND timestamp >= ?
+                            ORDER BY timestamp
+                            LIMIT ?''',
+                [room, since, limit],
+            ).fetchall()
+
+    def page_messages(
+        self, room: str, before_id: Optional[int], after_id: Optional[int], limit: int
+    ) -> List[HistoryRow]:
+        """
+        Up to `limit` of `room`'s messages with ids between the two bounds, oldest first.
+
+        Read off the (room, id) index from whichever bound the page starts at; see
+        :meth:`server.storage.Storage.page_messages`.
+        """
+        forward = before_id is None and after_id is not None
+        with shared_pool(self.path).borrow() as conn:
+            rows = conn.execute(
+                f'''SELECT id, nickname, color, message, timestamp
+                            FROM message
+                            WHERE room = ? AND id < ? AND id > ?
+                            ORDER BY id {'ASC' if forward else 'DESC'}
+                            LIMIT ?''',
+                [
+                    room,
+                    2**63 - 1 if before_id is None else before_id,
+                    0 if after_id is None else after_id,
+                    limit,
+                ],
+            ).fetchall()
+        return rows if forward else rows[::-1]
+
+    def search_messages(
+        self, room: str, terms: List[str], offset: int, limit: int
+    ) -> List[HistoryRow]:
+        """
+        `room`'s messages containing every one of `terms`, best match (bm25) first.
+
+        Scoring a match costs a lookup of its own, so a word found in most messages
+        would make a search as slow as the table is long. Only the room's newest
+        SEARCH_RANK_WINDOW matches (or as many as the page reaches into) are scored,
+        which bounds that cost: a very common word finds its best hits among recent ones.
+
+        :return: At most `limit` HistoryRow tuples, skipping the first `offset` hits.
+        """
+        window = max(constants.SEARCH_RANK_WINDOW, offset + limit)
+        with shared_pool(self.path).borrow() as conn:
+            return conn.execute(
+                '''SELECT id, nickname, color, message, timestamp FROM (
+                                SELECT message.id, nickname, color, message.message, timestamp,
+                                    message_fts.rank AS score
+                                FROM message_fts JOIN message ON message.id = message_fts.rowid
+                                WHERE message_fts MATCH ? AND room = ?
+                                ORDER BY message_fts.rowid DESC
+                                LIMIT ?)
+                            ORDER BY score
+                            LIMIT ? OFFSET ?''',
+                [fts_query(terms), room, window, limit, offset],
+            ).fetchall()
+
+    def latest_messages(self, limit: int) -> Dict[str, List[HistoryRow]]:
+        """Every room's newest `limit` messages, oldest first, e.g. to warm a history buffer."""
+        with shared_pool(self.path).borrow() as conn:
+            conn.execute('BEGIN')  # one snapshot across every room's query
+            try:
+                rooms = [row[0] for row in conn.execute('SELECT DISTINCT room FROM message')]
+                latest = {}
+                for room in rooms:
+                    rows = conn.execute(
+                        '''SELECT id, nickname, color, message, timestamp
+                                    FROM message
+                                    WHERE room = ?
+                                    ORDER BY timestamp DESC, id DESC
+                                    LIMIT ?''',
+                        [room, limit],
+                    ).fetchall()
+                    latest[room] = rows[::-1]
+                return latest
+            finally:
+                conn.execute('COMMIT')
+
+    def submit_message(
+        self,
+        nickname: str,
+        user_hash: str,
+        color: str,
+        message: str,
+        timestamp: int,
+        room: str = constants.DEFAULT_ROOM,
+    ) -> 'Future[int]':
+        """Queue a message for insertion without waiting; the future resolves to its ID."""
+        return shared_writer(self.path).submit(nickname, user_hash, color, message, timestamp, room)
+
+
+class ServerDatabase(Database, MessageStore):
+    """
+    The server's message database, with a connection of its own for the schema.
+
+    The file is kept in WAL mode, so readers never wait for the writer and the writer
+    never waits for readers. Writes go through the file's shared MessageWriter under
+    the global lock; history reads use read-only pooled connections and take no lock
+    at all, each one reading a consistent snapshot of the table.
+    """
+
+    def __init__(self, database: Optional[str] = None):
+        self.path = database or constants.SERVER_DATABASE
+        super().__init__(self.path)
 
     def construct(self):
+        # Only takes effect on a new, empty file; migrate() converts older ones.
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if self.conn.execute('PRAGMA journal_mode').fetchone()[0] != 'wal':
+            with lock:
+                self.conn.execute('PRAGMA journal_mode=WAL')
         self.conn.execute(
-            '''CREATE TABLE IF NOT EXISTS message
+            f'''CREATE TABLE IF NOT EXISTS message
                             (id INTEGER PRIMARY KEY,
                             nickname TEXT NOT NULL,
                             connection_hash TEXT NOT NULL,
                             color TEXT DEFAULT '#000000',
                             message TEXT DEFAULT '',
-                            timestamp INTEGER NOT NULL)'''
+                            timestamp INTEGER NOT NULL,
+                            room TEXT NOT NULL DEFAULT '{constants.DEFAULT_ROOM}')'''
         )
+        self.migrate()
 
-    def add_message(
-        self, nickname: str, user_hash: str, color: str, message: str, timestamp: int
-    ) -> int:
+    def migrate(self) -> None:
         """
-        Insert a message into the database. Returns the message ID.
-
-        :param nickname: A non-unique identifier for the user.
-        :param user_hash: A unique hash (usually) denoting the sender's identity.
-        :param color: The color of the user who sent the message.
-        :param message: The string content of the message echoed to all clients.
-        :param timestamp: The epoch time of the sent message.
-        :return: The unique integer primary key chosen for the message, i.e. it's ID.
+        Bring a database written by an older server up to SCHEMA_VERSION.
+
+        The applied version is kept in sqlite's ``user_version`` pragma, so every step
+        runs once per file. Version 1 files each message under a room (older rows all
+        belong to the default room) and indexes messages by (room, timestamp), which
+        lets a history request read one room's recent messages off the index rather
+        than scanning the whole table. Version 2 turns on incremental auto-vacuum, so
+        the space pruned messages leave behind can be handed back a little at a time;
+        an existing file has to be rebuilt once, with a full VACUUM, to switch.
+        Version 3 indexes messages by (room, id) too, for paging through a room's
+        history from a message id. Version 4 adds ``message_fts``, a full-text index
+        of the message column kept in step with the table by triggers (so the
+        writer and the pruner need not know about it), and fills it from the rows
+        already there.
         """
+        if self.conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return  # the usual case, and no need to wait on the writer to find out
         with lock:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= SCHEMA_VERSION:
+                return
             with self.conn:
-                cur = self.conn.cursor()
-                try:
-                    cur.execute(
-                        '''INSERT INTO message (nickname, connection_hash, color, message, timestamp)
-                                VALUES (?, ?, ?, ?, ?)''',
-                        [nickname, user_hash, color, message, timestamp],
+                columns = [row[1] for row in self.conn.execute('PRAGMA table_info(message)')]
+                if 'room' not in columns:
+                    self.conn.execute(
+                        f"ALTER TABLE message ADD COLUMN room TEXT NOT NULL "
+                        f"DEFAULT '{constants.DEFAULT_ROOM}'"
                     )
-                    message_id = cur.lastrowid
-                    assert message_id is not None  # always set right after an INSERT
-                    logger.debug(f'Message #{message_id} recorded.')
-                    return message_id
-                finally:
-                    cur.close()
+                self.conn.execute(
+                    'CREATE INDEX IF NOT EXISTS message_room_time ON message (room, timestamp)'
+                )
+                self.conn.execute(
+                    'CREATE INDEX IF NOT EXISTS message_room_id ON message (room, id)'
+                )
+                for statement in FTS_SCHEMA:
+                    self.conn.execute(statement)
+                if version < 4:
+                    self.conn.execute("INSERT INTO message_fts (message_fts) VALUES ('rebuild')")
+            if self.conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+                self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                self.conn.execute('VACUUM')  # outside any transaction
+            self.conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        logger.info(f'Migrated the message table from version {version} to {SCHEMA_VERSION}.')
+
+
+# An external-content full-text index over message.message, rowid = message.id.
+# Messages are only ever inserted and deleted, so those are the triggers it needs.
+FTS_SCHEMA = (
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS message_fts
+            USING fts5 (message, content = 'message', content_rowid = 'id')''',
+    '''CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+            INSERT INTO message_fts (rowid, message) VALUES (new.id, new.message);
+        END''',
+    '''CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+            INSERT INTO message_fts (message_fts, rowid, message)
+                VALUES ('delete', old.id, old.message);
+        END''',
+)
+
+
+def fts_query(terms: List[str]) -> str:
+    """An FTS5 query matching every one of ``terms`` as a plain word, whatever it contains."""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+# nickname, connection_hash, color, message, timestamp, room
+Row = Tuple[str, str, str, str, int, str]
+
+
+class WriterStats(NamedTuple):
+    batches: int  # transactions committed
+    rows: int  # messages inserted across them
+    largest_batch: int
+    mean_commit: float  # seconds per transaction, insert through commit
+    max_commit: float
+
+
+def check_durability(durability: str) -> str:
+    """Return ``durability`` if it names a mode; raise ValueError otherwise."""
+    if durability not in DURABILITY_MODES:
+        raise ValueError(
+            f'unknown durability {durability!r} (expected one of {", ".join(DURABILITY_MODES)})'
+        )
+    return durability
+
+
+class MessageWriter:
+    """The one thread that inserts messages into a database file, with group commit.
+
+    Every connection used to insert and commit its own messages one at a time,
+    serialised on the global lock, so a burst paid for one commit (and one fsync)
+    per message. Here callers only queue rows. The writer thread takes everything
+    queued -- up to ``max_batch`` rows, after waiting up to ``max_delay`` seconds
+    for more to arrive -- and inserts the lot in a single transaction. With no
+    delay, a batch is simply whatever queued up while the previous commit was in
+    progress, so a lone message is never held back.
+
+    Message ids don't come from sqlite: the writer hands them out as rows are
+    queued, counting up from the largest id already in the file, so every caller
+    knows its id at once. ``durability`` decides when it is told:
+
+    * ``sync`` -- once the row's transaction has committed (and been fsynced), so
+      a message is never delivered before it is safe on disk;
+    * ``async`` -- straight away, while the row is still queued: delivery no longer
+      waits for the disk, and a crash loses at most the rows not yet committed;
+    * ``none`` -- straight away, and the writer also stops fsyncing, leaving it to
+      the operating system; a power cut can lose recently committed rows too.
+
+    Only this writer may add messages to its file while it runs, or the ids collide.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        max_batch: int = constants.WRITE_BATCH_SIZE,
+        max_delay: float = constants.WRITE_BATCH_DELAY,
+        durability: str = constants.DURABILITY,
+    ) -> None:
+        self.path = path or constants.SERVER_DATABASE
+        self.max_batch, self.max_delay = max(1, max_batch), max_delay
+        self.durability = durability
+        self._queue: Deque[Tuple[int, Row, 'Future[int]']] = collections.deque()
+        self._ready = threading.Condition()
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self._batches = self._rows = self._largest = 0
+        self._commit_total = self._commit_max = 0.0
+        database = ServerDatabase(self.path)
+        try:
+            self._last_id: int = database.conn.execute(
+                'SELECT COALESCE(MAX(id), 0) FROM message'
+            ).fetchone()[0]
+        finally:
+            database.close()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    @property
+    def durability(self) -> str:
+        return self._durability
+
+    @durability.setter
+    def durability(self, durability: str) -> None:
+        """Change when callers learn their ids; applies from the next message on."""
+        self._durability = check_durability(durability)
+
+    def submit(
+        self,
+        nickname: str,
+        user_hash: str,
+        color: str,
+        message: str,
+        timestamp: int,
+        room: str = constants.DEFAULT_ROOM,
+    ) -> 'Future[int]':
+        """Queue one message row; the returned future resolves to its ID -- once committed,
+        unless the writer's durability says not to wait."""
+        future: 'Future[int]' = Future()
+        with self._ready:
+            if self._closed:
+                raise RuntimeError('the message writer is closed')
+            self._last_id += 1
+            message_id = self._last_id
+            self._queue.append(
+                (message_id, (nickname, user_hash, color, message, timestamp, room), future)
+            )
+            self._ready.notify()
+        if self._durability != SYNC:
+            future.set_result(message_id)
+        return future
+
+    def add_message(
+        self,
+        nickname: str,
+        user_hash: str,
+        color: str,
+        message: str,
+        timestamp: int,
+        room: str = constants.DEFAULT_ROOM,
+    ) -> int:
+        """Insert one message and wait for its ID, like ServerDatabase.add_message."""
+        return self.submit(nickname, user_hash, color, message, timestamp, room).result()
+
+    def stats(self) -> WriterStats:
+        with self._stats_lock:
+            return WriterStats(
+                self._batches,
+                self._rows,
+                self._largest,
+                self._commit_total / self._batches if self._batches else 0.0,
+                self._commit_max,
+            )
+
+    def close(self) -> None:
+        """Commit everything already queued, then stop the writer thread."""
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+        self._thread.join()
+
+    def _next_batch(self) -> List[Tuple[int, Row, 'Future[int]']]:
+        """Block until rows are queued (or the writer closes) and take up to a batch."""
+        with self._ready:
+            while not self._queue and not self._closed:
+                self._ready.wait()
+            if self.max_delay > 0 and not self._closed:
+                end = time.monotonic() + self.max_delay
+                while len(self._queue) < self.max_batch and not self._closed:
+                    remaining = end - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+            count = min(len(self._queue), self.max_batch)
+            return [self._queue.popleft() for _ in range(count)]
+
+    def _run(self) -> None:
+        # sqlite connections belong to the thread that opened them.
+        database = ServerDatabase(self.path)
+        synchronous = None
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    return  # closed, and nothing left to write
+                wanted = 'OFF' if self._durability == NONE else 'FULL'
+                if wanted != synchronous:
+                    database.conn.execute(f'PRAGMA synchronous = {wanted}')
+                    synchronous = wanted
+                self._commit(database.conn, batch)
+        finally:
+            database.close()
+
+    def _commit(
+        self, conn: sqlite3.Connection, batch: List[Tuple[int, Row, 'Future[int]']]
+    ) -> None:
+        started = time.perf_counter()
+        try:
+            with lock:
+                with conn:
+                    conn.executemany(
+                        '''INSERT INTO message (id, nickname, connection_hash, color, message, timestamp, room)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                        [(message_id, *row) for message_id, row, _ in batch],
+                    )
+        except Exception as e:
+            logger.error(f'Failed to record {len(batch)} message(s): {e}')
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        elapsed = time.perf_counter() - started
+        with self._stats_lock:
+            self._batches += 1
+            self._rows += len(batch)
+            self._largest = max(self._largest, len(batch))
+            self._commit_total += elapsed
+            self._commit_max = max(self._commit_max, elapsed)
+        logger.debug(f'Recorded messages #{batch[0][0]}-#{batch[-1][0]} in one transaction.')
+        for message_id, _, future in batch:
+            if not future.done():
+                future.set_result(message_id)
+
+
+_writers: Dict[str, MessageWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def shared_writer(path: Optional[str] = None) -> MessageWriter:
+    """The process's one MessageWriter for a database file, started on first use."""
+    path = os.path.abspath(path or constants.SERVER_DATABASE)
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = _writers[path] = MessageWriter(path)
+        return writer
+
+
+def close_writers() -> None:
+    """Flush and stop every shared writer, e.g. as the server shuts down."""
+    with _writers_lock:
+        writers = list(_writers.values())
+        _writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+class ConnectionPool:
+    """A fixed number of read-only connections to a database file, lent out in turn.
+
+    Every client handler used to open a connection of its own -- a file handle and
+    a page cache per user, and a schema check on the join path -- only to run the
+    occasional history query. Now a file has one pool, whose creation prepares the
+    schema; connections are opened as they are first needed, at most ``size`` of
+    them, and a borrower waits when all are in use.
+    """
+
+    def __init__(self, path: Optional[str] = None, size: int = constants.DB_POOL_SIZE) -> None:
+        self.path = path or constants.SERVER_DATABASE
+        self.size = max(1, size)
+        ServerDatabase(self.path).close()  # create or migrate the schema, once
+        self._idle: 'queue.LifoQueue[sqlite3.Connection]' = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._closed = False
+
+    @contextlib.contextmanager
+    def borrow(self) -> Iterator[sqlite3.Connection]:
+        """Lend out a connection for one short operation, waiting if every one is in use."""
+        conn = self._take()
+        try:
+            yield conn
+        finally:
+            if self._closed:
+                conn.close()
+            else:
+                self._idle.put(conn)
+
+    def close(self) -> None:
+        """Close the idle connections; borrowed ones close as they are returned."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _take(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            opening = self._opened < self.size
+            if opening:
+                self._opened += 1
+        if opening:
+            return self._open()
+        return self._idle.get()
+
+    def _open(self) -> sqlite3.Connection:
+        uri = f'file:{urllib.request.pathname2url(os.path.abspath(self.path))}?mode=ro'
+        # Lent to one thread at a time, but not always the same one.
+        return sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False)
+
+
+_pools: Dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(path: Optional[str] = None) -> ConnectionPool:
+    """The process's one ConnectionPool for a database file, created on first use."""
+    path = os.path.abspath(path or constants.SERVER_DATABASE)
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+def close_pools() -> None:
+    """Close every shared pool, e.g. as the server shuts down."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
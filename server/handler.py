@@ -1,11 +1,10 @@
-import json
 import logging
 import random
 import socket
 import time
 import uuid
-from json import JSONDecodeError
-from typing import Any, Callable, List, Optional
+from concurrent.futures import Future
+from typing import Any, Callable, FrozenSet, Iterable, List, Optional
 
 from shared import constants
 from shared import helpers
@@ -13,13 +12,25 @@ from shared import protocol
 
 # noinspection PyUnresolvedReferences
 from shared.exceptions import DataReceptionException, StopException
-from server import db
-from server import rooms
+from server import outbox
 from server import resilience
+from server import search
+from server import storage
 from server.commands import CommandHandler
+from server.registry import ConnectionRegistry
 
 logger = logging.getLogger('handler')
 
+# Optional protocol extensions this server implements, accepted when a client offers them.
+FEATURES: FrozenSet[str] = frozenset(
+    {constants.Features.PRESENCE, constants.Features.HISTORY_PAGES}
+)
+
+
+def _message_id(value: Any) -> Optional[int]:
+    """A cursor id from a GET_HISTORY_PAGE request; anything but a whole number means none."""
+    return value if isinstance(value, int) and not isinstance(value, bool) else None
+
 
 class BaseClient(object):
     """A simple base class for the client containing basic client communication methods."""
@@ -27,38 +38,59 @@ class BaseClient(object):
     def __init__(
         self,
         conn: socket.socket,
-        all_clients: List['BaseClient'],
+        registry: ConnectionRegistry,
+        address,
+        stop_flag: Callable[[], bool],
+    ) -> None:
+        self.attach(conn, registry, address, stop_flag)
+        # Reads block until the client speaks; the heartbeat scheduler wakes a
+        # stale one (see wake()), so nothing here needs to poll.
+        self.conn.settimeout(None)
+
+    def attach(
+        self,
+        conn: socket.socket,
+        registry: ConnectionRegistry,
         address,
         stop_flag: Callable[[], bool],
     ) -> None:
-        self.conn, self.all_clients, self.address, self.stop_flag = (
+        """Set up the state every client shares, whichever engine drives its socket."""
+        self.conn, self.registry, self.address, self.stop_flag = (
             conn,
-            all_clients,
+            registry,
             address,
             stop_flag,
         )
-        self.db: Optional[db.ServerDatabase] = None
-
-        self.conn.settimeout(0.5)
+        self.db: Optional[storage.Storage] = None
+        self.version = protocol.LEGACY_VERSION  # how this client's frames are framed
+        self.serializer = protocol.JSON  # and what their bodies are serialized with
 
     def connect_database(self):
-        """"""
+        """Give this client a handle on the server's message store."""
         if self.db is None:
             logger.debug('Connecting client to database.')
-            self.db = db.ServerDatabase()
+            self.db = storage.open_store()
 
-    def send(self, message: bytes) -> None:
-        """Sends a pre-encoded message to this client."""
-        self.conn.send(message)
+    def send(self, message: bytes, droppable: bool = True) -> None:
+        """Sends a pre-encoded message to this client.
+
+        A frame that is not ``droppable`` survives a ``drop-oldest`` send queue overflow.
+        """
+        self.send_framed(protocol.reframe(message, self.version, self.serializer), droppable)
+
+    def send_framed(self, frame: bytes, droppable: bool = True) -> None:
+        """Sends a message already framed for this client's protocol version."""
+        self.conn.sendall(frame)
 
     def _fan_out(self, members, message: bytes) -> None:
         """Send a pre-encoded message to several clients, pruning any that error.
 
         A single unreachable recipient (a socket that has been closed out from
-        under us) must not abort delivery to everyone else, nor linger in the
-        connection list where it would break every later broadcast.
+        under us, or one so far behind that its send queue gave up) must not abort
+        delivery to everyone else, nor linger in the connection list where it
+        would break every later broadcast.
         """
-        for member in list(members):
+        for member in members:
             try:
                 member.send(message)
             except OSError as e:
@@ -66,11 +98,20 @@ class BaseClient(object):
                 member.discard()
 
     def discard(self) -> None:
-        """Drop this client from the shared list and close its socket, quietly."""
+        """Drop this client from the registry and close its socket, quietly."""
+        self.registry.remove(self)
+        self.shutdown()
+
+    def wake(self) -> None:
+        """Shut the socket down, so a handler thread blocked reading from it returns."""
         try:
-            self.all_clients.remove(self)
-        except ValueError:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
+
+    def shutdown(self) -> None:
+        """Close the underlying connection, ignoring one that is already closed."""
+        self.wake()
         try:
             self.conn.close()
         except OSError:
@@ -78,7 +119,7 @@ class BaseClient(object):
 
     def send_message(self, message: str) -> None:
         """Sends a string message as the server to this client."""
-        self.conn.send(
+        self.send(
             helpers.prepare_message(
                 nickname='Server', message=message, color=constants.Colors.BLACK.hex, message_id=-1
             )
@@ -88,27 +129,37 @@ class BaseClient(object):
         """Sends a string message to all connected clients as the Server."""
         assert self.db is not None, 'broadcast_message runs after the database is connected'
         timestamp = int(time.time())
+        room = self.current_room()
         message_id = self.db.add_message(
-            'Server', 'server', constants.Colors.BLACK.hex, message, timestamp
+            'Server', 'server', constants.Colors.BLACK.hex, message, timestamp, room
+        )
+        self.registry.history.record(
+            room, (message_id, 'Server', constants.Colors.BLACK.hex, message, timestamp)
         )
-        prepared = helpers.prepare_message(
+        self._fan_out(self.room_members(), self._server_message(message, message_id, timestamp))
+
+    @staticmethod
+    def _server_message(message: str, message_id: int, timestamp: int) -> bytes:
+        """Encode a recorded message from the Server."""
+        return helpers.prepare_message(
             nickname='Server',
             message=message,
             color=constants.Colors.BLACK.hex,
             message_id=message_id,
             timestamp=timestamp,
         )
-        self._fan_out(
-            rooms.members_in(self.all_clients, getattr(self, 'room', constants.DEFAULT_ROOM)),
-            prepared,
-        )
 
     def broadcast(self, message: bytes) -> None:
         """Sends a pre-encoded message to all clients in the sender's room"""
-        self._fan_out(
-            rooms.members_in(self.all_clients, getattr(self, 'room', constants.DEFAULT_ROOM)),
-            message,
-        )
+        self._fan_out(self.room_members(), message)
+
+    def current_room(self) -> str:
+        """The room this client is in; the default room until it has one of its own."""
+        return getattr(self, 'room', constants.DEFAULT_ROOM)
+
+    def room_members(self):
+        """Everyone currently sharing this client's room, itself included."""
+        return self.registry.rooms.members(self.current_room())
 
     def __repr__(self) -> str:
         return f'BaseClient({self.address})'
@@ -118,22 +169,53 @@ class Client(BaseClient):
     """
     A class dedicating to handling interactions between the server and the client.
 
-    Client.run() should be ran in a thread alongside the other clients.
+    Client.run() should be ran in a thread alongside the other clients. Outgoing
+    frames go through the client's own Outbox, so sending never blocks the caller.
     """
 
     def __init__(
         self,
         conn: socket.socket,
         address: Any,
-        all_clients: List['BaseClient'],
+        registry: ConnectionRegistry,
         stop_flag: Callable[[], bool],
+        queue_policy: Optional[outbox.QueuePolicy] = None,
+        features: Iterable[str] = (),
+        version: int = protocol.LEGACY_VERSION,
+        serializer: str = protocol.JSON,
+        compressed: bool = False,
     ):
-        super().__init__(conn, all_clients, address, stop_flag)
+        super().__init__(conn, registry, address, stop_flag)
+        self.init_session(features, version, serializer, compressed)
+        self.outbox = outbox.Outbox(
+            conn,
+            queue_policy or outbox.QueuePolicy(),
+            on_error=self._writer_failed,
+            name=self.short_id,
+            compressor=protocol.Compressor() if compressed else None,
+        )
+        self.frame_reader = protocol.FrameReader(conn, version)
 
+    def init_session(
+        self,
+        features: Iterable[str] = (),
+        version: int = protocol.LEGACY_VERSION,
+        serializer: str = protocol.JSON,
+        compressed: bool = False,
+    ) -> None:
+        """Give a freshly connected client its identity, room, colour and timers.
+
+        ``features`` are the optional protocol extensions agreed in its handshake,
+        ``version``, ``serializer`` and ``compressed`` how it agreed to frame
+        everything after it.
+        """
+        self.features: FrozenSet[str] = frozenset(features)
+        self.version, self.serializer = version, serializer
+        self.decompressor = protocol.Decompressor() if compressed else None
         self.id = str(uuid.uuid4())
         self.short_id = self.id[:8]
-        self.nickname = self.id[:8]
-        self.room = constants.DEFAULT_ROOM
+        self._nickname = self.id[:8]
+        self._room = constants.DEFAULT_ROOM
         self.color: constants.Color = random.choice(
             constants.Colors.has_contrast(float(constants.MINIMUM_CONTRAST))
         )
@@ -143,100 +225,192 @@ class Client(BaseClient):
         self.last_nickname_change: Optional[float] = None
         self.last_seen = time.time()
         self.last_ping = 0.0
+        self.expired = False  # set once the keep-alive gives up on the client
 
     def __repr__(self) -> str:
         if self.last_nickname_change is None:
             return f'Client({self.short_id})'
         return f'Client({self.nickname}, {self.short_id})'
 
+    @property
+    def room(self) -> str:
+        return self._room
+
+    @room.setter
+    def room(self, room: str) -> None:
+        """Change rooms, keeping the registry's room index in step."""
+        self._room = room
+        self.registry.rooms.move(self, room)
+
+    @property
+    def nickname(self) -> str:
+        return self._nickname
+
+    @nickname.setter
+    def nickname(self, nickname: str) -> None:
+        """Change nickname, keeping the registry's nickname index in step."""
+        old, self._nickname = self._nickname, nickname
+        self.registry.rename(self, old, nickname)
+
+    def send_framed(self, frame: bytes, droppable: bool = True) -> None:
+        """Queue a framed message for this client's writer thread."""
+        if self.conn.fileno() == -1:
+            raise ConnectionResetError('the socket is already closed')
+        self.outbox.put(frame, droppable)
+
+    def shutdown(self) -> None:
+        """Stop the writer thread, then close the socket."""
+        self.outbox.close()
+        super().shutdown()
+
+    def _writer_failed(self, error: OSError) -> None:
+        """Drop a client whose writer thread could no longer reach it."""
+        logger.warning(f'Pruning unreachable client {self!r}: {error}')
+        self.discard()
+
     def connect_database(self) -> None:
-        """Instantiate"""
+        """Give this client a handle on the server's message store; it opens no connection."""
         if self.db is None:
             logger.debug(f'Connecting Client({self.short_id}) to the database.')
-            self.db = db.ServerDatabase()
+            self.db = storage.open_store()
 
     def request_nickname(self) -> None:
         """Send a request for the client's nickname information."""
-        self.conn.send(helpers.prepare_request(constants.Requests.REQUEST_NICK))
+        self.send(helpers.prepare_request(constants.Requests.REQUEST_NICK))
+
+    def user_entry(self) -> dict:
+        """How this client appears in its roommates' user lists."""
+        return {'id': self.id, 'nickname': self.nickname, 'color': self.color.hex}
 
     def _room_user_list(self, room: str) -> bytes:
         """Encode the USER_LIST of everyone currently in `room`."""
-        mates = rooms.members_in(self.all_clients, room)
-        return helpers.prepare_json(
-            {
-                'type': constants.Types.USER_LIST,
-                'users': [
-                    {'nickname': other.nickname, 'color': other.color.hex} for other in mates
-                ],
-            }
-        )
+        mates = self.registry.rooms.members(room)
+        return helpers.prepare_user_list([other.user_entry() for other in mates])
 
     def send_connections_list(self) -> None:
         """Sends this client the list of users sharing its room."""
-        self.conn.send(self._room_user_list(self.room))
+        self.send(self._room_user_list(self.room))
 
     def notify_room(self, room: str) -> None:
         """Send every member of `room` a refreshed user list."""
-        self._fan_out(rooms.members_in(self.all_clients, room), self._room_user_list(room))
+        self._fan_out(self.registry.rooms.members(room), self._room_user_list(room))
+
+    def announce_join(self, room: str) -> None:
+        """Send this client the full list of `room`, which it just entered, and tell the room.
+
+        Like every roster change this goes through the registry's presence
+        debouncer, so a burst of them reaches each member as one update.
+        """
+        self.registry.presence.joined(self, room)
+
+    def announce_leave(self, room: str) -> None:
+        """Tell the members of `room` that this client has left it."""
+        self.registry.presence.left(self, room)
+
+    def announce_rename(self) -> None:
+        """Tell this client's room, itself included, about its new nickname."""
+        self.registry.presence.renamed(self, self.room)
 
     def send_message_history(self, limit: int, time_limit: int) -> None:
         limit = min(100, max(0, limit))
         time_limit = min(60 * 30, max(0, time_limit))
         min_time = int(time.time()) - time_limit
 
-        assert self.db is not None, 'send_message_history runs after the database is connected'
-        with db.lock:
-            cur = self.db.conn.cursor()
+        # Almost every request is for messages the room's buffer still holds, and
+        # usually for the same ones as the last client asked for.
+        frame = self.registry.history.encoded(self.room, min_time, limit)
+        if frame is None:
+            assert self.db is not None, 'send_message_history runs after the database is connected'
+            messages = self.db.recent_messages(self.room, min_time, limit)
+            frame = helpers.prepare_message_history(messages)
+        self.send(frame)
+
+    def send_history_pages(
+        self,
+        before_id: Optional[int],
+        after_id: Optional[int],
+        page_size: int,
+        pages: int = 1,
+        ref: Optional[str] = None,
+    ) -> None:
+        """Stream up to `pages` HISTORY_PAGE frames of the room's messages between two ids.
+
+        Unlike send_message_history there is no time limit: each frame is a bounded
+        page read off the (room, id) index, and a client that wants more asks again
+        from the last id it got. A backward request (the default) walks from
+        ``before_id`` (or the newest message) towards older ones; one with only an
+        ``after_id`` walks forward. Every frame says whether there is ``more``.
+        """
+        page_size = min(constants.HISTORY_PAGE_SIZE, max(1, page_size))
+        pages = min(constants.HISTORY_MAX_PAGES, max(1, pages))
+        forward = before_id is None and after_id is not None
+        assert self.db is not None, 'send_history_pages runs after the database is connected'
+        for _ in range(pages):
+            # One row past the page says whether another one follows.
+            rows = self.db.page_messages(self.room, before_id, after_id, page_size + 1)
+            more = len(rows) > page_size
+            rows = rows[:page_size] if forward else rows[-page_size:]
+            self.send(helpers.prepare_history_page(rows, more, ref))
+            if not more:
+                return
+            if forward:
+                after_id = rows[-1][0]
+            else:
+                before_id = rows[0][0]
+
+    def search(self, terms: List[str], page: int = 1) -> None:
+        """Search this client's room on the search threads and send it the hits, when ready."""
+        assert self.db is not None, 'search runs after the database is connected'
+        query = ' '.join(terms)
+
+        def reply(done: Any) -> None:
             try:
-                cur.execute(
-                    '''SELECT id, nickname, color, message, timestamp
-                                FROM message
-                                WHERE timestamp >= ?
-                                ORDER BY timestamp
-                                LIMIT ?''',
-                    [min_time, limit],
-                )
+                found = done.result()
+            except Exception as e:
+                logger.error(f'Searching for {query!r} failed: {e}')
+                frame = helpers.prepare_search_results(query, page, [], False, 'Search failed.')
+            else:
+                frame = helpers.prepare_search_results(query, found.page, found.hits, found.more)
+            try:
+                self.send(frame)
+            except OSError:
+                pass  # gone while the search ran
 
-                messages = cur.fetchall()
-                self.send(helpers.prepare_message_history(messages))
-            finally:
-                cur.close()
+        self.when_done(search.submit(self.db, self.current_room(), terms, page), reply)
+
+    def when_done(self, future: 'Future[Any]', callback: Callable[[Any], None]) -> None:
+        """Call ``callback`` with ``future`` once it resolves, on whichever thread resolves it."""
+        future.add_done_callback(callback)
 
     def receive(self) -> Any:
         """
         Attempt to receive raw data over the TCP Socket connection.
 
         This function takes use of the thread's Stop flag, and thus will raise a StopException automatically.
-        This function will raise and intercept socket.timeout exceptions regularly until a message header is received.
+        It blocks until a whole frame has arrived, unless one already has; stopping the server, or
+        the keep-alive giving up on the client, shuts the socket down (see wake()) so that the read
+        fails and this returns.
         """
 
-        while True:
-            try:
-                # Check if the stop flag has been set. Exceptions will be handled by parent function (handle).
-                self.check_stop()
-
-                # This will timeout in 0.5 seconds.
-                header = protocol.recv_exact(self.conn, protocol.HEADER_LENGTH)
-                break
-            except socket.timeout:
-                # No data this cycle; use the idle time to run the keep-alive.
-                self.heartbeat()
-                continue
-            except ConnectionError:
-                raise DataReceptionException('The connection closed before a header arrived.')
-
+        # Check if the stop flag has been set. Exceptions will be handled by parent function (handle).
+        self.check_stop()
         try:
-            length = int(header.decode('utf-8'))
+            kind, body = self.frame_reader.read_frame()
         except ValueError:
             raise DataReceptionException('The socket did not receive the expected header.')
+        except OSError:
+            self.check_stop()
+            if self.expired:
+                raise DataReceptionException('The client stopped responding.')
+            if self.frame_reader.buffered:
+                raise DataReceptionException('The connection closed mid-message.')
+            raise DataReceptionException('The connection closed before a header arrived.')
 
-        logger.debug(f'Header received - Length {length}')
+        logger.debug(f'Frame received - Length {len(body)}')
 
         try:
-            data = json.loads(protocol.recv_exact(self.conn, length).decode('utf-8'))
-        except ConnectionError:
-            raise DataReceptionException('The connection closed mid-message.')
-        except JSONDecodeError:
+            data = protocol.decode(body, kind, self.decompressor)
+        except ValueError:
             raise DataReceptionException('The socket received a invalid JSON structure.')
         else:
             self.last_seen = time.time()
@@ -244,16 +418,18 @@ class Client(BaseClient):
             return data
 
     def handle_nickname(self, nickname: str) -> None:
-        if self.last_nickname_change is None:
+        first = self.last_nickname_change is None
+        if first:
             logger.info(f'Nickname is {nickname}')
-            self.broadcast_message(f'{nickname} joined!')
-            self.last_nickname_change = time.time()
         else:
             logger.info(f'{self.nickname} changed their name to {nickname}')
         self.nickname = nickname
+        if first:
+            self.registry.presence.notice(self, self.room, 'joined')
+            self.last_nickname_change = time.time()
 
         # New nickname has to be sent to everyone sharing the room
-        self.notify_room(self.room)
+        self.announce_rename()
 
     def process_command(self, content: str) -> None:
         """Parse a slash-prefixed message and run it, broadcasting any reply.
@@ -276,9 +452,38 @@ class Client(BaseClient):
         if resilience.is_stale(self.last_seen, now, constants.PING_TIMEOUT):
             raise DataReceptionException('The client stopped responding.')
         if resilience.should_ping(self.last_seen, self.last_ping, now, constants.PING_INTERVAL):
-            self.conn.send(helpers.prepare_ping())
+            self.send(helpers.prepare_ping())
             self.last_ping = now
 
+    def next_keep_alive(self) -> float:
+        """Seconds until heartbeat() could next have something to do."""
+        return resilience.seconds_until_due(
+            self.last_seen,
+            self.last_ping,
+            time.time(),
+            constants.PING_INTERVAL,
+            constants.PING_TIMEOUT,
+        )
+
+    def keep_alive(self) -> Optional[float]:
+        """Run heartbeat() for the scheduler: the delay until it is next due, or None once gone.
+
+        A client that has gone stale is marked expired and woken, so its own
+        handler thread closes it exactly as it always has.
+        """
+        if self not in self.registry:
+            return None
+        try:
+            self.heartbeat()
+        except DataReceptionException as e:
+            logger.warning(f'{e} Dropping {self!r}.')
+            self.expired = True
+            self.wake()
+            return None
+        except OSError:
+            return None  # unreachable; whoever noticed is already dropping it
+        return self.next_keep_alive()
+
     def check_stop(self) -> None:
         """Raises a StopException if the stop flag is set to true by the commanding main thread."""
         stop_flag: bool = self.stop_flag()
@@ -287,15 +492,78 @@ class Client(BaseClient):
 
     def close(self) -> None:
         logger.info(f'Shutting down Client {self.id}. ({self.nickname})')
-        already_gone = self not in self.all_clients  # may already have been pruned
-        self.conn.close()  # Close socket connection
-        if not already_gone:
-            self.all_clients.remove(self)  # Remove the user from the global client list
-        self.broadcast_message(f'{self.nickname} left!')  # Now we can broadcast it's exit message
+        self.shutdown()  # Close socket connection
+        self.registry.remove(self)  # No-op if it was already pruned
+        self.registry.presence.notice(self, self.room, 'left')  # Now we can announce its exit
         # Inform the room's remaining members of the disconnect
-        self.notify_room(self.room)
+        self.announce_leave(self.room)
+        self.disconnect_database()
+
+    def disconnect_database(self) -> None:
+        """Let go of this client's database handle, if it took one."""
         if self.db is not None:
-            self.db.close()  # Close database connection
+            self.db.close()
+
+    def dispatch(self, data: dict) -> bool:
+        """Act on one decoded frame from the client; False once it has quit.
+
+        Shared by every engine's receive loop, so the threaded and asyncio servers
+        speak exactly the same protocol.
+        """
+        if data['type'] == constants.Types.REQUEST:
+            if data['request'] == constants.Requests.GET_MESSAGE_HISTORY:
+                self.send_message_history(
+                    limit=data.get('limit', 50), time_limit=data.get('time_limit', 60 * 30)
+                )
+            elif data['request'] == constants.Requests.GET_HISTORY_PAGE:
+                self.send_history_pages(
+                    before_id=_message_id(data.get('before_id')),
+                    after_id=_message_id(data.get('after_id')),
+                    page_size=data.get('page_size', constants.HISTORY_PAGE_SIZE),
+                    pages=data.get('pages', 1),
+                    ref=data.get('ref'),
+                )
+
+        elif data['type'] == constants.Types.PONG:
+            pass  # last_seen was already refreshed in receive()
+        elif data['type'] == constants.Types.QUIT:
+            logger.info(f'{self.nickname} sent QUIT, closing connection.')
+            self.close()
+            return False
+        elif data['type'] == constants.Types.NICKNAME:
+            self.handle_nickname(data['nickname'])
+        elif data['type'] == constants.Types.MESSAGE:
+            # Record the message in the DB.
+            assert self.db is not None  # connected before the receive loop starts
+            timestamp = int(time.time())
+            message_id = self.db.add_message(
+                self.nickname, self.id, self.color.hex, data['content'], timestamp, self.room
+            )
+            self.remember(data['content'], message_id, timestamp)
+            self.relay(data['content'], message_id)
+
+        return True
+
+    def remember(self, content: str, message_id: int, timestamp: int) -> None:
+        """Add a chat message this client just sent to its room's history buffer."""
+        self.registry.history.record(
+            self.room, (message_id, self.nickname, self.color.hex, content, timestamp)
+        )
+
+    def relay(self, content: str, message_id: int) -> None:
+        """Broadcast a recorded chat message to the room, then run it if it is a command."""
+        self.broadcast(
+            helpers.prepare_message(
+                nickname=self.nickname,
+                message=content,
+                color=self.color.hex,
+                message_id=message_id,
+            )
+        )
+
+        # Process commands
+        if content.strip().startswith('/'):
+            self.process_command(content)
 
     def handle(self) -> None:
         """Server mainloop function for a given socket connection"""
@@ -307,39 +575,8 @@ class Client(BaseClient):
                 logger.debug('Waiting to receive data')
                 data = self.receive()
 
-                if data['type'] == constants.Types.REQUEST:
-                    if data['request'] == constants.Requests.GET_MESSAGE_HISTORY:
-                        self.send_message_history(
-                            limit=data.get('limit', 50), time_limit=data.get('time_limit', 60 * 30)
-                        )
-
-                elif data['type'] == constants.Types.PONG:
-                    pass  # last_seen was already refreshed in receive()
-                elif data['type'] == constants.Types.QUIT:
-                    logger.info(f'{self.nickname} sent QUIT, closing connection.')
-                    self.close()
+                if not self.dispatch(data):
                     break
-                elif data['type'] == constants.Types.NICKNAME:
-                    self.handle_nickname(data['nickname'])
-                elif data['type'] == constants.Types.MESSAGE:
-                    # Record the message in the DB.
-                    assert self.db is not None  # connected at the top of handle()
-                    message_id = self.db.add_message(
-                        self.nickname, self.id, self.color.hex, data['content'], int(time.time())
-                    )
-
-                    self.broadcast(
-                        helpers.prepare_message(
-                            nickname=self.nickname,
-                            message=data['content'],
-                            color=self.color.hex,
-                            message_id=message_id,
-                        )
-                    )
-
-                    # Process commands
-                    if data['content'].strip().startswith('/'):
-                        self.process_command(data['content'])
             except DataReceptionException as e:
                 logger.critical(e)
                 logger.warning('Aborting connection to the client.')
@@ -0,0 +1,117 @@
+"""One keep-alive scheduler for every client of the threaded engine.
+
+Each handler thread used to wake from ``recv`` every half second, only to ask
+:mod:`server.resilience` whether its own client needed a PING or had gone stale:
+two wakeups per client per second, however quiet the server. Now handler threads
+block in ``recv`` until their client actually speaks, and a single thread keeps
+every client's next keep-alive deadline on a hashed timer wheel.
+
+The wheel is a ring of ``slots`` buckets, each ``tick`` seconds wide; a deadline
+further away than one turn of the ring waits out the extra turns in its bucket.
+Scheduling and firing are O(1), and the thread sleeps straight through empty
+buckets -- and entirely while nobody is connected -- so idle clients cost
+nothing between their deadlines. Traffic never touches the wheel: when a
+client's deadline comes round, :meth:`server.handler.Client.keep_alive` runs
+the same PING/stale checks as before and says when it is next due.
+"""
+
+import logging
+import math
+import threading
+import time
+from typing import Any, List, Optional
+
+from shared import constants
+
+logger = logging.getLogger('heartbeat')
+
+
+class HeartbeatScheduler:
+    """A hashed timer wheel of keep-alive deadlines, run by one daemon thread.
+
+    Anything scheduled needs a ``keep_alive()`` method returning the seconds until
+    it is next due, or None once it no longer needs checking.
+    """
+
+    def __init__(
+        self, tick: float = constants.HEARTBEAT_TICK, slots: int = constants.HEARTBEAT_SLOTS
+    ) -> None:
+        self.tick, self.slots = tick, slots
+        # Each bucket holds [turns still to wait, client] entries.
+        self._wheel: List[List[List[Any]]] = [[] for _ in range(slots)]
+        self._cursor = 0  # the bucket that fires next
+        self._next_tick = time.monotonic() + tick  # when it does
+        self._scheduled = 0
+        self._ready = threading.Condition()
+        self._stopped = False
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        with self._ready:
+            return self._scheduled
+
+    def start(self) -> 'HeartbeatScheduler':
+        self._thread = threading.Thread(target=self._run, name='heartbeat', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        with self._ready:
+            self._stopped = True
+            self._ready.notify_all()
+
+    def add(self, client: Any, delay: float) -> None:
+        """Run ``client.keep_alive()`` in ``delay`` seconds (rounded up to a tick)."""
+        with self._ready:
+            if self._scheduled == 0:
+                # The wheel stood still while empty; restart it from now.
+                self._next_tick = time.monotonic() + self.tick
+            # The first bucket to fire at or after the deadline, counted from the cursor.
+            ahead = max(0, math.ceil((time.monotonic() + delay - self._next_tick) / self.tick))
+            slot = (self._cursor + ahead) % self.slots
+            self._wheel[slot].append([ahead // self.slots, client])
+            self._scheduled += 1
+            self._ready.notify_all()
+
+    def _ticks_to_next(self) -> Optional[int]:
+        """Buckets to advance before the next non-empty one fires; None if all are empty."""
+        if self._scheduled == 0:
+            return None
+        for offset in range(self.slots):
+            if self._wheel[(self._cursor + offset) % self.slots]:
+                return offset
+        return None  # unreachable while _scheduled is accurate
+
+    def _advance(self) -> List[Any]:
+        """Wait for the next occupied bucket to come due and take what is due in it."""
+        with self._ready:
+            while not self._stopped:
+                skip = self._ticks_to_next()
+                if skip is None:
+                    self._ready.wait()
+                    continue
+                due_at = self._next_tick + skip * self.tick
+                remaining = due_at - time.monotonic()
+                if remaining > 0:
+                    self._ready.wait(remaining)
+                    continue  # woken early, or an earlier deadline may have arrived
+                self._cursor = (self._cursor + skip) % self.slots
+                self._next_tick = due_at + self.tick
+                bucket = self._wheel[self._cursor]
+                self._cursor = (self._cursor + 1) % self.slots
+                due = [client for turns, client in bucket if turns == 0]
+                bucket[:] = [[turns - 1, client] for turns, client in bucket if turns > 0]
+                self._scheduled -= len(due)
+                return due
+            return []
+
+    def _run(self) -> None:
+        while not self._stopped:
+            for client in self._advance():
+                try:
+                    delay = client.keep_alive()
+                except Exception as e:
+                    logger.warning(f'Keep-alive for {client!r} failed: {e}')
+                    continue
+                if delay is not None:
+                    self.add(client, delay)
@@ -0,0 +1,161 @@
+"""Each room's recent messages, kept in memory to answer history requests.
+
+Every client asks for the room's history as soon as it connects -- after a
+restart, all of them at once -- and each request used to be a query against the
+message table under the global database lock. A request reaches back at most
+thirty minutes and a hundred messages, so nearly all of them ask for messages the
+server has only just recorded. The server now keeps the newest ``capacity``
+messages of every room in a buffer, appended to as each message is recorded,
+and warmed from the database before the first client is accepted.
+
+A buffer is only trusted for what it is sure to hold. Each room remembers the
+newest timestamp among the messages it no longer has (evicted, or too old to be
+loaded when warming); a request reaching back that far goes to the database, as
+does every request before the buffers have been warmed.
+
+The encoded MESSAGE_HISTORY frame is cached too. Requests arriving together --
+a reconnect wave -- mostly ask for the same messages, so each room keeps the
+frames it has built, keyed by which of its messages they hold, until the next
+message arrives; a wave then costs one encode rather than one per client.
+
+Messages the retention pruner deletes are evicted from the buffers (and their
+frames dropped) as each batch goes, so history never offers what is gone.
+"""
+
+import bisect
+import collections
+import logging
+import threading
+from typing import Deque, Dict, List, Optional, Tuple
+
+from server import metrics
+from server import storage
+from shared import constants
+from shared import helpers
+
+logger = logging.getLogger('history')
+
+FRAMES_PER_ROOM = 16  # encoded frames a room keeps between messages
+
+
+class _Room:
+    """One room's buffered messages, in id order."""
+
+    __slots__ = ('rows', 'floor', 'frames')
+
+    def __init__(self, floor: float) -> None:
+        self.rows: Deque[storage.HistoryRow] = collections.deque()
+        self.floor = floor  # the newest timestamp of a message not in ``rows``
+        # Encoded frames by (first message id, message count); cleared as messages arrive.
+        self.frames: Dict[Tuple[Optional[int], int], bytes] = {}
+
+
+class RoomHistory:
+    """Bounded buffers of the recent messages in every room."""
+
+    def __init__(
+        self,
+        capacity: int = constants.HISTORY_BUFFER_SIZE,
+        counters: Optional[metrics.Counters] = None,
+    ) -> None:
+        self.capacity = max(1, capacity)
+        self.counters = counters if counters is not None else metrics.history_counters()
+        self._lock = threading.Lock()
+        self._rooms: Dict[str, _Room] = {}
+        self._warm = False
+
+    def warm(self, database: storage.Storage) -> int:
+        """Load each room's newest messages from ``database``; returns how many were loaded.
+
+        Call it before any client can send a message, so nothing recorded since is missed.
+        """
+        rooms: Dict[str, _Room] = {}
+        loaded = 0
+        for room, rows in database.latest_messages(self.capacity + 1).items():
+            # One message more than fits says whether the room has older ones.
+            buffer = rooms[room] = _Room(rows[0][4] if len(rows) > self.capacity else -1)
+            buffer.rows.extend(rows[-self.capacity :])
+            loaded += len(buffer.rows)
+        with self._lock:
+            self._rooms = rooms
+            self._warm = True
+        logger.info(f'Loaded {loaded} recent message(s) across {len(rooms)} room(s).')
+        return loaded
+
+    def record(self, room: str, row: storage.HistoryRow) -> None:
+        """Remember a message just recorded in ``room``."""
+        with self._lock:
+            buffer = self._rooms.get(room)
+            if buffer is None:
+                # A room with nothing in the database yet: the buffer has all of it.
+                buffer = self._rooms[room] = _Room(-1)
+            buffer.frames.clear()
+            rows = buffer.rows
+            if not rows or rows[-1][0] < row[0]:
+                rows.append(row)
+            else:
+                # Recorded by another thread just after this one committed first.
+                rows.insert(bisect.bisect([r[0] for r in rows], row[0]), row)
+            while len(rows) > self.capacity:
+                buffer.floor = max(buffer.floor, rows.popleft()[4])
+
+    def evict(self, room: str, cutoff: Tuple[int, int]) -> int:
+        """Forget ``room``'s messages at or below the (timestamp, id) ``cutoff``, as the
+        retention pruner deletes them; returns how many were buffered."""
+        timestamp, message_id = cutoff
+        with self._lock:
+            buffer = self._rooms.get(room)
+            if buffer is None:
+                return 0
+            kept = [
+                row
+                for row in buffer.rows
+                if row[4] > timestamp or (row[4] == timestamp and row[0] > message_id)
+            ]
+            evicted = len(buffer.rows) - len(kept)
+            # Requests reaching back to the cutoff go to the database, which knows
+            # how far the deletes have got.
+            buffer.floor = max(buffer.floor, timestamp)
+            if evicted:
+                buffer.rows = collections.deque(kept)
+                buffer.frames.clear()
+            return evicted
+
+    def recent(self, room: str, since: int, limit: int) -> Optional[List[storage.HistoryRow]]:
+        """The first ``limit`` messages of ``room`` sent at or after ``since``, oldest first,
+        as ServerDatabase.recent_messages would return them; None if the buffer may be
+        missing some of them."""
+        with self._lock:
+            return self._select(room, since, limit)
+
+    def encoded(self, room: str, since: int, limit: int) -> Optional[bytes]:
+        """The MESSAGE_HISTORY frame for :meth:`recent`'s messages, built at most once
+        per room between messages; None if the buffer may be missing some of them."""
+        with self._lock:
+            rows = self._select(room, since, limit)
+            if rows is None:
+                return None
+            buffer = self._rooms.get(room)
+            if buffer is None:
+                # Nothing said here yet; not worth a buffer of its own.
+                return helpers.prepare_message_history(rows)
+            key = (rows[0][0] if rows else None, len(rows))
+            frame = buffer.frames.get(key)
+            if frame is None:
+                self.counters.incr('encodes')
+                frame = helpers.prepare_message_history(rows)
+                if len(buffer.frames) >= FRAMES_PER_ROOM:
+                    del buffer.frames[next(iter(buffer.frames))]
+                buffer.frames[key] = frame
+            return frame
+
+    def _select(self, room: str, since: int, limit: int) -> Optional[List[storage.HistoryRow]]:
+        """What :meth:`recent` returns. Hold the lock."""
+        buffer = self._rooms.get(room)
+        if not self._warm or (buffer is not None and since <= buffer.floor):
+            self.counters.incr('misses')
+            return None
+        self.counters.incr('hits')
+        rows = [row for row in buffer.rows if row[4] >= since] if buffer else []
+        rows.sort(key=lambda row: row[4])
+        return rows[:limit]
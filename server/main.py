@@ -1,10 +1,21 @@
 import logging
+import selectors
 import socket
 import sys
 import threading
-from typing import List
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, cast
 
+from server import db
 from server import handler
+from server import heartbeat
+from server import metrics
+from server import outbox
+from server import search
+from server import storage
+from server.registry import ConnectionRegistry
+from server.retention import Retention, start_pruner
 from shared import constants
 from shared import handshake
 from shared import protocol
@@ -21,9 +32,39 @@ def _close(sock: socket.socket) -> None:
 
 
 def serve(
-    host: str = constants.DEFAULT_IP, port: int = constants.DEFAULT_PORT, use_tls: bool = False
+    host: str = constants.DEFAULT_IP,
+    port: int = constants.DEFAULT_PORT,
+    use_tls: bool = False,
+    max_handshakes: int = constants.MAX_HANDSHAKES,
+    handshakes: Optional[metrics.Counters] = None,
+    send_queue: Optional[outbox.QueuePolicy] = None,
+    presence_window: float = constants.PRESENCE_WINDOW,
+    max_pending: int = constants.MAX_PENDING_HANDSHAKES,
+    durability: str = constants.DURABILITY,
+    retention: Optional[Retention] = None,
+    backend: str = constants.STORAGE_BACKEND,
+    compression: bool = constants.COMPRESSION,
 ) -> None:
-    """Bind to host/port and accept clients until interrupted."""
+    """Bind to host/port and accept clients until interrupted.
+
+    The accept loop never negotiates. Each new socket waits in a selector until
+    its first bytes arrive, and only then goes to a pool of at most
+    ``max_handshakes`` workers that negotiate and set the client up, so peers
+    that are slow to send their HELLO occupy no worker and can't hold up anyone
+    else's connection. Every socket's handshake deadline runs from the moment it
+    was accepted; at most ``max_pending`` may be waiting at once, and any more are
+    closed on arrival so the client retries later.
+    ``handshakes`` (created when not given) counts how those negotiations end.
+    ``send_queue`` bounds each client's outbound queue and says what to do when a
+    slow reader fills it. Roster changes within ``presence_window`` seconds of
+    each other reach a room as one update. ``durability`` says whether a message
+    waits for its commit before it is delivered (see server.db.MessageWriter), and
+    messages older or more numerous than ``retention`` allows are pruned. Messages
+    are kept by the storage ``backend`` (see server.storage); only sqlite prunes.
+    Clients that ask for a compressed connection get one if ``compression`` allows it.
+    """
+    send_queue = outbox.check_policy(send_queue or outbox.QueuePolicy())
+    durability = db.check_durability(durability)
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(
         socket.SOL_SOCKET, socket.SO_REUSEADDR, 1
@@ -32,22 +73,29 @@ def serve(
     server.listen(1)
     server.settimeout(0.5)
 
-    clients: List[handler.BaseClient] = []
+    # Create or migrate the schema once, then load each room's recent history,
+    # before any client can connect and add to it.
+    storage.prepare(backend, durability)
+    clients = ConnectionRegistry(presence_window)
+    clients.history.warm(storage.open_store())
+    pruner = start_pruner(retention, backend, clients.history)
+    heartbeats = heartbeat.HeartbeatScheduler().start()
     stop_flag: bool = False
-    try:
-        logger.info(f'Waiting for connections on {host}:{port}...')
-        while True:
-            try:
-                conn, address = server.accept()
-            except socket.timeout:
-                continue
+    if handshakes is None:
+        handshakes = metrics.handshake_counters()
+    counters = handshakes
+    pool = ThreadPoolExecutor(max_workers=max(1, max_handshakes), thread_name_prefix='handshake')
 
-            # A single client's setup failing (e.g. a TLS/plaintext mismatch) must not
-            # take down the whole server, so isolate it from the accept loop.
-            client = None
+    def onboard(conn: socket.socket, address: Any, deadline: float) -> None:
+        """Negotiate with one accepted socket and, if it is a real client, start it."""
+        # A single client's setup failing (e.g. a TLS/plaintext mismatch) must not
+        # take down the whole server, so isolate it from the rest of the pool.
+        client = None
+        try:
+            # Negotiate version and TLS in cleartext before anything else; a
+            # mismatch is answered with a stated rejection, not a silent drop.
+            counters.incr('in_flight')
             try:
-                # Negotiate version and TLS in cleartext before anything else; a
-                # mismatch is answered with a stated rejection, not a silent drop.
                 negotiation = handshake.negotiate_server(
                     conn,
                     require_tls=use_tls,
@@ -55,51 +103,125 @@ def serve(
                     version=protocol.PROTOCOL_VERSION,
                     certfile=constants.TLS_CERT,
                     keyfile=constants.TLS_KEY,
+                    features=handler.FEATURES,
+                    deadline=deadline,
+                    supports_compression=compression,
                 )
+            finally:
+                counters.incr('in_flight', -1)
+
+            # A reachability probe just wants the handshake answered; close it
+            # cleanly without building a client, so the common Test Connection
+            # workflow doesn't look like an error in the logs.
+            if negotiation.probe:
+                logger.debug(
+                    'Test connection from %s: %s',
+                    address,
+                    'reachable' if negotiation.ok else negotiation.reason,
+                )
+                counters.incr('completed' if negotiation.ok else 'refused')
+                _close(negotiation.sock or conn)
+                return
+
+            if negotiation.timed_out:
+                timed_out = counters.incr('timed_out')
+                logger.info(f'Handshake from {address} timed out ({timed_out} so far)')
+                _close(conn)
+                return
+
+            # A stated mismatch is an expected, handled outcome, not a fault.
+            if not negotiation.ok:
+                counters.incr('refused')
+                logger.info(f'Refused connection from {address}: {negotiation.reason}')
+                _close(conn)
+                return
+            counters.incr('completed')
+            assert negotiation.sock is not None  # ok implies a usable socket
+            conn = negotiation.sock
+            logger.info(f"New connection from {address}")
 
-                # A reachability probe just wants the handshake answered; close it
-                # cleanly without building a client, so the common Test Connection
-                # workflow doesn't look like an error in the logs.
-                if negotiation.probe:
-                    logger.debug(
-                        'Test connection from %s: %s',
-                        address,
-                        'reachable' if negotiation.ok else negotiation.reason,
-                    )
-                    _close(negotiation.sock or conn)
-                    continue
-
-                # A stated mismatch is an expected, handled outcome, not a fault.
-                if not negotiation.ok:
-                    logger.info(f'Refused connection from {address}: {negotiation.reason}')
-                    _close(conn)
-                    continue
-                assert negotiation.sock is not None  # ok implies a usable socket
-                conn = negotiation.sock
-                logger.info(f"New connection from {address}")
-
-                client = handler.Client(conn, address, clients, lambda: stop_flag)
-                clients.append(client)
-                client.request_nickname()
-
-                # Inform the new client's room of the arrival
-                logger.debug('Informing the room of the incoming connection.')
-                client.notify_room(client.room)
-
-                # Start Handling Thread For Client
-                thread = threading.Thread(target=client.handle, name=client.id[:8])
-                thread.start()
-            except Exception as e:
-                logger.warning(f'Dropping connection from {address}: {e}')
-                # Don't leave a half-set-up client in the list; a closed socket there
-                # would break every later broadcast with a bad file descriptor.
-                if client is not None:
-                    client.discard()
+            client = handler.Client(
+                conn,
+                address,
+                clients,
+                lambda: stop_flag,
+                send_queue,
+                negotiation.features,
+                negotiation.version,
+                negotiation.serializer,
+                negotiation.compressed,
+            )
+            clients.add(client)
+            client.request_nickname()
+
+            # Inform the new client's room of the arrival
+            logger.debug('Informing the room of the incoming connection.')
+            client.announce_join(client.room)
+
+            # Start Handling Thread For Client
+            thread = threading.Thread(target=client.handle, name=client.id[:8])
+            thread.start()
+            heartbeats.add(client, client.next_keep_alive())
+        except Exception as e:
+            counters.incr('failed')
+            logger.warning(f'Dropping connection from {address}: {e}')
+            # Don't leave a half-set-up client registered; a closed socket there
+            # would break every later broadcast with a bad file descriptor.
+            if client is not None:
+                client.discard()
+            else:
+                _close(conn)
+
+    # Accepted sockets wait here, keyed to (address, deadline), until they speak.
+    waiting = selectors.DefaultSelector()
+    waiting.register(server, selectors.EVENT_READ)
+
+    def accept() -> None:
+        try:
+            conn, address = server.accept()
+        except (socket.timeout, BlockingIOError):
+            return
+        if len(waiting.get_map()) - 1 >= max_pending:
+            shed = counters.incr('shed')
+            logger.warning(f'Shedding connection from {address}: too many pending ({shed} so far)')
+            _close(conn)
+            return
+        deadline = time.monotonic() + handshake.HANDSHAKE_TIMEOUT
+        waiting.register(conn, selectors.EVENT_READ, (address, deadline))
+
+    def expire() -> None:
+        now = time.monotonic()
+        for key in list(waiting.get_map().values()):
+            if key.data is not None and key.data[1] <= now:
+                waiting.unregister(key.fileobj)
+                timed_out = counters.incr('timed_out')
+                logger.info(f'Handshake from {key.data[0]} timed out ({timed_out} so far)')
+                _close(key.fileobj)  # type: ignore[arg-type]
+
+    try:
+        logger.info(f'Waiting for connections on {host}:{port}...')
+        while True:
+            for key, _ in waiting.select(timeout=0.5):
+                if key.fileobj is server:
+                    accept()
                 else:
-                    _close(conn)
+                    waiting.unregister(key.fileobj)
+                    address, deadline = key.data
+                    conn = cast(socket.socket, key.fileobj)
+                    pool.submit(onboard, conn, address, deadline)
+            expire()
     except KeyboardInterrupt:
         logger.info('User stopped server manually. Enabling stop flag.')
         stop_flag = True
+        heartbeats.stop()
+        if pruner is not None:
+            pruner.stop()
+        # Handler threads block in recv; wake each so it sees the stop flag.
+        for client in clients:
+            client.wake()
+        search.close_searches()
+        storage.close_all()
+        pool.shutdown(wait=False, cancel_futures=True)
         sys.exit()
 
 
@@ -0,0 +1,60 @@
+"""Small thread-safe counters the server keeps about its own behaviour.
+
+Nothing here exports anywhere; the counters exist so the server can log them
+and tests can assert on them without reaching into private state.
+"""
+
+import threading
+from typing import Dict
+
+
+class Counters:
+    """A fixed set of named integer counters, safe to bump from any thread."""
+
+    def __init__(self, *names: str) -> None:
+        self._lock = threading.Lock()
+        self._values: Dict[str, int] = dict.fromkeys(names, 0)
+
+    def incr(self, name: str, amount: int = 1) -> int:
+        """Add ``amount`` (which may be negative) to a counter and return its new value."""
+        with self._lock:
+            self._values[name] += amount
+            return self._values[name]
+
+    def __getitem__(self, name: str) -> int:
+        with self._lock:
+            return self._values[name]
+
+    def snapshot(self) -> Dict[str, int]:
+        """Every counter's current value, read together."""
+        with self._lock:
+            return dict(self._values)
+
+    def __repr__(self) -> str:
+        values = ', '.join(f'{name}={value}' for name, value in self.snapshot().items())
+        return f'Counters({values})'
+
+
+def handshake_counters() -> Counters:
+    """Counters for the handshake stage: in flight now, and how each one ended.
+
+    ``shed`` counts connections closed on arrival because too many were already
+    waiting to send their HELLO.
+    """
+    return Counters('in_flight', 'completed', 'refused', 'failed', 'timed_out', 'shed')
+
+
+def presence_counters() -> Counters:
+    """Counters for roster updates: changes seen, and the updates sent and saved."""
+    return Counters('changes', 'flushes', 'updates_sent', 'updates_saved')
+
+
+def history_counters() -> Counters:
+    """Counters for history requests: answered from memory or left to the database,
+    and how many history frames had to be encoded for the ones answered from memory."""
+    return Counters('hits', 'misses', 'encodes')
+
+
+def retention_counters() -> Counters:
+    """Counters for pruning: passes made, messages deleted and database pages given back."""
+    return Counters('passes', 'deleted', 'pages_freed')
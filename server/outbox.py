@@ -0,0 +1,291 @@
+"""Per-client outbound queues, so a slow recipient only ever slows itself down.
+
+Broadcasting used to write to every member's socket on the sender's own handler
+thread, so one peer with a full receive window held up everything that sender
+relayed. Instead each client owns an :class:`Outbox`: a bounded queue that
+broadcasts only append to, drained by that client's own writer thread. What
+happens when a recipient falls so far behind that its queue fills is a policy:
+
+``drop-oldest``
+    Discard the oldest queued frame to make room; the client misses a little.
+    Frames queued as not droppable (roster updates, which the client's copy of
+    the room depends on) are passed over; if nothing older may go, the new
+    frame is the one discarded, or queued past the limit if it may not be.
+``disconnect``
+    Give up on the client, as though its socket had failed.
+``block``
+    Wait up to a deadline for room, then give up as ``disconnect`` does.
+
+The asyncio engine applies the same policies through :class:`AsyncOutbox`, whose
+frames are drained by a task on the loop instead of a thread.
+
+A writer takes every frame that has queued up since its last write, up to
+``constants.SEND_BATCH_FRAMES``, and sends them together: one ``sendmsg`` for
+the threaded engine's :class:`protocol.FrameWriter`, one ``writelines`` for
+the asyncio transport. A system message followed by a USER_LIST then costs one
+syscall rather than two.
+
+A compressed connection's frames go through its :class:`protocol.Compressor` as
+they are written, not as they are queued: the zlib stream has to see exactly
+the frames the client does, and ``drop-oldest`` may discard a queued one.
+"""
+
+import asyncio
+import collections
+import logging
+import socket
+import threading
+import time
+from typing import Callable, Deque, List, NamedTuple, Optional, Tuple
+
+from shared import constants
+from shared import protocol
+
+logger = logging.getLogger('outbox')
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+BLOCK = 'block'
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+
+class QueuePolicy(NamedTuple):
+    size: int = constants.SEND_QUEUE_SIZE  # frames held before the policy kicks in
+    on_full: str = constants.SEND_QUEUE_POLICY  # one of POLICIES
+    deadline: float = constants.SEND_BLOCK_DEADLINE  # seconds 'block' waits for room
+
+
+def check_policy(policy: QueuePolicy) -> QueuePolicy:
+    """Return ``policy`` if it is usable, else raise ValueError saying why.
+
+    Servers call this once at startup, so a bad setting stops them there instead
+    of failing every connection later.
+    """
+    if policy.on_full not in POLICIES:
+        raise ValueError(
+            f'unknown send queue policy {policy.on_full!r} (expected one of {", ".join(POLICIES)})'
+        )
+    if policy.size < 1:
+        raise ValueError(f'send queue size must be at least 1, not {policy.size}')
+    if policy.deadline < 0:
+        raise ValueError(f'send block deadline must not be negative, not {policy.deadline}')
+    return policy
+
+
+# A queued frame, and whether drop-oldest may discard it.
+Queued = Tuple[bytes, bool]
+
+
+class OutboxFull(ConnectionError):
+    """A recipient fell too far behind and is being dropped.
+
+    A ConnectionError, so anything that already prunes an unreachable client on
+    OSError treats an overflowing one the same way.
+    """
+
+
+class Outbox:
+    """A bounded frame queue for one connection, drained by a daemon writer thread.
+
+    ``on_error`` is called (from the writer thread) if a write fails, so the owner
+    can drop the client; it is not called for a close the owner asked for.
+    """
+
+    def __init__(
+        self,
+        conn: socket.socket,
+        policy: QueuePolicy = QueuePolicy(),
+        on_error: Optional[Callable[[OSError], None]] = None,
+        name: str = 'outbox',
+        compressor: Optional[protocol.Compressor] = None,
+    ) -> None:
+        check_policy(policy)
+        self.conn, self.policy, self.on_error = conn, policy, on_error
+        self.compressor = compressor
+        self.writer = protocol.FrameWriter(conn)
+        self.dropped = 0  # frames discarded under the drop-oldest policy
+        self._frames: Deque[Queued] = collections.deque()
+        self._ready = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._drain, name=f'{name}-writer', daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        with self._ready:
+            return len(self._frames)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, frame: bytes, droppable: bool = True) -> None:
+        """Queue a frame for sending, applying the full-queue policy if needed.
+
+        Raises OutboxFull when the policy gives up on the client, and
+        ConnectionResetError once the outbox has been closed.
+        """
+        with self._ready:
+            if self._closed:
+                raise ConnectionResetError('the connection is closed')
+            if len(self._frames) >= self.policy.size:
+                if self.policy.on_full == DROP_OLDEST:
+                    if _drop_oldest(self._frames):
+                        self.dropped += 1
+                        logger.debug(f'{self._thread.name} full; dropped its oldest frame.')
+                    elif droppable:
+                        self.dropped += 1  # nothing older may go, so this one does
+                        return
+                elif self.policy.on_full == DISCONNECT:
+                    raise OutboxFull(f'send queue full ({self.policy.size} frames)')
+                else:
+                    end = time.monotonic() + self.policy.deadline
+                    while len(self._frames) >= self.policy.size and not self._closed:
+                        remaining = end - time.monotonic()
+                        if remaining <= 0:
+                            raise OutboxFull(f'send queue stayed full for {self.policy.deadline}s')
+                        self._ready.wait(remaining)
+                    if self._closed:
+                        raise ConnectionResetError('the connection is closed')
+            self._frames.append((frame, droppable))
+            self._ready.notify_all()
+
+    def close(self) -> None:
+        """Stop the writer, discarding anything still queued."""
+        with self._ready:
+            self._closed = True
+            self._frames.clear()
+            self._ready.notify_all()
+
+    def _next(self) -> Optional[List[bytes]]:
+        """Block until frames are queued (taking a batch of them) or the outbox closes (None)."""
+        with self._ready:
+            while not self._frames and not self._closed:
+                self._ready.wait()
+            if self._closed:
+                return None
+            batch = _take(self._frames)
+            self._ready.notify_all()  # room for a blocked put()
+            return batch
+
+    def _drain(self) -> None:
+        while True:
+            batch = self._next()
+            if batch is None:
+                return
+            if self.compressor is not None:
+                batch = [self.compressor.compress(frame) for frame in batch]
+            try:
+                # A send timeout, if the socket has one, only means the peer is
+                # reading slowly, so keep going rather than treat it as dead.
+                self.writer.write(batch, keep_trying=lambda: not self._closed)
+            except OSError as e:
+                if self._closed:
+                    return  # the owner closed the socket under us on purpose
+                self.close()
+                if self.on_error is not None:
+                    self.on_error(e)
+                return
+
+
+class AsyncOutbox:
+    """The asyncio engine's :class:`Outbox`: a bounded frame queue drained by a task.
+
+    ``put`` runs on the event loop and so can never wait; under the ``block``
+    policy a full queue is allowed to overrun only until it has stayed full for
+    the deadline, after which the client is given up on as with ``disconnect``.
+    """
+
+    def __init__(
+        self,
+        writer: asyncio.StreamWriter,
+        policy: QueuePolicy = QueuePolicy(),
+        on_error: Optional[Callable[[OSError], None]] = None,
+        name: str = 'outbox',
+        compressor: Optional[protocol.Compressor] = None,
+    ) -> None:
+        check_policy(policy)
+        self.writer, self.policy, self.on_error = writer, policy, on_error
+        self.compressor = compressor
+        self.dropped = 0  # frames discarded under the drop-oldest policy
+        self._frames: Deque[Queued] = collections.deque()
+        self._ready = asyncio.Event()
+        self._full_since: Optional[float] = None
+        self._closed = False
+        self._task = asyncio.get_running_loop().create_task(self._drain(), name=f'{name}-writer')
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def put(self, frame: bytes, droppable: bool = True) -> None:
+        """Queue a frame for sending, applying the full-queue policy if needed.
+
+        Raises OutboxFull when the policy gives up on the client, and
+        ConnectionResetError once the outbox has been closed.
+        """
+        if self._closed:
+            raise ConnectionResetError('the connection is closed')
+        if len(self._frames) >= self.policy.size:
+            if self.policy.on_full == DROP_OLDEST:
+                if _drop_oldest(self._frames):
+                    self.dropped += 1
+                    logger.debug(f'{self._task.get_name()} full; dropped its oldest frame.')
+                elif droppable:
+                    self.dropped += 1  # nothing older may go, so this one does
+                    return
+            elif self.policy.on_full == DISCONNECT:
+                raise OutboxFull(f'send queue full ({self.policy.size} frames)')
+            else:
+                now = time.monotonic()
+                if self._full_since is None:
+                    self._full_since = now
+                elif now - self._full_since >= self.policy.deadline:
+                    raise OutboxFull(f'send queue stayed full for {self.policy.deadline}s')
+        self._frames.append((frame, droppable))
+        self._ready.set()
+
+    def close(self) -> None:
+        """Stop the writer task, discarding anything still queued."""
+        self._closed = True
+        self._frames.clear()
+        self._ready.set()
+
+    async def _drain(self) -> None:
+        while True:
+            while not self._frames and not self._closed:
+                self._ready.clear()
+                await self._ready.wait()
+            if self._closed:
+                return
+            batch = _take(self._frames)
+            if len(self._frames) < self.policy.size:
+                self._full_since = None
+            if self.compressor is not None:
+                batch = [self.compressor.compress(frame) for frame in batch]
+            try:
+                self.writer.writelines(batch)
+                await self.writer.drain()
+            except OSError as e:
+                if self._closed:
+                    return
+                self.close()
+                if self.on_error is not None:
+                    self.on_error(e)
+                return
+
+
+def _take(frames: Deque[Queued]) -> List[bytes]:
+    """Pop the frames a writer sends together: those queued, up to SEND_BATCH_FRAMES."""
+    return [frames.popleft()[0] for _ in range(min(len(frames), constants.SEND_BATCH_FRAMES))]
+
+
+def _drop_oldest(frames: Deque[Queued]) -> bool:
+    """Discard the oldest droppable frame queued; False if every one must be kept."""
+    for index, (_, droppable) in enumerate(frames):
+        if droppable:
+            del frames[index]
+            return True
+    return False
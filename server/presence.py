@@ -0,0 +1,283 @@
+"""Coalescing of room roster updates, so a burst of arrivals costs one update each.
+
+Every join, leave and rename used to send each member of the room an update on
+the spot. When a restarted server is met by every client reconnecting at once,
+that is one update per member per arrival -- quadratic in the size of the room.
+Instead each change is recorded against its room, and the first one opens a short
+window; when it closes, the net effect of everything in it is delivered:
+
+* a member that negotiated presence deltas gets one delta per net change --
+  USER_JOINED, USER_LEFT or USER_RENAMED -- queued together, so its writer
+  sends them in a single write;
+* everyone else -- older clients, and anyone who arrived during the window --
+  gets the room's full list, once.
+
+Roster frames are queued as not droppable: a client whose queue overflows under
+the ``drop-oldest`` policy loses chat frames, never a change to its roster.
+
+The server's "X joined!" and "X left!" notices go through the same window: the
+ones a room collects are written to the history and sent as a single notice, so a
+stampede costs one database write per window rather than one per arrival. The
+write is only submitted to the store's writer, and the notice sent once it has
+its id, through ``when_done``: under asyncio that is a callback on the loop, so
+a commit (an fsync, under ``durability = "sync"``) never stalls the loop.
+
+A window of zero delivers every change immediately, exactly as before.
+"""
+
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from server import metrics
+from server import storage
+from server.history import RoomHistory
+from server.rooms import RoomRegistry
+from shared import constants
+from shared import helpers
+
+logger = logging.getLogger('presence')
+
+JOINED, LEFT, RENAMED = 'joined', 'left', 'renamed'
+
+# Runs a callback after a delay: threading.Timer by default, loop.call_later under asyncio.
+Scheduler = Callable[[float, Callable[[], None]], Any]
+
+# Submits a server notice for recording: (room, message, timestamp) -> future message id.
+Persist = Callable[[str, str, int], 'Future[int]']
+
+# Calls back with a Persist future once it resolves: on the event loop under asyncio.
+WhenDone = Callable[['Future[int]', Callable[['Future[int]'], None]], None]
+
+
+def _start_timer(delay: float, callback: Callable[[], None]) -> threading.Timer:
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+def record_notice(room: str, message: str, timestamp: int) -> 'Future[int]':
+    """Submit a notice to the message store's shared writer, without waiting for it."""
+    return storage.open_store().submit_message(
+        'Server', 'server', constants.Colors.BLACK.hex, message, timestamp, room
+    )
+
+
+def _wait_then(future: 'Future[int]', callback: Callable[['Future[int]'], None]) -> None:
+    """Wait for ``future`` on this thread (a timer's, for the threaded engine), then call back."""
+    future.exception()
+    callback(future)
+
+
+def describe(verb: str, nicknames: List[str], shown: int = 3) -> str:
+    """Phrase one notice for several people, e.g. 'ann, bo and 4 others joined!'."""
+    if len(nicknames) == 1:
+        return f'{nicknames[0]} {verb}!'
+    if len(nicknames) <= shown:
+        return f'{", ".join(nicknames[:-1])} and {nicknames[-1]} {verb}!'
+    return f'{", ".join(nicknames[:shown - 1])} and {len(nicknames) - shown + 1} others {verb}!'
+
+
+class _Change:
+    """What one client did to a room's roster during the current window."""
+
+    __slots__ = ('client', 'was_present', 'renamed')
+
+    def __init__(self, client: Any, was_present: bool) -> None:
+        self.client = client
+        self.was_present = was_present  # in the room when the window opened
+        self.renamed = False
+
+
+class _Pending:
+    """Everything recorded against one room since its window opened."""
+
+    __slots__ = ('changes', 'notices', 'naive')
+
+    def __init__(self) -> None:
+        self.changes: Dict[str, _Change] = {}  # by client id, in first-seen order
+        self.notices: List[Tuple[str, str]] = []  # (verb, nickname), in arrival order
+        self.naive = 0  # frames sending each change on its own would have cost
+
+
+class PresenceDebouncer:
+    """Collects roster changes per room and delivers each room's net change at once."""
+
+    def __init__(
+        self,
+        rooms: RoomRegistry,
+        window: float = 0.0,
+        counters: Optional[metrics.Counters] = None,
+        schedule: Optional[Scheduler] = None,
+        persist: Optional[Persist] = None,
+        history: Optional[RoomHistory] = None,
+        when_done: Optional[WhenDone] = None,
+    ) -> None:
+        self.rooms = rooms
+        self.window = window
+        self.counters = counters if counters is not None else metrics.presence_counters()
+        self.history = history  # where recorded notices are remembered, if anywhere
+        self._schedule = schedule or _start_timer
+        self._persist = persist or record_notice
+        self._when_done = when_done or _wait_then
+        self._lock = threading.Lock()
+        self._pending: Dict[str, _Pending] = {}
+
+    def joined(self, client: Any, room: str) -> None:
+        """Record that ``client`` has entered ``room``."""
+        self._record(client, room, JOINED)
+
+    def left(self, client: Any, room: str) -> None:
+        """Record that ``client`` has left ``room``."""
+        self._record(client, room, LEFT)
+
+    def renamed(self, client: Any, room: str) -> None:
+        """Record that ``client``, still in ``room``, has a new nickname."""
+        self._record(client, room, RENAMED)
+
+    def notice(self, client: Any, room: str, verb: str) -> None:
+        """Tell ``room`` that ``client`` has ``verb`` (e.g. 'joined'), as the Server.
+
+        With no window the client says it itself, right away; otherwise the notice
+        waits to be merged with the rest of the room's window.
+        """
+        if self.window <= 0:
+            client.broadcast_message(f'{client.nickname} {verb}!')
+            return
+        with self._lock:
+            pending, opened = self._open(room)
+            pending.notices.append((verb, client.nickname))
+        if opened:
+            self._schedule(self.window, lambda: self.flush(room))
+
+    def _open(self, room: str) -> Tuple[_Pending, bool]:
+        """The room's pending window, and whether this call opened it. Hold the lock."""
+        pending = self._pending.get(room)
+        if pending is None:
+            pending = self._pending[room] = _Pending()
+            return pending, True
+        return pending, False
+
+    def _record(self, client: Any, room: str, kind: str) -> None:
+        self.counters.incr('changes')
+        with self._lock:
+            pending, opened = self._open(room)
+            change = pending.changes.get(client.id)
+            if change is None:
+                change = pending.changes[client.id] = _Change(client, kind != JOINED)
+            if kind == RENAMED:
+                change.renamed = True
+            # Announced on its own, this change would reach everyone in the room now.
+            pending.naive += len(self.rooms.members(room))
+
+        if self.window <= 0:
+            self.flush(room)
+        elif opened:
+            self._schedule(self.window, lambda: self.flush(room))
+
+    def flush(self, room: str) -> None:
+        """Deliver whatever has been recorded against ``room`` (a no-op if nothing has)."""
+        with self._lock:
+            pending = self._pending.pop(room, None)
+        if pending is None:
+            return
+
+        members = self.rooms.members(room)
+        self._send_notices(room, members, pending.notices)
+        present = {member.id for member in members}
+        deltas: List[bytes] = []
+        arrived = set()
+        for client_id, change in pending.changes.items():
+            now_present = client_id in present
+            if change.was_present and not now_present:
+                deltas.append(helpers.prepare_user_left(client_id))
+            elif now_present and not change.was_present:
+                deltas.append(helpers.prepare_user_joined(change.client.user_entry()))
+                arrived.add(client_id)
+            elif now_present and change.renamed:
+                deltas.append(helpers.prepare_user_renamed(client_id, change.client.nickname))
+
+        sent = 0
+        if deltas:
+            full: Optional[bytes] = None
+            for member in members:
+                if member.id not in arrived and constants.Features.PRESENCE in member.features:
+                    frames = deltas
+                else:
+                    if full is None:
+                        full = helpers.prepare_user_list([m.user_entry() for m in members])
+                    frames = [full]
+                for frame in frames:
+                    if not self._deliver(member, frame, droppable=False):
+                        break
+                    sent += 1
+
+        saved = max(0, pending.naive - sent)
+        self.counters.incr('flushes')
+        self.counters.incr('updates_sent', sent)
+        self.counters.incr('updates_saved', saved)
+        if saved:
+            logger.debug(
+                f'Coalesced {len(pending.changes)} roster change(s) in {room}: '
+                f'sent {sent} update(s), saved {saved}.'
+            )
+
+    def _send_notices(
+        self, room: str, members: Tuple[Any, ...], notices: List[Tuple[str, str]]
+    ) -> None:
+        """Record and send one Server message per verb for the notices a window collected.
+
+        Each is sent once the store has given it an id, through ``when_done``.
+        """
+        by_verb: Dict[str, List[str]] = {}
+        for verb, nickname in notices:
+            by_verb.setdefault(verb, []).append(nickname)
+        for verb, nicknames in by_verb.items():
+            message = describe(verb, nicknames)
+            timestamp = int(time.time())
+            self._when_done(
+                self._persist(room, message, timestamp),
+                functools.partial(self._announce, room, members, message, timestamp),
+            )
+
+    def _announce(
+        self,
+        room: str,
+        members: Tuple[Any, ...],
+        message: str,
+        timestamp: int,
+        written: 'Future[int]',
+    ) -> None:
+        """Remember a recorded notice in the room's history and send it to ``members``."""
+        if written.exception() is not None:
+            logger.error(f'Could not record a presence notice: {written.exception()}')
+            return
+        message_id = written.result()
+        if self.history is not None:
+            self.history.record(
+                room, (message_id, 'Server', constants.Colors.BLACK.hex, message, timestamp)
+            )
+        frame = helpers.prepare_message(
+            nickname='Server',
+            message=message,
+            color=constants.Colors.BLACK.hex,
+            message_id=message_id,
+            timestamp=timestamp,
+        )
+        for member in members:
+            self._deliver(member, frame)
+
+    @staticmethod
+    def _deliver(member: Any, frame: bytes, droppable: bool = True) -> bool:
+        """Send one frame, pruning a member that can no longer be reached."""
+        try:
+            member.send(frame, droppable=droppable)
+        except OSError as e:
+            logger.warning(f'Pruning unreachable client {member!r}: {e}')
+            member.discard()
+            return False
+        return True
@@ -0,0 +1,122 @@
+"""The server's registry of connected clients.
+
+Replaces a plain shared list that was appended to by the accept path, removed
+from by whichever thread noticed a disconnect, and copied by every broadcast.
+Clients are indexed by id (so adding and removing one is O(1)) and by nickname,
+and the registry carries the :class:`server.rooms.RoomRegistry` that indexes
+them by room, so one object answers every "who is connected" question. It also
+carries the :class:`server.presence.PresenceDebouncer` that tells each room about
+changes to who is in it, and the :class:`server.history.RoomHistory` that
+remembers what was recently said there.
+
+Iterating the registry walks an immutable snapshot, rebuilt lazily after the
+membership changes, so a reader never holds the lock or sees a half-applied
+update, and repeated iteration between changes never copies.
+"""
+
+import threading
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+from server import metrics
+from server import presence
+from server.history import RoomHistory
+from server.presence import Persist, PresenceDebouncer, Scheduler, WhenDone
+from server.rooms import RoomRegistry
+
+
+class ConnectionRegistry:
+    """Thread-safe index of connected clients by id, by nickname and by room."""
+
+    def __init__(
+        self,
+        presence_window: float = 0.0,
+        presence_counters: Optional[metrics.Counters] = None,
+        schedule: Optional[Scheduler] = None,
+        persist: Optional[Persist] = None,
+        history: Optional[RoomHistory] = None,
+        when_done: Optional[WhenDone] = None,
+    ) -> None:
+        """``presence_window`` is how long roster changes are coalesced per room
+        (0 announces each at once); ``schedule`` runs the delayed announcements,
+        ``persist`` submits the merged join/leave notices for recording and
+        ``when_done`` calls back once one is recorded (see server.presence).
+        ``history`` buffers each room's recent messages (a fresh, unwarmed one by
+        default)."""
+        self._lock = threading.Lock()
+        self._by_id: Dict[str, Any] = {}
+        self._by_nickname: Dict[str, Dict[Any, None]] = {}  # nicknames needn't be unique
+        self._snapshot: Optional[Tuple[Any, ...]] = ()
+        self.rooms = RoomRegistry()
+        self.history = history if history is not None else RoomHistory()
+        self.presence = PresenceDebouncer(
+            self.rooms,
+            presence_window,
+            presence_counters,
+            schedule=schedule,
+            persist=persist or presence.record_notice,
+            history=self.history,
+            when_done=when_done,
+        )
+
+    def add(self, client: Any) -> None:
+        """Register a connected client under its id, nickname and current room."""
+        with self._lock:
+            self._by_id[client.id] = client
+            self._by_nickname.setdefault(client.nickname, {})[client] = None
+            self._snapshot = None
+        self.rooms.add(client, client.room)
+
+    def remove(self, client: Any) -> bool:
+        """Forget a client; returns False if it was already gone (e.g. pruned)."""
+        with self._lock:
+            if self._by_id.get(client.id) is not client:
+                return False
+            del self._by_id[client.id]
+            self._unindex_nickname(client, client.nickname)
+            self._snapshot = None
+        self.rooms.remove(client)
+        return True
+
+    def rename(self, client: Any, old: str, new: str) -> None:
+        """Re-index a registered client whose nickname changed from ``old`` to ``new``."""
+        with self._lock:
+            if self._by_id.get(client.id) is not client:
+                return
+            self._unindex_nickname(client, old)
+            self._by_nickname.setdefault(new, {})[client] = None
+
+    def get(self, client_id: str) -> Optional[Any]:
+        """The connected client with this id, or None."""
+        return self._by_id.get(client_id)
+
+    def with_nickname(self, nickname: str) -> Tuple[Any, ...]:
+        """Every connected client currently using ``nickname``."""
+        with self._lock:
+            return tuple(self._by_nickname.get(nickname, ()))
+
+    def snapshot(self) -> Tuple[Any, ...]:
+        """Every connected client, in the order they connected."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._by_id.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def __iter__(self) -> Iterator[Any]:
+        return iter(self.snapshot())
+
+    def __contains__(self, client: Any) -> bool:
+        client_id = getattr(client, 'id', None)
+        return client_id is not None and self._by_id.get(client_id) is client
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def _unindex_nickname(self, client: Any, nickname: str) -> None:
+        holders = self._by_nickname.get(nickname)
+        if holders is not None:
+            holders.pop(client, None)
+            if not holders:
+                del self._by_nickname[nickname]
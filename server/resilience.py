@@ -13,3 +13,16 @@ def is_stale(last_seen: float, now: float, timeout: float) -> bool:
 def should_ping(last_seen: float, last_ping: float, now: float, interval: float) -> bool:
     """True when a client has gone quiet for ``interval`` and isn't already being probed."""
     return (now - last_seen) >= interval and (now - last_ping) >= interval
+
+
+def seconds_until_due(
+    last_seen: float, last_ping: float, now: float, interval: float, timeout: float
+) -> float:
+    """Seconds until :func:`should_ping` or :func:`is_stale` could next turn true.
+
+    Lets a caller sleep straight through a quiet connection's idle time instead of
+    polling it; any traffic in the meantime only pushes the real deadline later.
+    """
+    ping_due = max(last_seen, last_ping) + interval
+    stale_due = last_seen + timeout
+    return max(0.0, min(ping_due, stale_due) - now)
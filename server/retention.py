@@ -0,0 +1,207 @@
+"""How long the server keeps messages, and the background job that enforces it.
+
+Nothing used to delete a message, so ``server.db`` -- and its page cache, and
+every backup of it -- grew for as long as the server ran, although clients only
+ever ask for the last half hour. Each room can now be given a maximum age and a
+maximum number of messages (``[server.retention]`` in ``tcp-chat.toml``), with a
+default for rooms not named.
+
+A :class:`Pruner` thread wakes every ``interval`` seconds and deletes what the
+policy no longer keeps, oldest first, ``batch`` rows per transaction. It takes
+the database lock only for one such batch at a time, so a message being recorded
+waits behind at most one small delete, and each batch is evicted from the
+server's in-memory :class:`server.history.RoomHistory` as well, so history
+requests stop offering it at once. The pages freed are then handed back to
+the filesystem a few at a time by an incremental vacuum.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from server import db
+from server import metrics
+from server import storage
+from server.history import RoomHistory
+from shared import constants
+
+logger = logging.getLogger('retention')
+
+
+class RetentionPolicy(NamedTuple):
+    max_age: float = constants.RETENTION_MAX_AGE  # seconds a message is kept (0: forever)
+    max_rows: int = constants.RETENTION_MAX_ROWS  # messages a room keeps (0: no limit)
+
+    @property
+    def keeps_everything(self) -> bool:
+        return self.max_age <= 0 and self.max_rows <= 0
+
+
+class Retention(NamedTuple):
+    default: RetentionPolicy = RetentionPolicy()
+    rooms: Dict[str, RetentionPolicy] = {}  # overrides for particular rooms
+
+    def for_room(self, room: str) -> RetentionPolicy:
+        return self.rooms.get(room, self.default)
+
+    @property
+    def keeps_everything(self) -> bool:
+        return self.default.keeps_everything and all(
+            policy.keeps_everything for policy in self.rooms.values()
+        )
+
+
+def _policy(data: Dict[str, Any], where: str, base: RetentionPolicy) -> RetentionPolicy:
+    unknown = set(data) - set(RetentionPolicy._fields)
+    if unknown:
+        raise ValueError(f'unknown retention setting(s) in {where}: {", ".join(sorted(unknown))}')
+    policy = base._replace(**data)
+    if policy.max_age < 0 or policy.max_rows < 0:
+        raise ValueError(f'retention limits in {where} must not be negative')
+    return policy
+
+
+def parse_retention(data: Optional[Dict[str, Any]]) -> Retention:
+    """Build a Retention from the ``[server.retention]`` table; raise ValueError if it is bad.
+
+    Its ``max_age`` and ``max_rows`` are the default, and each ``[server.retention.rooms.X]``
+    table overrides them for room X (anything it leaves out comes from the default).
+    """
+    data = dict(data or {})
+    rooms = data.pop('rooms', {})
+    default = _policy(data, '[server.retention]', RetentionPolicy())
+    return Retention(
+        default,
+        {
+            room: _policy(settings, f'[server.retention.rooms.{room}]', default)
+            for room, settings in rooms.items()
+        },
+    )
+
+
+class Pruner:
+    """The daemon thread that deletes messages the retention policy no longer keeps."""
+
+    def __init__(
+        self,
+        retention: Retention,
+        path: Optional[str] = None,
+        batch: int = constants.PRUNE_BATCH_SIZE,
+        interval: float = constants.PRUNE_INTERVAL,
+        vacuum_pages: int = constants.PRUNE_VACUUM_PAGES,
+        counters: Optional[metrics.Counters] = None,
+        history: Optional[RoomHistory] = None,
+    ) -> None:
+        self.retention = retention
+        self.history = history  # the buffers to evict pruned messages from
+        self.path = path or constants.SERVER_DATABASE
+        self.batch, self.interval, self.vacuum_pages = max(1, batch), interval, vacuum_pages
+        self.counters = counters if counters is not None else metrics.retention_counters()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> 'Pruner':
+        self._thread = threading.Thread(target=self._run, name='pruner', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self) -> None:
+        # sqlite connections belong to the thread that opened them.
+        database = db.ServerDatabase(self.path)
+        try:
+            while not self._stop.wait(self.interval):
+                try:
+                    self.prune(database.conn)
+                except Exception as e:
+                    logger.error(f'Pruning old messages failed: {e}')
+        finally:
+            database.close()
+
+    def prune(self, conn: sqlite3.Connection, now: Optional[float] = None) -> int:
+        """Delete everything the policy no longer keeps, a batch at a time; returns the count."""
+        now = time.time() if now is None else now
+        rooms = [row[0] for row in conn.execute('SELECT DISTINCT room FROM message')]
+        deleted = 0
+        for room in rooms:
+            policy = self.retention.for_room(room)
+            for cutoff in self._cutoffs(conn, room, policy, now):
+                while not self._stop.is_set():
+                    removed = self._delete_batch(conn, room, cutoff)
+                    deleted += removed
+                    if removed and self.history is not None:
+                        self.history.evict(room, cutoff)
+                    if removed < self.batch:
+                        break
+        self.counters.incr('passes')
+        if deleted:
+            self.counters.incr('deleted', deleted)
+            logger.info(f'Pruned {deleted} message(s) past their retention.')
+            self._vacuum(conn)
+        return deleted
+
+    @staticmethod
+    def _cutoffs(
+        conn: sqlite3.Connection, room: str, policy: RetentionPolicy, now: float
+    ) -> List[Tuple[int, int]]:
+        """(timestamp, id) bounds at or below which ``room``'s messages are deleted."""
+        cutoffs = []
+        if policy.max_age > 0:
+            # Everything sent before the age limit, whatever its id.
+            cutoffs.append((int(now - policy.max_age) - 1, 2**63 - 1))
+        if policy.max_rows > 0:
+            newest_dropped = conn.execute(
+                '''SELECT timestamp, id FROM message WHERE room = ?
+                        ORDER BY timestamp DESC, id DESC LIMIT 1 OFFSET ?''',
+                [room, policy.max_rows],
+            ).fetchone()
+            if newest_dropped is not None:
+                cutoffs.append((newest_dropped[0], newest_dropped[1]))
+        return cutoffs
+
+    def _delete_batch(self, conn: sqlite3.Connection, room: str, cutoff: Tuple[int, int]) -> int:
+        timestamp, message_id = cutoff
+        with db.lock:
+            with conn:
+                return conn.execute(
+                    '''DELETE FROM message WHERE id IN (
+                            SELECT id FROM message
+                            WHERE room = ? AND (timestamp < ? OR (timestamp = ? AND id <= ?))
+                            ORDER BY timestamp LIMIT ?)''',
+                    [room, timestamp, timestamp, message_id, self.batch],
+                ).rowcount
+
+    def _vacuum(self, conn: sqlite3.Connection) -> None:
+        """Give the pages freed by pruning back to the filesystem, a few at a time."""
+        free = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        while free and not self._stop.is_set():
+            with db.lock:
+                conn.execute(f'PRAGMA incremental_vacuum({self.vacuum_pages})').fetchall()
+            left = conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if left >= free:
+                return  # not an incremental auto-vacuum file; nothing to give back this way
+            self.counters.incr('pages_freed', free - left)
+            free = left
+
+
+def start_pruner(
+    retention: Optional[Retention],
+    backend: str = storage.SQLITE,
+    history: Optional[RoomHistory] = None,
+) -> Optional[Pruner]:
+    """Start a Pruner if ``retention`` deletes anything and ``backend`` can prune.
+
+    What it deletes is evicted from ``history`` too.
+    """
+    if retention is None or retention.keeps_everything:
+        return None
+    if backend != storage.SQLITE:
+        logger.warning(f'Retention is not enforced by the {backend!r} storage backend.')
+        return None
+    return Pruner(retention, history=history).start()
@@ -1,24 +1,94 @@
-"""Helpers for grouping connected clients into named rooms.
+"""An index of which connected clients are in which named room.
 
-Rooms are derived from each client's ``room`` attribute rather than a separate
-registry, so a client can only ever be in one room and membership can't drift
-out of sync with the connection list.
+A client is in exactly one room at a time. The registry keeps both directions --
+room to members and client to room -- so fan-out and member counts cost the size
+of one room instead of a scan over every connection. Each room's member list is
+handed out as an immutable snapshot, rebuilt lazily after that room changes, so
+handler threads can iterate one without holding the lock or copying it per
+broadcast, and entering or leaving a room stays O(1).
 """
 
-from typing import Dict, List
+import threading
+from typing import Any, Dict, Optional, Tuple
 
 from shared import constants
 
 
-def members_in(clients, room: str) -> List:
-    """Return the connected clients currently in ``room``."""
-    return [client for client in clients if getattr(client, 'room', constants.DEFAULT_ROOM) == room]
+class RoomRegistry:
+    """Thread-safe ``room -> members`` and ``client -> room`` maps, kept in step."""
 
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._members: Dict[str, Dict[Any, None]] = {}  # insertion-ordered sets
+        self._room_of: Dict[Any, str] = {}
+        self._snapshots: Dict[str, Tuple[Any, ...]] = {}
 
-def room_counts(clients) -> Dict[str, int]:
-    """Return a mapping of room name to member count for every occupied room."""
-    counts: Dict[str, int] = {}
-    for client in clients:
-        room = getattr(client, 'room', constants.DEFAULT_ROOM)
-        counts[room] = counts.get(room, 0) + 1
-    return counts
+    def add(self, client: Any, room: str = constants.DEFAULT_ROOM) -> None:
+        """Register a newly connected client in ``room`` (moving it if already known)."""
+        with self._lock:
+            old = self._room_of.get(client)
+            if old is not None:
+                self._leave(client, old)
+            self._enter(client, room)
+
+    def move(self, client: Any, room: str) -> Optional[str]:
+        """Move a registered client to ``room``, returning the room it left.
+
+        Returns None, and registers nothing, for a client that isn't registered.
+        """
+        with self._lock:
+            old = self._room_of.get(client)
+            if old is not None and old != room:
+                self._leave(client, old)
+                self._enter(client, room)
+            return old
+
+    def remove(self, client: Any) -> Optional[str]:
+        """Forget a disconnected client, returning the room it was in (if any)."""
+        with self._lock:
+            old = self._room_of.get(client)
+            if old is not None:
+                self._leave(client, old)
+            return old
+
+    def members(self, room: str) -> Tuple[Any, ...]:
+        """The clients currently in ``room``, in the order they entered it."""
+        snapshot = self._snapshots.get(room)
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshots.get(room)
+                if snapshot is None:
+                    snapshot = tuple(self._members.get(room, ()))
+                    if snapshot:
+                        self._snapshots[room] = snapshot
+        return snapshot
+
+    def room_of(self, client: Any) -> Optional[str]:
+        """The room a registered client is in, or None."""
+        return self._room_of.get(client)
+
+    def counts(self) -> Dict[str, int]:
+        """A mapping of room name to member count for every occupied room."""
+        with self._lock:
+            return {room: len(members) for room, members in self._members.items()}
+
+    def __contains__(self, client: Any) -> bool:
+        return client in self._room_of
+
+    def __len__(self) -> int:
+        return len(self._room_of)
+
+    def _enter(self, client: Any, room: str) -> None:
+        members = self._members.setdefault(room, {})
+        members[client] = None
+        self._room_of[client] = room
+        self._snapshots.pop(room, None)
+
+    def _leave(self, client: Any, room: str) -> None:
+        members = self._members[room]
+        del members[client]
+        del self._room_of[client]
+        self._snapshots.pop(room, None)
+        if not members:
+            # Rooms exist only while occupied, so an emptied one disappears.
+            del self._members[room]
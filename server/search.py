@@ -0,0 +1,75 @@
+"""Full-text search of a room's messages, run off the handlers' threads.
+
+A search can take far longer than anything else a client asks for: a common
+word in a busy room matches thousands of rows, and every one of them has to be
+ranked. So ``/search`` never runs its query where the client's frames are read.
+It is handed to a small pool of search threads shared by the whole server, the
+handler goes straight back to its receive loop, and the hits are sent to the
+requester alone, as a SEARCH_RESULTS frame, once they are ready. The pool also
+bounds how many searches can be reading the database at the same time.
+"""
+
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from server import storage
+from shared import constants
+
+logger = logging.getLogger('search')
+
+
+class SearchPage(NamedTuple):
+    terms: List[str]
+    page: int  # 1-based
+    hits: List[storage.HistoryRow]  # best match first
+    more: bool  # whether a further page has hits
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _pool() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=constants.SEARCH_WORKERS, thread_name_prefix='search'
+            )
+        return _executor
+
+
+def run(
+    store: storage.Storage,
+    room: str,
+    terms: List[str],
+    page: int = 1,
+    page_size: int = constants.SEARCH_PAGE_SIZE,
+) -> SearchPage:
+    """One page of ``room``'s messages matching every one of ``terms``, on this thread."""
+    page = max(1, page)
+    # One hit past the page says whether another one follows.
+    hits = store.search_messages(room, terms, (page - 1) * page_size, page_size + 1)
+    return SearchPage(terms, page, hits[:page_size], len(hits) > page_size)
+
+
+def submit(
+    store: storage.Storage,
+    room: str,
+    terms: List[str],
+    page: int = 1,
+    page_size: int = constants.SEARCH_PAGE_SIZE,
+) -> 'Future[SearchPage]':
+    """Queue a search for the shared search threads; the future resolves to its page."""
+    return _pool().submit(run, store, room, terms, page, page_size)
+
+
+def close_searches() -> None:
+    """Let running searches finish and drop queued ones, e.g. as the server shuts down."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,393 @@
+"""An append-only, segmented log of chat messages: the ``log`` storage backend.
+
+Messages are only ever appended, in roughly timestamp order, and only ever read
+back by time range, so they are kept as length-prefixed records in a directory
+of segment files. Each segment is named after the id of its first message and
+is sealed once it passes ``segment_size`` bytes, when a new one is started.
+
+Next to each segment an ``.idx`` file holds a sparse timestamp index: every
+``index_every`` bytes, the offset of the next record and the newest timestamp
+of everything before it. Every record before such an entry is older than its
+timestamp, so a history read bisects the index for where to start and parses
+forward from there through a memory map of the segment, rather than reading
+the file from the beginning. On startup only the tail after each segment's last
+index entry is scanned, and a record torn by a crash is cut off.
+
+Retention and pruning (see :mod:`server.retention`) apply to the sqlite backend
+only; a log keeps its segments until they are removed by hand.
+"""
+
+import bisect
+import collections
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from typing import BinaryIO, Deque, Dict, List, Optional, Tuple
+
+from server import db
+from server import storage
+from shared import constants
+
+logger = logging.getLogger('segmentlog')
+
+# Length of the rest of the record, id, timestamp, then the byte lengths of the
+# room, nickname, connection hash and color that follow; the message is the rest.
+RECORD = struct.Struct('>IQqHHHH')
+# Newest timestamp of every record before the offset, and the offset.
+INDEX_ENTRY = struct.Struct('>qQ')
+
+SYNC_INTERVAL = 1.0  # seconds between fsyncs under 'async' durability
+
+
+def encode_record(message_id: int, row: db.Row) -> bytes:
+    nickname, user_hash, color, message, timestamp, room = row
+    fields = [field.encode('utf-8') for field in (room, nickname, user_hash, color, message)]
+    head = RECORD.pack(
+        RECORD.size - 4 + sum(len(field) for field in fields),
+        message_id,
+        timestamp,
+        *(len(field) for field in fields[:4]),
+    )
+    return head + b''.join(fields)
+
+
+class _Segment:
+    """One segment file, its sparse index, and a memory map of it for readers."""
+
+    def __init__(self, directory: str, first_id: int) -> None:
+        self.first_id = first_id
+        self.path = os.path.join(directory, f'{first_id:020d}.seg')
+        self.index_path = self.path[: -len('.seg')] + '.idx'
+        self.entries: List[Tuple[int, int]] = []  # (newest timestamp before offset, offset)
+        self.size = 0
+        self.newest = -(2**63)  # newest timestamp in the segment
+        self.last_id = first_id - 1
+        self._map: Optional[mmap.mmap] = None
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """Read the index and scan the tail after it, cutting off a torn last record."""
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'rb') as handle:
+                data = handle.read()
+            usable = len(data) - len(data) % INDEX_ENTRY.size
+            self.entries = [
+                (newest, offset) for newest, offset in INDEX_ENTRY.iter_unpack(data[:usable])
+            ]
+        size = os.path.getsize(self.path)
+        while True:
+            # Every index entry is written just before the record it points at.
+            start = self.entries[-1][1] if self.entries else 0
+            with open(self.path, 'rb') as handle:
+                handle.seek(start)
+                tail = handle.read()
+            newest, offset = self.entries[-1][0] if self.entries else self.newest, 0
+            while offset + RECORD.size <= len(tail):
+                length, message_id, timestamp = RECORD.unpack_from(tail, offset)[:3]
+                if offset + 4 + length > len(tail):
+                    break
+                newest, self.last_id = max(newest, timestamp), message_id
+                offset += 4 + length
+            if offset or not self.entries:
+                break
+            self.entries.pop()  # its record never made it to disk whole
+        self.newest = newest
+        self.size = start + offset
+        if self.size < size:
+            logger.warning(f'Cutting {size - self.size} torn byte(s) off {self.path}.')
+            with open(self.path, 'r+b') as handle:
+                handle.truncate(self.size)
+        with open(self.index_path, 'wb') as handle:
+            handle.write(b''.join(INDEX_ENTRY.pack(*entry) for entry in self.entries))
+
+    def view(self, size: int) -> memoryview:
+        """The first ``size`` bytes of the file, through a (re)mapping that covers them."""
+        if size == 0:
+            return memoryview(b'')
+        with self._lock:
+            if self._map is None or len(self._map) < size:
+                # Views of the old map may still be in use; it closes once they are gone.
+                with open(self.path, 'rb') as handle:
+                    self._map = mmap.mmap(handle.fileno(), size, access=mmap.ACCESS_READ)
+            return memoryview(self._map)[:size]
+
+    def start(self, since: int) -> int:
+        """An offset before which every record is older than ``since``."""
+        position = bisect.bisect_left(self.entries, (since, 0))
+        return self.entries[position - 1][1] if position else 0
+
+    def close(self) -> None:
+        with self._lock:
+            self._map = None  # closed once no reader holds a view of it
+
+
+def _records(buffer: memoryview, offset: int, room: Optional[bytes] = None):
+    """Parse records from ``offset`` on, skipping other rooms' without decoding them."""
+    end = len(buffer)
+    while offset + RECORD.size <= end:
+        length, message_id, timestamp, room_len, nick_len, hash_len, color_len = RECORD.unpack_from(
+            buffer, offset
+        )
+        body = offset + RECORD.size
+        offset += 4 + length
+        if room is not None and buffer[body : body + room_len] != room:
+            continue
+        nick = body + room_len
+        color = nick + nick_len + hash_len
+        text = color + color_len
+        yield (
+            message_id,
+            timestamp,
+            bytes(buffer[body:nick]).decode('utf-8'),
+            bytes(buffer[nick : nick + nick_len]).decode('utf-8'),
+            bytes(buffer[color:text]).decode('utf-8'),
+            bytes(buffer[text:offset]).decode('utf-8'),
+        )
+
+
+class SegmentLog:
+    """The one writer of a log directory, and the readers' view of its segments."""
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        segment_size: int = constants.SEGMENT_SIZE,
+        index_every: int = constants.SEGMENT_INDEX_EVERY,
+        durability: str = constants.DURABILITY,
+    ) -> None:
+        self.directory = directory or constants.SEGMENT_LOG_DIR
+        self.segment_size, self.index_every = segment_size, index_every
+        self.durability = durability
+        self._lock = threading.Lock()
+        self._last_sync = time.monotonic()
+        os.makedirs(self.directory, exist_ok=True)
+        self._segments: List[_Segment] = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith('.seg'):
+                segment = _Segment(self.directory, int(name[: -len('.seg')]))
+                segment.load()
+                self._segments.append(segment)
+        self._last_id = self._segments[-1].last_id if self._segments else 0
+        if not self._segments:
+            self._segments.append(self._create(1))
+        self._file: BinaryIO = open(self._segments[-1].path, 'ab')
+        self._index: BinaryIO = open(self._segments[-1].index_path, 'ab')
+        self._closed = False
+
+    @property
+    def durability(self) -> str:
+        return self._durability
+
+    @durability.setter
+    def durability(self, durability: str) -> None:
+        self._durability = db.check_durability(durability)
+
+    def append(self, row: db.Row) -> int:
+        """Append one message and return its id, once it is as safe as ``durability`` says."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('the message log is closed')
+            self._last_id += 1
+            record = encode_record(self._last_id, row)
+            active = self._segments[-1]
+            if active.size and active.size + len(record) > self.segment_size:
+                active = self._rotate(self._last_id)
+            if not active.entries or active.size - active.entries[-1][1] >= self.index_every:
+                entry = (active.newest, active.size)
+                active.entries.append(entry)
+                self._index.write(INDEX_ENTRY.pack(*entry))
+                self._index.flush()
+            self._file.write(record)
+            self._file.flush()  # readers map the file, not this buffer
+            active.size += len(record)
+            active.newest = max(active.newest, row[4])
+            active.last_id = self._last_id
+            self._sync()
+            return self._last_id
+
+    def recent(self, room: str, since: int, limit: int) -> List[db.HistoryRow]:
+        rows = [
+            (message_id, nickname, color, message, timestamp)
+            for segment, size in self._snapshot()
+            if segment.newest >= since
+            for message_id, timestamp, _, nickname, color, message in _records(
+                segment.view(size), segment.start(since), room.encode('utf-8')
+            )
+            if timestamp >= since
+        ]
+        rows.sort(key=lambda row: row[4])
+        return rows[:limit]
+
+    def page(
+        self, room: str, before_id: Optional[int], after_id: Optional[int], limit: int
+    ) -> List[db.HistoryRow]:
+        # Ids rise through the log, so a page only reads the segments its bounds
+        # reach into, newest first for a backward page and oldest first otherwise.
+        upper = 2**63 - 1 if before_id is None else before_id
+        lower = 0 if after_id is None else after_id
+        forward = before_id is None and after_id is not None
+        snapshot = self._snapshot()
+        ends = [segment.first_id for segment, _ in snapshot[1:]] + [upper]
+        spans = [
+            (segment, size)
+            for (segment, size), end in zip(snapshot, ends)
+            if segment.first_id < upper and end > lower + 1
+        ]
+        rows: List[db.HistoryRow] = []
+        for segment, size in spans if forward else reversed(spans):
+            found: Deque[db.HistoryRow] = collections.deque(maxlen=None if forward else limit)
+            for message_id, timestamp, _, nickname, color, message in _records(
+                segment.view(size), 0, room.encode('utf-8')
+            ):
+                if lower < message_id < upper:
+                    found.append((message_id, nickname, color, message, timestamp))
+                    if forward and len(rows) + len(found) == limit:
+                        break
+            rows = rows + list(found) if forward else list(found) + rows
+            if len(rows) >= limit:
+                break
+        return rows[:limit] if forward else rows[-limit:]
+
+    def search(self, room: str, terms: List[str], offset: int, limit: int) -> List[db.HistoryRow]:
+        # There is no text index here: a search reads the whole room, and the
+        # newest matches count as the best.
+        words = [term.casefold() for term in terms]
+        hits = [
+            (message_id, nickname, color, message, timestamp)
+            for segment, size in self._snapshot()
+            for message_id, timestamp, _, nickname, color, message in _records(
+                segment.view(size), 0, room.encode('utf-8')
+            )
+            if all(word in message.casefold() for word in words)
+        ]
+        hits.reverse()
+        return hits[offset : offset + limit]
+
+    def latest(self, limit: int) -> Dict[str, List[db.HistoryRow]]:
+        latest: Dict[str, Deque[db.HistoryRow]] = {}
+        for segment, size in self._snapshot():
+            for message_id, timestamp, room, nickname, color, message in _records(
+                segment.view(size), 0
+            ):
+                rows = latest.setdefault(room, collections.deque(maxlen=limit))
+                rows.append((message_id, nickname, color, message, timestamp))
+        return {room: sorted(rows, key=lambda row: row[4]) for room, rows in latest.items()}
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._index.close()
+            for segment in self._segments:
+                segment.close()
+
+    def _snapshot(self) -> List[Tuple[_Segment, int]]:
+        """Every segment with how much of it is complete, as of now."""
+        with self._lock:
+            return [(segment, segment.size) for segment in self._segments]
+
+    def _create(self, first_id: int) -> _Segment:
+        segment = _Segment(self.directory, first_id)
+        open(segment.path, 'ab').close()
+        return segment
+
+    def _rotate(self, first_id: int) -> _Segment:
+        """Seal the active segment and start a new one. Hold the lock."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._index.close()
+        segment = self._create(first_id)
+        self._segments.append(segment)
+        self._file = open(segment.path, 'ab')
+        self._index = open(segment.index_path, 'ab')
+        logger.debug(f'Started log segment {os.path.basename(segment.path)}.')
+        return segment
+
+    def _sync(self) -> None:
+        """fsync as often as ``durability`` asks. Hold the lock."""
+        if self._durability == db.NONE:
+            return
+        now = time.monotonic()
+        if self._durability == db.SYNC or now - self._last_sync >= SYNC_INTERVAL:
+            os.fsync(self._file.fileno())
+            self._last_sync = now
+
+
+class LogStore(storage.Storage):
+    """A handler's store backed by the shared log of a directory; it opens nothing itself."""
+
+    def __init__(self, directory: Optional[str] = None) -> None:
+        self.directory = directory or constants.SEGMENT_LOG_DIR
+        self._closed = False
+
+    @property
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def close(self) -> None:
+        self._closed = True
+
+    def submit_message(
+        self,
+        nickname: str,
+        user_hash: str,
+        color: str,
+        message: str,
+        timestamp: int,
+        room: str = constants.DEFAULT_ROOM,
+    ) -> 'Future[int]':
+        future: 'Future[int]' = Future()
+        try:
+            row = (nickname, user_hash, color, message, timestamp, room)
+            future.set_result(shared_log(self.directory).append(row))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def recent_messages(self, room: str, since: int, limit: int) -> List[db.HistoryRow]:
+        return shared_log(self.directory).recent(room, since, limit)
+
+    def page_messages(
+        self, room: str, before_id: Optional[int], after_id: Optional[int], limit: int
+    ) -> List[db.HistoryRow]:
+        return shared_log(self.directory).page(room, before_id, after_id, limit)
+
+    def search_messages(
+        self, room: str, terms: List[str], offset: int, limit: int
+    ) -> List[db.HistoryRow]:
+        return shared_log(self.directory).search(room, terms, offset, limit)
+
+    def latest_messages(self, limit: int) -> Dict[str, List[db.HistoryRow]]:
+        return shared_log(self.directory).latest(limit)
+
+
+_logs: Dict[str, SegmentLog] = {}
+_logs_lock = threading.Lock()
+
+
+def shared_log(directory: Optional[str] = None) -> SegmentLog:
+    """The process's one SegmentLog for a directory, opened on first use."""
+    directory = os.path.abspath(directory or constants.SEGMENT_LOG_DIR)
+    with _logs_lock:
+        log = _logs.get(directory)
+        if log is None:
+            log = _logs[directory] = SegmentLog(directory)
+        return log
+
+
+def close_logs() -> None:
+    """Flush and close every shared log, e.g. as the server shuts down."""
+    with _logs_lock:
+        logs = list(_logs.values())
+        _logs.clear()
+    for log in logs:
+        log.close()
@@ -0,0 +1,160 @@
+"""The interface the server's message stores share, and the choice between them.
+
+Handlers only ever record a message and read a room's recent ones, so that is
+all a store has to offer. Two backends provide it:
+
+* ``sqlite`` -- :class:`server.db.MessageStore`, the message table in
+  ``server.db``: group-committed writes, pooled snapshot reads, retention;
+* ``log`` -- :class:`server.segmentlog.LogStore`, an append-only log of
+  length-prefixed records in rotating segment files, read through memory maps
+  and a sparse timestamp index. Chat history is appended in order and read by
+  time range, which is all a log has to be good at.
+
+The server picks one at startup with :func:`prepare`, and every handler then
+gets a store of that kind from :func:`open_store`.
+"""
+
+import abc
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from shared import constants
+
+HistoryRow = Tuple[int, str, str, str, int]  # id, nickname, color, message, timestamp
+
+SQLITE, LOG = 'sqlite', 'log'
+BACKENDS = (SQLITE, LOG)
+
+_backend = SQLITE
+
+
+class Storage(abc.ABC):
+    """Where a handler records messages and reads a room's history."""
+
+    @property
+    @abc.abstractmethod
+    def is_closed(self) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        """Stop using the store; anything it shares with other stores stays open."""
+
+    @abc.abstractmethod
+    def submit_message(
+        self,
+        nickname: str,
+        user_hash: str,
+        color: str,
+        message: str,
+        timestamp: int,
+        room: str = constants.DEFAULT_ROOM,
+    ) -> 'Future[int]':
+        """Queue a message for recording without waiting; the future resolves to its ID."""
+
+    def add_message(
+        self,
+        nickname: str,
+        user_hash: str,
+        color: str,
+        message: str,
+        timestamp: int,
+        room: str = constants.DEFAULT_ROOM,
+    ) -> int:
+        """
+        Record a message. Returns the message ID.
+
+        This blocks for as long as the store's durability setting says a sender
+        must wait: until the message is on disk under ``sync``, barely at all otherwise.
+
+        :param nickname: A non-unique identifier for the user.
+        :param user_hash: A unique hash (usually) denoting the sender's identity.
+        :param color: The color of the user who sent the message.
+        :param message: The string content of the message echoed to all clients.
+        :param timestamp: The epoch time of the sent message.
+        :param room: The room the message was sent to.
+        :return: The unique integer chosen for the message, i.e. it's ID.
+        """
+        return self.submit_message(nickname, user_hash, color, message, timestamp, room).result()
+
+    @abc.abstractmethod
+    def recent_messages(self, room: str, since: int, limit: int) -> List[HistoryRow]:
+        """
+        The first `limit` messages sent to `room` at or after `since`, oldest first.
+
+        :return: HistoryRow tuples, as sent in MESSAGE_HISTORY.
+        """
+
+    @abc.abstractmethod
+    def page_messages(
+        self, room: str, before_id: Optional[int], after_id: Optional[int], limit: int
+    ) -> List[HistoryRow]:
+        """
+        Up to `limit` of `room`'s messages with ids between the two bounds, oldest first.
+
+        Without an ``after_id`` these are the newest such messages, the page just
+        before ``before_id`` (or the room's latest page, without either bound);
+        with only an ``after_id``, the oldest ones after it.
+        """
+
+    @abc.abstractmethod
+    def search_messages(
+        self, room: str, terms: List[str], offset: int, limit: int
+    ) -> List[HistoryRow]:
+        """`room`'s messages containing every one of `terms`, best first, from hit `offset` on."""
+
+    @abc.abstractmethod
+    def latest_messages(self, limit: int) -> Dict[str, List[HistoryRow]]:
+        """Every room's newest `limit` messages, oldest first, e.g. to warm a history buffer."""
+
+
+def check_backend(backend: str) -> str:
+    """Return ``backend`` if it names a storage backend; raise ValueError otherwise."""
+    if backend not in BACKENDS:
+        raise ValueError(
+            f'unknown storage backend {backend!r} (expected one of {", ".join(BACKENDS)})'
+        )
+    return backend
+
+
+def prepare(
+    backend: str = constants.STORAGE_BACKEND, durability: str = constants.DURABILITY
+) -> None:
+    """Make ``backend`` the one every store opens, and get it ready for clients.
+
+    Servers call this once at startup: the sqlite schema is created or migrated
+    here rather than on anyone's join path, and the backend's writer learns how
+    long senders wait for their messages to reach the disk.
+    """
+    global _backend
+    _backend = check_backend(backend)
+    if backend == SQLITE:
+        from server import db
+
+        db.shared_pool()
+        db.shared_writer().durability = durability
+    else:
+        from server import segmentlog
+
+        segmentlog.shared_log().durability = durability
+
+
+def open_store(path: Optional[str] = None) -> Storage:
+    """A store of the kind :func:`prepare` chose (sqlite until it is called)."""
+    if _backend == SQLITE:
+        from server import db
+
+        return db.MessageStore(path)
+    from server import segmentlog
+
+    return segmentlog.LogStore(path)
+
+
+def close_all() -> None:
+    """Flush and close everything the backends share, e.g. as the server shuts down."""
+    from server import db
+    from server import segmentlog
+
+    db.close_writers()
+    db.close_pools()
+    segmentlog.close_logs()
@@ -14,8 +14,46 @@ DEFAULT_IP = "127.0.0.1"
 DEFAULT_PORT = 5555
 DEFAULT_ROOM = "general"
 
+ENGINES = ('threads', 'asyncio')
+SERVER_ENGINE = 'threads'  # One OS thread per client, or coroutines on a single event loop
+MAX_HANDSHAKES = 16  # Connection handshakes the server negotiates at once; the rest wait
+MAX_PENDING_HANDSHAKES = 256  # Accepted sockets that may wait for a HELLO; later ones are shed
+
+SEND_QUEUE_SIZE = 256  # Frames queued for a slow client before SEND_QUEUE_POLICY applies
+SEND_QUEUE_POLICY = 'drop-oldest'  # 'drop-oldest', 'disconnect' or 'block'
+SEND_BLOCK_DEADLINE = 2.0  # Seconds the 'block' policy waits for room before disconnecting
+SEND_BATCH_FRAMES = 64  # Most queued frames a client's writer sends in one syscall
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Longest frame body accepted from a peer, in bytes
+COMPRESSION = True  # Compress v3 connections whose client asks for it in its HELLO
+COMPRESSION_THRESHOLD = 256  # Frame bodies shorter than this many bytes go uncompressed
+
+WRITE_BATCH_SIZE = 256  # Messages the database writer inserts per transaction at most
+WRITE_BATCH_DELAY = 0.0  # Seconds it waits to fill a batch; 0 takes only what is already queued
+DURABILITY = 'sync'  # 'sync' (send once on disk), 'async' (send, then write) or 'none' (no fsync)
+DB_POOL_SIZE = 4  # Read-only database connections shared by every client handler
+HISTORY_BUFFER_SIZE = 500  # Recent messages per room kept in memory to answer history requests
+HISTORY_PAGE_SIZE = 100  # Most messages in one HISTORY_PAGE frame
+HISTORY_MAX_PAGES = 10  # Most HISTORY_PAGE frames streamed in answer to one request
+SEARCH_PAGE_SIZE = 10  # Hits in one page of /search results
+SEARCH_RANK_WINDOW = 5000  # Newest matches a search scores, which bounds what one costs
+SEARCH_WORKERS = 2  # Threads running /search queries, shared by every client
+RETENTION_MAX_AGE = 0  # Seconds a message is kept before it is pruned (0: forever)
+RETENTION_MAX_ROWS = 0  # Messages a room keeps before the oldest are pruned (0: no limit)
+PRUNE_INTERVAL = 60.0  # Seconds between pruning passes
+PRUNE_BATCH_SIZE = 500  # Messages deleted per transaction, so the writer never waits long
+PRUNE_VACUUM_PAGES = 256  # Free pages handed back to the filesystem per incremental vacuum step
+ARCHIVE_BATCH_SIZE = 10000  # Messages per read and per transaction in archive export/import
+STORAGE_BACKEND = 'sqlite'  # Where messages are kept: 'sqlite' (server.db) or 'log' (segment files)
+SEGMENT_LOG_DIR = os.path.join(__BASE_DIR, 'server-log')  # Segment files of the 'log' backend
+SEGMENT_SIZE = 64 * 1024 * 1024  # Bytes a log segment grows to before a new one is started
+SEGMENT_INDEX_EVERY = 4096  # Bytes of records between a segment's sparse index entries
+
+PRESENCE_WINDOW = 0.25  # Seconds a room's roster changes are coalesced into one update (0: none)
+
 PING_INTERVAL = 20  # Seconds of silence before the server probes a client with a PING
 PING_TIMEOUT = 60  # Seconds of silence before the server gives up on a client
+HEARTBEAT_TICK = 0.5  # Resolution, in seconds, of the server's keep-alive timer wheel
+HEARTBEAT_SLOTS = 256  # Buckets in that wheel; one turn should outlast PING_TIMEOUT
 
 MAX_SCROLLBACK = 200  # Most recent messages kept rendered in the chat box
 
@@ -48,6 +86,21 @@ class Types:
     HELLO = 'HELLO'  # Opening frame: client's protocol version and TLS intent
     WELCOME = 'WELCOME'  # Server accepts the client, telling it whether to upgrade to TLS
     REJECT = 'REJECT'  # Server refuses the client, with a human-readable reason
+    USER_JOINED = 'USER_JOINED'  # Someone entered the room (needs Features.PRESENCE)
+    USER_LEFT = 'USER_LEFT'  # Someone left the room (needs Features.PRESENCE)
+    USER_RENAMED = 'USER_RENAMED'  # Someone in the room changed nickname (needs Features.PRESENCE)
+    HISTORY_PAGE = 'HISTORY_PAGE'  # One page of history (needs Features.HISTORY_PAGES)
+    SEARCH_RESULTS = 'SEARCH_RESULTS'  # A page of /search hits, sent to the searcher only
+
+
+class Features:
+    """
+    Optional protocol extensions, offered in the client's HELLO and accepted in the WELCOME.
+    A peer that doesn't mention a feature gets the behaviour from before it existed.
+    """
+
+    PRESENCE = 'presence'  # Roster changes arrive as USER_JOINED/LEFT/RENAMED deltas
+    HISTORY_PAGES = 'history-pages'  # History can be paged through by message id (GET_HISTORY_PAGE)
 
 
 class Requests:
@@ -58,6 +111,7 @@ class Requests:
 
     REQUEST_NICK = 'REQUEST_NICK'  # Send the server the client's nickname
     GET_MESSAGE_HISTORY = 'GET_MESSAGE_HISTORY'  # Send the client a detailed list of all messages sent up to a certain point.
+    GET_HISTORY_PAGE = 'GET_HISTORY_PAGE'  # Stream pages of the room's messages before/after an id.
 
 
 class Color:
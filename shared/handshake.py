@@ -6,16 +6,32 @@ back as a *stated* rejection the client can show, instead of an opaque socket
 reset. Only after the server says WELCOME does either side wrap the socket in
 TLS, at which point the normal framed protocol takes over.
 
-    client -> HELLO   {version, tls}
-    server -> WELCOME {tls}   (then both upgrade if tls)   | REJECT {reason}
+    client -> HELLO   {version, tls, features, serializers, compress}
+    server -> WELCOME {version, tls, features, serializer, compress}   (then upgrade if tls)
+            | REJECT  {reason}
+
+The handshake frames are always in v2 framing. The WELCOME's ``version`` is the
+one the rest of the connection is framed in: the client's own, which a server
+accepts if it is its own version or an older one it still supports (see
+``protocol.SUPPORTED_VERSIONS``), so v2 and v3 clients share one port. A v3
+connection's frames are in the ``serializer`` the server chose from the ones the
+HELLO listed; a v2 one's are JSON. ``compress`` works like ``tls``: the client
+asks, and a v3 connection is compressed both ways if the server allows it (see
+``protocol.Compressor``).
+
+``features`` lists optional protocol extensions (see ``constants.Features``): the
+client offers what it understands and the WELCOME names the subset the server
+will use. Either side leaving it out simply means "none".
 
 Like any STARTTLS scheme the cleartext prelude is open to an active
 man-in-the-middle stripping the upgrade; that is an accepted trade-off here. The
 prelude carries only a version number and a boolean, never anything secret.
 """
 
+import asyncio
 import socket
-from typing import NamedTuple, Optional
+import time
+from typing import FrozenSet, Iterable, NamedTuple, Optional
 
 from shared import constants
 from shared import protocol
@@ -30,6 +46,11 @@ class HandshakeResult(NamedTuple):
     reason: str = ''
     rejected: bool = False  # True when the server stated a refusal, so retrying is pointless
     probe: bool = False  # True when the client announced this as a reachability probe
+    timed_out: bool = False  # True when the peer never finished its half in time
+    features: FrozenSet[str] = frozenset()  # optional extensions both ends agreed on
+    version: int = protocol.LEGACY_VERSION  # protocol version the connection continues in
+    serializer: str = protocol.JSON  # what the server will serialize frames with
+    compressed: bool = False  # True when frames after the handshake may be compressed
 
 
 def negotiate_client(
@@ -40,6 +61,9 @@ def negotiate_client(
     server_hostname: Optional[str] = None,
     timeout: float = HANDSHAKE_TIMEOUT,
     is_probe: bool = False,
+    features: Iterable[str] = (),
+    serializers: Optional[Iterable[str]] = None,
+    want_compression: bool = False,
 ) -> HandshakeResult:
     """Run the client side of the handshake, returning the (maybe upgraded) socket.
 
@@ -48,7 +72,14 @@ def negotiate_client(
     from blocking for the full handshake window on an unresponsive peer.
     ``is_probe`` marks the HELLO as a reachability check so the server can answer
     and hang up cleanly instead of building a client it will never hear from.
+    ``features`` are the optional extensions to offer; the result lists the ones
+    the server accepted, and the protocol version every later frame is framed in.
+    ``serializers`` are those to offer, by default every one ``protocol`` has;
+    the result names the one the server picked. ``want_compression`` asks for a
+    compressed connection, which the result says whether the server granted.
     """
+    if serializers is None:
+        serializers = protocol.serializers()
     previous_timeout = sock.gettimeout()
     sock.settimeout(timeout)
     try:
@@ -59,6 +90,9 @@ def negotiate_client(
                     'version': version,
                     'tls': bool(want_tls),
                     'probe': bool(is_probe),
+                    'features': sorted(features),
+                    'serializers': list(serializers),
+                    'compress': bool(want_compression),
                 }
             )
         )
@@ -77,6 +111,13 @@ def negotiate_client(
         )
     if reply.get('type') != constants.Types.WELCOME:
         return HandshakeResult(False, None, 'server sent an unexpected handshake reply')
+    # A server from before v3 says nothing, having accepted exactly what was offered.
+    agreed_version = reply.get('version', version)
+    if not isinstance(agreed_version, int) or agreed_version > version:
+        return HandshakeResult(False, None, f'server chose protocol version {agreed_version}')
+    serializer = reply.get('serializer', protocol.JSON)
+    if serializer != protocol.JSON and serializer not in serializers:
+        return HandshakeResult(False, None, f'server chose an unoffered serializer {serializer}')
 
     if reply.get('tls'):
         try:
@@ -85,7 +126,14 @@ def negotiate_client(
         except OSError as e:  # ssl.SSLError is an OSError subclass
             return HandshakeResult(False, None, f'TLS upgrade failed: {e}')
 
-    return HandshakeResult(True, sock)
+    return HandshakeResult(
+        True,
+        sock,
+        features=frozenset(reply.get('features') or ()),
+        version=agreed_version,
+        serializer=serializer,
+        compressed=bool(want_compression and reply.get('compress')) and agreed_version >= 3,
+    )
 
 
 def negotiate_server(
@@ -95,16 +143,29 @@ def negotiate_server(
     version: int,
     certfile: Optional[str] = None,
     keyfile: Optional[str] = None,
+    features: Iterable[str] = (),
+    deadline: Optional[float] = None,
+    supports_compression: bool = False,
 ) -> HandshakeResult:
     """Run the server side of the handshake against one freshly accepted socket.
 
     Validates the client's HELLO and either replies WELCOME (upgrading to TLS
-    when both sides agree) or REJECT with a stated reason. Never raises.
+    when both sides agree) or REJECT with a stated reason. Of the optional
+    ``features`` the server supports, it accepts those the client offered, and
+    it compresses the connection if asked to and ``supports_compression``.
+    ``deadline`` (a ``time.monotonic()`` value, by default HANDSHAKE_TIMEOUT from
+    now) is when the HELLO must have arrived, so time spent waiting to be
+    negotiated at all counts against it. Never raises.
     """
+    remaining = _remaining(deadline)
+    if remaining <= 0:
+        return HandshakeResult(False, None, 'handshake timed out', timed_out=True)
     previous_timeout = sock.gettimeout()
-    sock.settimeout(HANDSHAKE_TIMEOUT)
+    sock.settimeout(remaining)
     try:
         hello = protocol.read_message(sock)
+    except socket.timeout:
+        return HandshakeResult(False, None, 'handshake timed out', timed_out=True)
     except (OSError, ValueError) as e:
         return HandshakeResult(False, None, f'handshake failed: {e}')
     finally:
@@ -122,10 +183,10 @@ def negotiate_server(
             pass
         return HandshakeResult(False, None, reason, probe=is_probe)
 
-    upgrade = bool(hello.get('tls')) and supports_tls
+    terms = _terms(hello, supports_tls, features, supports_compression)
     try:
-        sock.sendall(protocol.encode({'type': constants.Types.WELCOME, 'tls': upgrade}))
-        if upgrade:
+        sock.sendall(protocol.encode(_welcome(terms)))
+        if terms.tls:
             assert (
                 certfile is not None and keyfile is not None
             ), 'TLS was offered without a configured certificate and key'
@@ -134,15 +195,183 @@ def negotiate_server(
     except OSError as e:  # ssl.SSLError is an OSError subclass
         return HandshakeResult(False, None, f'TLS upgrade failed: {e}', probe=is_probe)
 
-    return HandshakeResult(True, sock, probe=is_probe)
+    return _accepted(sock, is_probe, terms)
+
+
+async def negotiate_server_async(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    require_tls: bool,
+    supports_tls: bool,
+    version: int,
+    certfile: Optional[str] = None,
+    keyfile: Optional[str] = None,
+    features: Iterable[str] = (),
+    deadline: Optional[float] = None,
+    limiter: Optional[asyncio.Semaphore] = None,
+    supports_compression: bool = False,
+) -> HandshakeResult:
+    """The asyncio server's side of :func:`negotiate_server`, on a stream pair.
+
+    Same HELLO/WELCOME/REJECT exchange and the same refusal rules, so a client
+    can't tell the engines apart. A TLS upgrade happens in place on ``writer``,
+    so an ``ok`` result carries no socket: keep using the same reader and writer.
+    Waiting for the HELLO costs nothing here, so ``limiter`` (when given) bounds
+    only the work after it -- the reply and any TLS upgrade.
+    """
+    try:
+        hello = await asyncio.wait_for(
+            protocol.read_message_async(reader), max(0.0, _remaining(deadline))
+        )
+    except asyncio.TimeoutError:
+        return HandshakeResult(False, None, 'handshake timed out', timed_out=True)
+    except (OSError, ValueError, EOFError) as e:
+        return HandshakeResult(False, None, f'handshake failed: {e}')
+
+    if limiter is None:
+        return await _answer_async(
+            hello,
+            writer,
+            require_tls,
+            supports_tls,
+            version,
+            certfile,
+            keyfile,
+            features,
+            supports_compression,
+        )
+    async with limiter:
+        return await _answer_async(
+            hello,
+            writer,
+            require_tls,
+            supports_tls,
+            version,
+            certfile,
+            keyfile,
+            features,
+            supports_compression,
+        )
+
+
+async def _answer_async(
+    hello: dict,
+    writer: asyncio.StreamWriter,
+    require_tls: bool,
+    supports_tls: bool,
+    version: int,
+    certfile: Optional[str],
+    keyfile: Optional[str],
+    features: Iterable[str],
+    supports_compression: bool,
+) -> HandshakeResult:
+    """Reply to a HELLO that has arrived: REJECT it, or WELCOME and maybe upgrade."""
+    is_probe = bool(hello.get('probe'))
+    reason = _refusal(hello, require_tls, supports_tls, version)
+    if reason is not None:
+        try:
+            writer.write(protocol.encode({'type': constants.Types.REJECT, 'reason': reason}))
+            await writer.drain()
+        except OSError:
+            pass
+        return HandshakeResult(False, None, reason, probe=is_probe)
+
+    terms = _terms(hello, supports_tls, features, supports_compression)
+    try:
+        writer.write(protocol.encode(_welcome(terms)))
+        await writer.drain()
+        if terms.tls:
+            assert (
+                certfile is not None and keyfile is not None
+            ), 'TLS was offered without a configured certificate and key'
+            await writer.start_tls(tls.server_context(certfile, keyfile))
+    except OSError as e:  # ssl.SSLError is an OSError subclass
+        return HandshakeResult(False, None, f'TLS upgrade failed: {e}', probe=is_probe)
+
+    return _accepted(None, is_probe, terms)
+
+
+def _remaining(deadline: Optional[float]) -> float:
+    """Seconds left until ``deadline``, or a whole HANDSHAKE_TIMEOUT when there is none."""
+    if deadline is None:
+        return HANDSHAKE_TIMEOUT
+    return deadline - time.monotonic()
+
+
+def _agreed_features(hello: dict, supported: Iterable[str]) -> FrozenSet[str]:
+    """The optional features this HELLO offered that the server also supports."""
+    offered = hello.get('features')
+    if not isinstance(offered, list):
+        return frozenset()
+    return frozenset(name for name in offered if isinstance(name, str)) & frozenset(supported)
+
+
+def _serializer(hello: dict, version: int) -> str:
+    """What to serialize frames with for this HELLO's client: JSON before v3 framing."""
+    if version < 3:
+        return protocol.JSON
+    return protocol.choose_serializer(hello.get('serializers'))
+
+
+class _Terms(NamedTuple):
+    """What a server agreed to in its WELCOME."""
+
+    tls: bool
+    features: FrozenSet[str]
+    version: int
+    serializer: str
+    compress: bool
+
+
+def _terms(
+    hello: dict, supports_tls: bool, features: Iterable[str], supports_compression: bool
+) -> _Terms:
+    """The terms to WELCOME an acceptable HELLO on."""
+    version: int = hello['version']
+    return _Terms(
+        tls=bool(hello.get('tls')) and supports_tls,
+        features=_agreed_features(hello, features),
+        version=version,
+        serializer=_serializer(hello, version),
+        compress=bool(hello.get('compress')) and supports_compression and version >= 3,
+    )
+
+
+def _welcome(terms: _Terms) -> dict:
+    return {
+        'type': constants.Types.WELCOME,
+        'version': terms.version,
+        'tls': terms.tls,
+        'features': sorted(terms.features),
+        'serializer': terms.serializer,
+        'compress': terms.compress,
+    }
+
+
+def _accepted(sock: Optional[socket.socket], is_probe: bool, terms: _Terms) -> HandshakeResult:
+    return HandshakeResult(
+        True,
+        sock,
+        probe=is_probe,
+        features=terms.features,
+        version=terms.version,
+        serializer=terms.serializer,
+        compressed=terms.compress,
+    )
+
+
+def _accepted_versions(version: int) -> FrozenSet[int]:
+    """The HELLO versions a server at ``version`` accepts: its own, and older supported ones."""
+    return frozenset({version}) | frozenset(v for v in protocol.SUPPORTED_VERSIONS if v <= version)
 
 
 def _refusal(hello: dict, require_tls: bool, supports_tls: bool, version: int) -> Optional[str]:
     """Return a rejection reason for this HELLO, or None if it should be accepted."""
     if hello.get('type') != constants.Types.HELLO:
         return 'expected a HELLO to open the connection'
-    if hello.get('version') != version:
-        return f"unsupported protocol version {hello.get('version')} (server speaks {version})"
+    offered = hello.get('version')
+    if not isinstance(offered, int) or offered not in _accepted_versions(version):
+        return f'unsupported protocol version {offered} (server speaks {version})'
     wants_tls = bool(hello.get('tls'))
     if require_tls and not wants_tls:
         return 'server requires TLS'
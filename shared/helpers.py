@@ -31,26 +31,81 @@ def prepare_message(
     )
 
 
+def _history_entries(messages: List[Tuple[int, str, str, str, int]]) -> List[dict]:
+    return [
+        {
+            'type': constants.Types.MESSAGE,
+            'nickname': nickname,
+            'content': message,
+            'color': color,
+            'time': timestamp,
+            'id': message_id,
+        }
+        for message_id, nickname, color, message, timestamp in messages
+    ]
+
+
 def prepare_message_history(messages: List[Tuple[int, str, str, str, int]]) -> bytes:
     """Returns a encoded JSON message history object with the messages provided"""
+    return prepare_json(
+        {'type': constants.Types.MESSAGE_HISTORY, 'messages': _history_entries(messages)}
+    )
+
+
+def prepare_history_page(
+    messages: List[Tuple[int, str, str, str, int]], more: bool, ref: Optional[str] = None
+) -> bytes:
+    """Builds one HISTORY_PAGE frame; ``more`` says whether messages lie beyond it."""
     return prepare_json(
         {
-            'type': constants.Types.MESSAGE_HISTORY,
-            'messages': [
-                {
-                    'type': constants.Types.MESSAGE,
-                    'nickname': nickname,
-                    'content': message,
-                    'color': color,
-                    'time': timestamp,
-                    'id': message_id,
-                }
-                for message_id, nickname, color, message, timestamp in messages
-            ],
+            'type': constants.Types.HISTORY_PAGE,
+            'ref': ref,
+            'messages': _history_entries(messages),
+            'more': more,
         }
     )
 
 
+def prepare_search_results(
+    query: str,
+    page: int,
+    messages: List[Tuple[int, str, str, str, int]],
+    more: bool,
+    error: Optional[str] = None,
+) -> bytes:
+    """Builds a SEARCH_RESULTS frame: one page of hits, best first, or why there are none."""
+    return prepare_json(
+        {
+            'type': constants.Types.SEARCH_RESULTS,
+            'query': query,
+            'page': page,
+            'messages': _history_entries(messages),
+            'more': more,
+            'error': error,
+        }
+    )
+
+
+def prepare_user_list(users: List[dict]) -> bytes:
+    """Builds a USER_LIST frame carrying a room's whole roster."""
+    return prepare_json({'type': constants.Types.USER_LIST, 'users': users})
+
+
+def prepare_user_joined(user: dict) -> bytes:
+    """Builds a USER_JOINED presence delta carrying the newcomer's user-list entry."""
+    return prepare_json({'type': constants.Types.USER_JOINED, 'user': user})
+
+
+def prepare_user_left(user_id: str) -> bytes:
+    """Builds a USER_LEFT presence delta for the user with this id."""
+    return prepare_json({'type': constants.Types.USER_LEFT, 'id': user_id})
+
+
+def prepare_user_renamed(user_id: str, nickname: str) -> bytes:
+    """Builds a USER_RENAMED presence delta giving a user's new nickname."""
+    return prepare_json({'type': constants.Types.USER_RENAMED, 'id': user_id, 'nickname': nickname})
+
+
 def prepare_request(request: str) -> bytes:
     """Helper function for creating a request message."""
     return prepare_json({'type': constants.Types.REQUEST, 'request': request})
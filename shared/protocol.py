@@ -1,33 +1,277 @@
 """Wire protocol framing shared by the server and client.
 
-Messages travel as a fixed-width ASCII length header followed by a UTF-8 JSON
-body. ``socket.recv(n)`` may return fewer than ``n`` bytes, so every read has to
-loop until the whole frame has arrived -- otherwise large message bodies get
-truncated and the JSON fails to parse.
+Every frame is a header followed by a serialized body. How the header looks
+depends on the protocol version the two ends agreed on in their handshake:
+
+* v2 -- a space-padded, 10-character ASCII decimal length, then UTF-8 JSON;
+* v3 -- a 4-byte big-endian length and a 1-byte frame type (``BINARY_HEADER``),
+  the type naming the serializer the body is in.
+
+JSON is always available. msgpack and CBOR join it when their packages
+(``msgpack``, ``cbor2``) are installed; a v3 client lists the serializers it has
+in its HELLO and the server picks one for the connection (see
+:func:`choose_serializer`). A reader needs no such agreement: the frame type
+says how to decode each body.
+
+A v3 connection can also be compressed, both ways, if the HELLO asked for it
+and the server agreed. Each direction is then one zlib stream running across
+frames, so a frame can refer back to the nicknames, colours and keys of those
+before it. Only bodies of at least a threshold go through the stream, flushed
+at the end of each frame so it can be decoded on arrival, and their frame type
+carries ``FLAG_COMPRESSED``; shorter ones are sent as they are. Frames must go
+through a connection's :class:`Compressor` in the order they are written, and
+through its peer's :class:`Decompressor` in the order they are read.
+
+The handshake itself always travels in v2 framing, since neither end knows what
+the other speaks until it is over. Frames are built once, as v2 JSON
+:class:`Frame` values, and :func:`reframe` converts one for a peer speaking
+something else: by swapping the header for v3 JSON, or by serializing the object
+the frame remembers for another serializer. A frame keeps each conversion it
+has made, so a broadcast is serialized once per format among its recipients,
+not once per recipient.
+
+``socket.recv(n)`` may return fewer than ``n`` bytes, so every read has to loop
+until the whole frame has arrived -- otherwise large message bodies get
+truncated and the JSON fails to parse. :func:`read_message` does that with two
+``recv`` calls or more per frame, and reads nothing past the frame, which the
+handshake needs: the socket may be wrapped in TLS right after it. Once a
+connection is streaming, a :class:`FrameReader` takes over, reading whatever
+has arrived into one reusable buffer and handing out every complete frame in
+it, so a burst of frames costs a single ``recv``. A :class:`FrameWriter` does
+the same for the other direction, gathering several frames into one
+``sendmsg``.
 """
 
 import json
-from typing import Any
+import os
+import socket
+import ssl
+import struct
+import zlib
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 
-HEADER_LENGTH = 10
+from shared import constants
+
+HEADER_LENGTH = 10  # the v2 ASCII length header
 
 # Bumped whenever the message envelope changes in a way that isn't backwards
 # compatible. Stamped onto every outgoing dict frame so both ends can tell which
-# revision they are talking to. v2 added the cleartext connection handshake.
-PROTOCOL_VERSION = 2
+# revision they are talking to. v2 added the cleartext connection handshake, v3
+# the binary frame header.
+PROTOCOL_VERSION = 3
+
+# The versions a current server still accepts, oldest first.
+SUPPORTED_VERSIONS = (2, 3)
+
+LEGACY_VERSION = 2  # framing of the handshake, and of every frame built before reframe()
+
+BINARY_HEADER = struct.Struct('>IB')  # v3: body length, frame type
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')  # most buffers one sendmsg takes
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# Frame types carried in a v3 header, one per serializer; a v2 frame is always JSON.
+FRAME_JSON = 1
+FRAME_MSGPACK = 2
+FRAME_CBOR = 3
+FLAG_COMPRESSED = 0x80  # set on the type of a frame whose body went through the zlib stream
+
+JSON, MSGPACK, CBOR = 'json', 'msgpack', 'cbor'
+# Fastest first; the server picks by this order. cbor2 is slower than the stdlib's
+# json on all but the smallest frames (benchmarks/bench_codecs.py), so CBOR is
+# only chosen for a client that offers nothing else.
+PREFERENCE = (MSGPACK, JSON, CBOR)
+
+
+class Serializer(NamedTuple):
+    name: str
+    frame_type: int
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes], Any]
+
+
+_serializers: Dict[str, Serializer] = {}
+_by_frame_type: Dict[int, Serializer] = {}
+
+
+def register(serializer: Serializer) -> None:
+    """Make ``serializer`` available to encode with and to decode its frame type."""
+    if not 0 < serializer.frame_type < FLAG_COMPRESSED:
+        raise ValueError(f'frame type {serializer.frame_type} is out of range')
+    _serializers[serializer.name] = serializer
+    _by_frame_type[serializer.frame_type] = serializer
+
+
+def serializers() -> List[str]:
+    """The names of the available serializers, in order of preference."""
+    ranked = [name for name in PREFERENCE if name in _serializers]
+    return ranked + sorted(set(_serializers) - set(ranked))
+
+
+def choose_serializer(offered: Any) -> str:
+    """The preferred serializer among those a HELLO ``offered``; JSON if it named none we have."""
+    if isinstance(offered, list):
+        for name in serializers():
+            if name in offered:
+                return name
+    return JSON
+
+
+def _register_builtin() -> None:
+    register(Serializer(JSON, FRAME_JSON, lambda obj: json.dumps(obj).encode('utf-8'), json.loads))
+    try:
+        import msgpack
+    except ImportError:
+        pass
+    else:
+        register(
+            Serializer(
+                MSGPACK, FRAME_MSGPACK, msgpack.packb, lambda body: msgpack.unpackb(body, raw=False)
+            )
+        )
+    try:
+        import cbor2
+    except ImportError:
+        pass
+    else:
+        register(Serializer(CBOR, FRAME_CBOR, cbor2.dumps, cbor2.loads))
+
+
+_register_builtin()
+
+
+class Frame(bytes):
+    """A v2 JSON frame that keeps the object it encodes, and its other encodings.
+
+    Reframing it for a peer on another serializer starts from :attr:`message`
+    instead of parsing the JSON back, and each result is kept in
+    :attr:`variants` for the next peer that wants the same.
+    """
+
+    message: Any
+    variants: Dict[Tuple[int, str], bytes]
+
+
+class Compressor:
+    """The sending half of a compressed connection: turns v3 frames into what goes on the wire.
+
+    :attr:`raw` and :attr:`wire` count the bytes handed in and out.
+    """
+
+    def __init__(self, threshold: int = constants.COMPRESSION_THRESHOLD) -> None:
+        self.threshold = threshold
+        self.raw = self.wire = 0
+        self._stream = zlib.compressobj()
+
+    def compress(self, frame: bytes) -> bytes:
+        self.raw += len(frame)
+        length, kind = BINARY_HEADER.unpack_from(frame)
+        if length >= self.threshold:
+            body = memoryview(frame)[BINARY_HEADER.size :]
+            # Whatever the stream has taken in must reach the peer's stream too,
+            # so the result is sent even in the rare case it came out longer.
+            packed = self._stream.compress(body) + self._stream.flush(zlib.Z_SYNC_FLUSH)
+            frame = BINARY_HEADER.pack(len(packed), kind | FLAG_COMPRESSED) + packed
+        self.wire += len(frame)
+        return frame
+
+
+class Decompressor:
+    """The receiving half of a compressed connection, for the bodies flagged compressed."""
 
+    def __init__(self) -> None:
+        self._stream = zlib.decompressobj()
 
-def encode(obj: Any) -> bytes:
-    """Encode an object as a length-prefixed UTF-8 JSON frame.
+    def decompress(self, body: bytes) -> bytes:
+        try:
+            return self._stream.decompress(body)
+        except zlib.error as e:
+            raise ValueError(f'corrupt compressed frame: {e}')
+
+
+def header_length(version: int) -> int:
+    """How many bytes the frame header takes at ``version``."""
+    return BINARY_HEADER.size if version >= 3 else HEADER_LENGTH
+
+
+def parse_header(header: bytes, version: int) -> Tuple[int, int]:
+    """The frame type and body length a header announces; ValueError if it is malformed.
+
+    A length beyond ``constants.MAX_FRAME_SIZE`` is refused before anything is
+    allocated for the body, so a peer cannot make a reader reserve gigabytes
+    with a few bytes of header.
+    """
+    if version < 3:
+        kind, length = FRAME_JSON, int(header.decode('utf-8'))
+    else:
+        length, kind = BINARY_HEADER.unpack(header)
+        if kind & ~FLAG_COMPRESSED not in _by_frame_type:
+            raise ValueError(f'unknown frame type {kind}')
+    if not 0 <= length <= constants.MAX_FRAME_SIZE:
+        raise ValueError(f'frame length {length} out of range')
+    return kind, length
+
+
+def decode(body: bytes, kind: int = FRAME_JSON, decompressor: Optional[Decompressor] = None) -> Any:
+    """The object a frame body of type ``kind`` holds; ValueError if it does not parse.
+
+    A compressed body goes through ``decompressor`` first; without one it is refused.
+    """
+    if kind & FLAG_COMPRESSED:
+        if decompressor is None:
+            raise ValueError('compressed frame on an uncompressed connection')
+        body, kind = decompressor.decompress(body), kind & ~FLAG_COMPRESSED
+    try:
+        return _by_frame_type[kind].loads(body)
+    except Exception as e:  # each package has its own decode errors
+        raise ValueError(f'undecodable frame body: {e}') from e
+
+
+def encode(obj: Any, version: int = LEGACY_VERSION, serializer: str = JSON) -> bytes:
+    """Encode an object as a length-prefixed frame; a :class:`Frame` in v2 framing.
 
     Dict frames are stamped with the protocol version under the ``v`` key unless
     they already carry one. The input object is left untouched.
     """
     if isinstance(obj, dict) and 'v' not in obj:
         obj = dict(obj, v=PROTOCOL_VERSION)
+    if version >= 3:
+        chosen = _serializers[serializer]
+        body = chosen.dumps(obj)
+        return BINARY_HEADER.pack(len(body), chosen.frame_type) + body
+    if serializer != JSON:
+        raise ValueError(f'v{version} frames can only be JSON, not {serializer}')
     body = json.dumps(obj).encode('utf-8')
     header = '{:<{width}}'.format(len(body), width=HEADER_LENGTH).encode('utf-8')
-    return header + body
+    frame = Frame(header + body)
+    frame.message, frame.variants = obj, {}
+    return frame
+
+
+def reframe(frame: bytes, version: int, serializer: str = JSON) -> bytes:
+    """A v2 ``frame`` as a peer speaking ``version`` and ``serializer`` expects it.
+
+    That is the frame itself for v2. Any other bytes than a :class:`Frame` are
+    converted from scratch each time, their JSON parsed back if need be.
+    """
+    if version < 3:
+        return frame
+    variants: Optional[Dict[Tuple[int, str], bytes]] = getattr(frame, 'variants', None)
+    if variants is not None:
+        converted = variants.get((version, serializer))
+        if converted is not None:
+            return converted
+    if serializer == JSON:
+        body = memoryview(frame)[HEADER_LENGTH:]
+        converted = BINARY_HEADER.pack(len(body), FRAME_JSON) + body
+    else:
+        message = frame.message if isinstance(frame, Frame) else json.loads(frame[HEADER_LENGTH:])
+        converted = encode(message, version, serializer)
+    if variants is not None:
+        variants[(version, serializer)] = converted
+    return converted
 
 
 def recv_exact(sock, length: int) -> bytes:
@@ -47,9 +291,138 @@ def recv_exact(sock, length: int) -> bytes:
     return b''.join(chunks)
 
 
-def read_message(sock) -> dict:
-    """Read and decode a single length-prefixed JSON frame from the socket."""
-    header = recv_exact(sock, HEADER_LENGTH).decode('utf-8')
-    length = int(header)
-    body = recv_exact(sock, length).decode('utf-8')
-    return json.loads(body)
+class FrameReader:
+    """Reads the frames arriving on a socket through one buffer that is reused throughout.
+
+    :attr:`recvs` counts the ``recv_into`` calls made, :attr:`received` the bytes.
+    """
+
+    def __init__(self, sock, version: int = LEGACY_VERSION, size: int = 64 * 1024) -> None:
+        self.sock, self.version, self.size = sock, version, size
+        self.recvs = self.received = 0
+        self._header = header_length(version)
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = self._end = 0  # the unread bytes are _buffer[_start:_end]
+
+    @property
+    def buffered(self) -> int:
+        """How many bytes have arrived that no frame handed out has taken yet."""
+        return self._end - self._start
+
+    def read_frame(self) -> Tuple[int, bytes]:
+        """The next frame's type and (still encoded) body, reading only when none is buffered.
+
+        Raises ConnectionError if the peer closes the connection, OSError if
+        reading fails, and ValueError for a malformed header.
+        """
+        self._want(self._header)
+        kind, length = parse_header(
+            bytes(self._view[self._start : self._start + self._header]), self.version
+        )
+        self._want(self._header + length)
+        body_start = self._start + self._header
+        self._start = body_start + length
+        body = bytes(self._view[body_start : self._start])
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buffer) > self.size:  # let go of the room an outsized frame took
+                self._replace(bytearray(self.size))
+        return kind, body
+
+    def frames(self) -> Iterator[Tuple[int, bytes]]:
+        """Every frame as :meth:`read_frame` returns it, until reading fails."""
+        while True:
+            yield self.read_frame()
+
+    def _want(self, length: int) -> None:
+        """Receive until at least ``length`` unread bytes are buffered."""
+        while self._end - self._start < length:
+            if self._start + length > len(self._buffer):
+                self._make_room(length)
+            received = self.sock.recv_into(self._view[self._end :])
+            if not received:
+                raise ConnectionError('connection closed before frame was complete')
+            self.recvs += 1
+            self.received += received
+            self._end += received
+
+    def _make_room(self, length: int) -> None:
+        """Move the unread bytes to the front, growing the buffer if ``length`` won't fit."""
+        unread = self._end - self._start
+        if length > len(self._buffer):
+            buffer = bytearray(max(length, 2 * len(self._buffer)))
+            buffer[:unread] = self._view[self._start : self._end]
+            self._replace(buffer)
+        else:
+            self._view[:unread] = self._view[self._start : self._end]
+        self._start, self._end = 0, unread
+
+    def _replace(self, buffer: bytearray) -> None:
+        self._view.release()
+        self._buffer, self._view = buffer, memoryview(buffer)
+
+
+class FrameWriter:
+    """Writes frames to a socket whole, gathering several into each ``sendmsg``.
+
+    ``send`` and ``sendmsg`` may take only part of what they are given; the
+    writer carries on from wherever the last call stopped. TLS sockets have no
+    ``sendmsg``, so frames for one are joined and sent with ``send``, as is a
+    lone frame, for which ``send`` is the cheaper call.
+    :attr:`sends` counts the calls made.
+    """
+
+    def __init__(self, sock) -> None:
+        self.sock = sock
+        self.sends = 0
+        self._gather = hasattr(sock, 'sendmsg') and not isinstance(sock, ssl.SSLSocket)
+
+    def write(
+        self, frames: Sequence[bytes], keep_trying: Optional[Callable[[], bool]] = None
+    ) -> None:
+        """Write all of ``frames``, in order.
+
+        A socket timeout only means the peer is reading slowly: with
+        ``keep_trying`` the write resumes for as long as it returns True, and
+        without it the timeout propagates.
+        """
+        if not self._gather:
+            frames = [b''.join(frames)] if len(frames) > 1 else frames
+        views = [memoryview(frame) for frame in frames if frame]
+        first = 0  # views before this one are written
+        while first < len(views):
+            try:
+                if self._gather and len(views) - first > 1:
+                    sent = self.sock.sendmsg(views[first : first + IOV_MAX])
+                else:
+                    sent = self.sock.send(views[first])
+            except socket.timeout:
+                if keep_trying is None or not keep_trying():
+                    raise
+                continue
+            self.sends += 1
+            while sent and sent >= len(views[first]):
+                sent -= len(views[first])
+                first += 1
+            if sent:
+                views[first] = views[first][sent:]
+
+
+def read_message(
+    sock, version: int = LEGACY_VERSION, decompressor: Optional[Decompressor] = None
+) -> dict:
+    """Read and decode a single length-prefixed frame from the socket."""
+    kind, length = parse_header(recv_exact(sock, header_length(version)), version)
+    return decode(recv_exact(sock, length), kind, decompressor)
+
+
+async def read_message_async(reader, version: int = LEGACY_VERSION) -> dict:
+    """Read and decode a single frame from an ``asyncio.StreamReader``.
+
+    The coroutine twin of :func:`read_message`; ``readexactly`` does the looping
+    that :func:`recv_exact` does by hand, raising ``asyncio.IncompleteReadError``
+    (an EOFError) if the peer closes mid-frame.
+    """
+    kind, length = parse_header(await reader.readexactly(header_length(version)), version)
+    return decode(await reader.readexactly(length), kind)
@@ -0,0 +1,96 @@
+import gzip
+import json
+
+import pytest
+
+import launch
+from server import archive
+from server import db
+from server.archive import Selection
+
+
+@pytest.fixture
+def database(tmp_path):
+    path = str(tmp_path / 'server.db')
+    database = db.ServerDatabase(path)
+    for n in range(25):
+        database.add_message('alice', 'a', '#000000', f'general {n}', 1000 + n)
+        database.add_message('bob', 'b', '#ffffff', f'games {n}', 1000 + n, 'games')
+    database.close()
+    yield path
+    db.close_writers()
+    db.close_pools()
+
+
+def messages(path, room):
+    return [row[3] for row in db.MessageStore(path).recent_messages(room, 0, 1000)]
+
+
+def test_an_export_imports_back_into_an_empty_database(database, tmp_path):
+    archive_path = str(tmp_path / 'messages.jsonl.gz')
+    assert archive.export_messages(archive_path, database, batch=7) == 50
+    with gzip.open(archive_path, 'rt') as lines:
+        first = json.loads(next(lines))
+    assert first == {
+        'room': 'general',
+        'nickname': 'alice',
+        'hash': 'a',
+        'color': '#000000',
+        'message': 'general 0',
+        'time': 1000,
+        'id': 1,
+    }
+
+    copy = str(tmp_path / 'copy.db')
+    assert archive.import_messages(archive_path, copy, batch=7) == 50
+    assert messages(copy, 'games') == messages(database, 'games')
+    assert messages(copy, 'general') == messages(database, 'general')
+    assert db.MessageStore(copy).search_messages('games', ['24'], 0, 10)  # indexed as it went in
+
+
+def test_exports_and_imports_select_by_room_and_time(database, tmp_path):
+    archive_path = str(tmp_path / 'messages.jsonl.gz')
+    assert archive.export_messages(archive_path, database, Selection(('games',), 1010)) == 15
+    copy = str(tmp_path / 'copy.db')
+    assert archive.import_messages(archive_path, copy, Selection(until=1012)) == 2
+    assert messages(copy, 'games') == ['games 10', 'games 11']
+    assert messages(copy, 'general') == []
+
+
+def test_an_export_reads_one_snapshot_while_messages_keep_arriving(database, tmp_path):
+    with db.shared_pool(database).borrow() as conn:
+        conn.execute('BEGIN')
+        conn.execute('SELECT COUNT(*) FROM message').fetchone()  # the snapshot starts here
+        db.MessageStore(database).add_message('carol', 'c', '#000000', 'late', 2000)
+        assert conn.execute('SELECT COUNT(*) FROM message').fetchone()[0] == 50
+        conn.execute('COMMIT')
+    # The writer committed while the reader held its snapshot; an export is one such read.
+    assert archive.export_messages(str(tmp_path / 'all.jsonl.gz'), database) == 51
+
+
+def test_a_bad_line_stops_the_import_after_the_batches_before_it(tmp_path):
+    archive_path = str(tmp_path / 'broken.jsonl.gz')
+    record = {'room': 'general', 'nickname': 'a', 'hash': 'a', 'color': '#000000', 'time': 1}
+    with gzip.open(archive_path, 'wt') as out:
+        for n in range(3):
+            out.write(json.dumps(dict(record, message=f'm{n}')) + '\n')
+        out.write('{"room": "general"}\n')
+    copy = str(tmp_path / 'copy.db')
+    with pytest.raises(ValueError, match='line 4 has no nickname'):
+        archive.import_messages(archive_path, copy, batch=2)
+    assert messages(copy, 'general') == ['m0', 'm1']
+    db.close_pools()
+
+
+def test_the_archive_command_exports_from_the_command_line(database, tmp_path):
+    archive_path = str(tmp_path / 'cli.jsonl.gz')
+    launch.main(
+        ['archive', 'export', archive_path, '--database', database, '--room', 'general']
+        + ['--since', '1020']
+    )
+    with gzip.open(archive_path, 'rt') as lines:
+        assert [json.loads(line)['message'] for line in lines] == [
+            f'general {n}' for n in range(20, 25)
+        ]
+    with pytest.raises(SystemExit, match='neither an epoch timestamp'):
+        launch.main(['archive', 'import', archive_path, '--since', 'yesterday'])
@@ -0,0 +1,144 @@
+"""The asyncio engine against the unchanged client, over real sockets.
+
+The same ClientCore and handshake the GUI uses connect to ``server.aio`` here, so
+any drift between the two engines' protocol shows up as a failing test.
+"""
+
+import socket
+import time
+
+import pytest
+
+from client import core
+from server import metrics
+from shared import constants
+from shared import handshake
+from shared import protocol
+
+
+def _events_until(stream, predicate):
+    """Consume events until ``predicate`` matches one, failing on a disconnect.
+
+    Takes the event stream rather than the core: abandoning a stream closes the
+    connection, so each test keeps one alive for as long as it talks.
+    """
+    for event in stream:
+        if event.type == core.DISCONNECTED:
+            pytest.fail('disconnected before the expected event arrived')
+        if predicate(event):
+            return event
+
+
+def _has_user(nickname):
+    return lambda event: event.type == core.USER_LIST and nickname in {
+        u['nickname'] for u in event.payload['users']
+    }
+
+
+def test_client_core_connects_and_sees_itself(boot_server):
+    boot_server(56311, engine='asyncio')
+
+    c = core.ClientCore('127.0.0.1', 56311, 'alice')
+    assert c.connect().ok
+    c.sock.settimeout(3.0)
+    try:
+        _events_until(c.events(), _has_user('alice'))
+    finally:
+        c.close()
+
+
+def test_message_is_broadcast_to_the_room(boot_server):
+    boot_server(56312, engine='asyncio')
+
+    alice = core.ClientCore('127.0.0.1', 56312, 'alice')
+    bob = core.ClientCore('127.0.0.1', 56312, 'bob')
+    assert alice.connect().ok and bob.connect().ok
+    alice.sock.settimeout(3.0)
+    bob.sock.settimeout(3.0)
+    alice_events, bob_events = alice.events(), bob.events()
+    try:
+        _events_until(alice_events, _has_user('alice'))
+        _events_until(bob_events, _has_user('bob'))
+        alice.send_message('hello bob')
+        event = _events_until(
+            bob_events, lambda e: e.type == core.MESSAGE and e.payload['message'] == 'hello bob'
+        )
+        assert event.payload['nickname'] == 'alice'
+    finally:
+        alice.close()
+        bob.close()
+
+
+def test_commands_run_on_the_event_loop(boot_server):
+    boot_server(56313, engine='asyncio')
+
+    c = core.ClientCore('127.0.0.1', 56313, 'alice')
+    assert c.connect().ok
+    c.sock.settimeout(3.0)
+    stream = c.events()
+    try:
+        _events_until(stream, _has_user('alice'))
+        c.send_message('/rooms')
+        _events_until(
+            stream, lambda e: e.type == core.MESSAGE and 'Active rooms' in e.payload['message']
+        )
+    finally:
+        c.close()
+
+
+def test_tls_client_upgrades(self_signed, boot_server):
+    cert, key = self_signed
+    boot_server(56314, use_tls=True, cert=cert, key=key, engine='asyncio')
+
+    raw = socket.create_connection(('127.0.0.1', 56314))
+    result = handshake.negotiate_client(
+        raw,
+        want_tls=True,
+        version=protocol.PROTOCOL_VERSION,
+        verify=False,
+        server_hostname='localhost',
+    )
+    assert result.ok
+    assert protocol.read_message(result.sock, result.version)['type'] == constants.Types.REQUEST
+    result.sock.close()
+
+
+def test_mismatches_are_rejected_with_a_reason(boot_server):
+    boot_server(56315, engine='asyncio')
+
+    result = core.ClientCore('127.0.0.1', 56315, 'alice', use_tls=True).connect()
+    assert not result.ok
+    assert result.permanent
+    assert 'does not support TLS' in result.reason
+
+    assert core.probe('127.0.0.1', 56315).ok
+
+
+def test_timed_out_handshakes_are_counted(boot_server, monkeypatch):
+    monkeypatch.setattr(handshake, 'HANDSHAKE_TIMEOUT', 0.2)
+    counters = metrics.handshake_counters()
+    boot_server(56316, engine='asyncio', handshakes=counters)
+
+    silent = socket.create_connection(('127.0.0.1', 56316))
+    try:
+        # A silent peer must not hold up a real client meanwhile.
+        assert core.probe('127.0.0.1', 56316).ok
+        end = time.time() + 3.0
+        while counters['timed_out'] == 0 and time.time() < end:
+            time.sleep(0.05)
+        assert counters['timed_out'] == 1
+    finally:
+        silent.close()
+
+
+def test_silent_peers_do_not_hold_handshake_slots(boot_server):
+    boot_server(56317, engine='asyncio', max_handshakes=1)
+
+    silent = [socket.create_connection(('127.0.0.1', 56317)) for _ in range(4)]
+    try:
+        started = time.time()
+        assert core.probe('127.0.0.1', 56317).ok
+        assert time.time() - started < 2.0
+    finally:
+        for peer in silent:
+            peer.close()
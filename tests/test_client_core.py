@@ -6,6 +6,8 @@ object, and a connection bug shows up here instead of only in manual play.
 """
 
 import socket
+import threading
+import time
 
 import pytest
 
@@ -32,6 +34,23 @@ def test_core_answers_a_nick_request():
     assert reply['nickname'] == 'zara'
 
 
+def test_core_applies_presence_deltas_to_its_roster():
+    c = core.ClientCore('host', 1, 'nick')
+    alice = {'id': 'a', 'nickname': 'alice', 'color': '#000000'}
+    bob = {'id': 'b', 'nickname': 'bob', 'color': '#ffffff'}
+
+    def users(message):
+        (event,) = c._dispatch(message)
+        assert event.type == core.USER_LIST
+        return event.payload['users']
+
+    assert users({'type': constants.Types.USER_LIST, 'users': [alice]}) == [alice]
+    assert users({'type': constants.Types.USER_JOINED, 'user': bob}) == [alice, bob]
+    renamed = users({'type': constants.Types.USER_RENAMED, 'id': 'a', 'nickname': 'al'})
+    assert [u['nickname'] for u in renamed] == ['al', 'bob']
+    assert users({'type': constants.Types.USER_LEFT, 'id': 'b'}) == [dict(alice, nickname='al')]
+
+
 def test_connect_failure_is_reported_not_raised():
     # Reserve a port and release it so nothing is listening there.
     spare = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -108,3 +127,77 @@ def test_backoff_advances_and_resets():
 
     c.reset_backoff()
     assert c.next_reconnect_delay() <= first  # a fresh sequence starts over
+
+
+def test_history_pages_are_fetched_as_they_are_asked_for(boot_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(constants, 'SERVER_DATABASE', str(tmp_path / 'server.db'))
+    boot_server(56234)
+
+    c = core.ClientCore('127.0.0.1', 56234, 'alice')
+    assert c.connect().ok
+    assert constants.Features.HISTORY_PAGES in c.features
+    c.sock.settimeout(3.0)
+    seen = []
+    joined = threading.Event()
+
+    def read():
+        for event in c.events():
+            if event.type == core.USER_LIST:
+                joined.set()
+            elif event.type == core.MESSAGE:
+                seen.append(event.payload['id'])
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        assert joined.wait(3.0)
+        for n in range(5):
+            c.send_message(f'message {n}')
+        deadline = time.time() + 3.0
+        while len(seen) < 5 and time.time() < deadline:
+            time.sleep(0.01)
+
+        pages = c.history_pages(before_id=seen[-1], page_size=2)
+        assert not c._pagers  # nothing is asked for until the first page is wanted
+        assert [m['message'] for m in next(pages)] == ['message 2', 'message 3']
+        assert [m['message'] for m in next(pages)] == ['message 0', 'message 1']
+        older = [m['message'] for page in pages for m in page]  # join notices, to the start
+        assert 'alice joined!' in older and not c._pagers
+    finally:
+        c.close()
+
+
+def test_a_compressed_connection_reports_both_byte_counts(boot_server):
+    boot_server(56235)
+
+    c = core.ClientCore('127.0.0.1', 56235, 'alice', compress=True)
+    result = c.connect()
+    assert result.ok and result.compressed
+    c.sock.settimeout(3.0)
+    text = ' '.join(['the same long line, over and over.'] * 20)
+    echoes = 0
+    try:
+        for event in c.events():
+            if event.type == core.USER_LIST and not echoes:
+                c.send_message(text)
+                c.send_message(text)
+            elif event.type == core.MESSAGE and event.payload['message'] == text:
+                echoes += 1
+                if echoes == 2:
+                    break
+            elif event.type == core.DISCONNECTED:
+                pytest.fail('disconnected before the messages echoed back')
+    finally:
+        c.close()
+    stats = c.stats()
+    assert stats['sent'] < stats['sent_uncompressed']
+    assert stats['received'] < stats['received_uncompressed']
+
+
+def test_a_server_can_refuse_compression(boot_server):
+    boot_server(56236, compression=False)
+
+    c = core.ClientCore('127.0.0.1', 56236, 'alice', compress=True)
+    result = c.connect()
+    c.close()
+    assert result.ok and not result.compressed
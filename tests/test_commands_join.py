@@ -3,6 +3,7 @@ import socket
 from shared import constants
 from shared import protocol
 from server.handler import Client
+from server.registry import ConnectionRegistry
 
 
 class FakeDB:
@@ -16,19 +17,21 @@ def make_client(clients, nickname, room=constants.DEFAULT_ROOM):
     client.nickname = nickname
     client.room = room
     client.db = FakeDB()
-    clients.append(client)
+    clients.add(client)
     return client, peer
 
 
 def test_join_moves_client_to_the_new_room():
-    clients = []
+    clients = ConnectionRegistry()
     alice, _ = make_client(clients, 'alice')
     alice.command.process(['join', 'games'])
     assert alice.room == 'games'
+    assert clients.rooms.members('games') == (alice,)
+    assert clients.rooms.members(constants.DEFAULT_ROOM) == ()
 
 
 def test_join_announces_departure_to_the_old_room():
-    clients = []
+    clients = ConnectionRegistry()
     alice, _ = make_client(clients, 'alice')
     bob, bob_peer = make_client(clients, 'bob')
     bob_peer.settimeout(0.5)
@@ -44,7 +47,7 @@ def test_join_announces_departure_to_the_old_room():
 
 
 def test_join_rejects_the_current_room():
-    clients = []
+    clients = ConnectionRegistry()
     alice, _ = make_client(clients, 'alice', room='general')
     assert alice.command.process(['join', 'general']) == 'You are already in general.'
     assert alice.command.process(['join']) == 'Usage: /join <room>'
@@ -1,6 +1,7 @@
 import socket
 
 from server.handler import Client
+from server.registry import ConnectionRegistry
 
 
 def make_client(clients, nickname, room):
@@ -8,12 +9,12 @@ def make_client(clients, nickname, room):
     client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False)
     client.nickname = nickname
     client.room = room
-    clients.append(client)
+    clients.add(client)
     return client
 
 
 def test_rooms_lists_active_rooms_with_counts():
-    clients = []
+    clients = ConnectionRegistry()
     alice = make_client(clients, 'alice', 'general')
     make_client(clients, 'bob', 'general')
     make_client(clients, 'carol', 'games')
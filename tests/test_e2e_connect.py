@@ -55,7 +55,7 @@ def test_plaintext_client_to_plaintext_server_connects():
     _start_server(56120, use_tls=False)
     result = _connect(56120, want_tls=False)
     assert result.ok
-    assert protocol.read_message(result.sock)['type'] == constants.Types.REQUEST
+    assert protocol.read_message(result.sock, result.version)['type'] == constants.Types.REQUEST
 
 
 def test_tls_client_to_tls_server_connects(self_signed, monkeypatch):
@@ -63,7 +63,7 @@ def test_tls_client_to_tls_server_connects(self_signed, monkeypatch):
     _start_server(56121, use_tls=True, cert=cert, key=key, monkeypatch=monkeypatch)
     result = _connect(56121, want_tls=True)
     assert result.ok
-    assert protocol.read_message(result.sock)['type'] == constants.Types.REQUEST
+    assert protocol.read_message(result.sock, result.version)['type'] == constants.Types.REQUEST
 
 
 def test_plaintext_client_to_tls_server_is_rejected(self_signed, monkeypatch):
@@ -86,3 +86,27 @@ def test_version_skew_is_rejected():
     result = _connect(56124, want_tls=False, version=VERSION + 999)
     assert not result.ok
     assert 'version' in result.reason.lower()
+
+
+def _next_message(sock, version):
+    """Skip ahead to the next MESSAGE frame, e.g. past requests and user lists."""
+    while True:
+        frame = protocol.read_message(sock, version)
+        if frame['type'] == constants.Types.MESSAGE:
+            return frame
+
+
+def test_v2_and_v3_clients_share_a_room():
+    _start_server(56125, use_tls=False)
+    old = _connect(56125, want_tls=False, version=2)
+    new = _connect(56125, want_tls=False)
+    assert (old.version, new.version) == (2, 3)
+    for result in (old, new):
+        result.sock.settimeout(5.0)
+        assert protocol.read_message(result.sock, result.version)['type'] == constants.Types.REQUEST
+
+    old.sock.sendall(protocol.encode({'type': constants.Types.MESSAGE, 'content': 'from v2'}))
+    assert _next_message(new.sock, new.version)['content'] == 'from v2'
+    new.sock.sendall(protocol.encode({'type': constants.Types.MESSAGE, 'content': 'from v3'}, 3))
+    contents = [_next_message(old.sock, old.version)['content'] for _ in range(2)]
+    assert contents == ['from v2', 'from v3']  # its own message comes back first
@@ -1,9 +1,13 @@
 import socket
+import threading
 
 import pytest
 
 from shared import protocol
+from server import db
+from server import search
 from server.handler import Client
+from server.registry import ConnectionRegistry
 
 
 def make_client(clients, nickname, room='general'):
@@ -11,12 +15,12 @@ def make_client(clients, nickname, room='general'):
     client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False)
     client.nickname = nickname
     client.room = room
-    clients.append(client)
+    clients.add(client)
     return client, peer
 
 
 def test_bare_slash_is_not_treated_as_a_command():
-    clients = []
+    clients = ConnectionRegistry()
     alice, alice_peer = make_client(clients, 'alice')
     alice_peer.settimeout(0.2)
 
@@ -29,7 +33,7 @@ def test_bare_slash_is_not_treated_as_a_command():
 
 
 def test_slash_with_only_whitespace_is_not_treated_as_a_command():
-    clients = []
+    clients = ConnectionRegistry()
     alice, alice_peer = make_client(clients, 'alice')
     alice_peer.settimeout(0.2)
 
@@ -40,7 +44,7 @@ def test_slash_with_only_whitespace_is_not_treated_as_a_command():
 
 
 def test_slash_command_still_runs_and_replies():
-    clients = []
+    clients = ConnectionRegistry()
     alice, alice_peer = make_client(clients, 'alice')
     alice.connect_database()  # broadcasting a reply records it, as in the real loop
 
@@ -48,3 +52,36 @@ def test_slash_command_still_runs_and_replies():
 
     reply = protocol.read_message(alice_peer)
     assert 'Active rooms' in reply['content']
+
+
+def test_search_hits_go_to_the_searcher_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr('shared.constants.SERVER_DATABASE', str(tmp_path / 'server.db'))
+    clients = ConnectionRegistry()
+    alice, alice_peer = make_client(clients, 'alice')
+    _, bob_peer = make_client(clients, 'bob')
+    alice.connect_database()
+    try:
+        for n in range(12):
+            alice.db.add_message('bob', 'b', '#000000', f'release {n} is out', n)
+
+        searched = threading.Event()
+        when_done = alice.when_done
+        monkeypatch.setattr(
+            alice,
+            'when_done',
+            lambda future, callback: when_done(future, lambda f: (callback(f), searched.set())),
+        )
+        alice.process_command('/search release out #2')
+        assert searched.wait(5)  # answered from a search thread
+
+        reply = protocol.read_message(alice_peer)
+        assert reply['type'] == 'SEARCH_RESULTS'
+        assert (reply['query'], reply['page'], reply['more']) == ('release out', 2, False)
+        assert len(reply['messages']) == 2
+        bob_peer.settimeout(0.2)
+        with pytest.raises(socket.timeout):
+            protocol.read_message(bob_peer)
+    finally:
+        search.close_searches()
+        db.close_writers()
+        db.close_pools()
@@ -5,11 +5,12 @@ import pytest
 from shared import protocol
 from shared.exceptions import DataReceptionException
 from server.handler import Client
+from server.registry import ConnectionRegistry
 
 
 def make_client():
     server_end, client_end = socket.socketpair()
-    client = Client(server_end, ('127.0.0.1', 5555), [], lambda: False)
+    client = Client(server_end, ('127.0.0.1', 5555), ConnectionRegistry(), lambda: False)
     return client, client_end
 
 
@@ -34,3 +35,10 @@ def test_receive_raises_on_a_closed_connection():
     peer.close()
     with pytest.raises(DataReceptionException):
         client.receive()
+
+
+def test_receive_hands_out_frames_that_arrived_together():
+    client, peer = make_client()
+    peer.sendall(b''.join(protocol.encode({'type': 'MESSAGE', 'content': n}) for n in range(3)))
+    assert [client.receive()['content'] for _ in range(3)] == [0, 1, 2]
+    assert client.frame_reader.recvs == 1
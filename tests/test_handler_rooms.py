@@ -2,8 +2,10 @@ import socket
 
 import pytest
 
+from shared import constants
 from shared import protocol
 from server.handler import Client
+from server.registry import ConnectionRegistry
 
 
 def make_client(clients, nickname, room='general'):
@@ -11,12 +13,12 @@ def make_client(clients, nickname, room='general'):
     client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False)
     client.nickname = nickname
     client.room = room
-    clients.append(client)
+    clients.add(client)
     return client, peer
 
 
 def test_send_connections_list_only_includes_roommates():
-    clients = []
+    clients = ConnectionRegistry()
     alice, alice_peer = make_client(clients, 'alice', room='general')
     make_client(clients, 'bob', room='general')
     make_client(clients, 'carol', room='games')
@@ -28,7 +30,7 @@ def test_send_connections_list_only_includes_roommates():
 
 
 def test_notify_room_reaches_every_member_of_that_room():
-    clients = []
+    clients = ConnectionRegistry()
     alice, alice_peer = make_client(clients, 'alice', room='general')
     bob, bob_peer = make_client(clients, 'bob', room='general')
     carol, carol_peer = make_client(clients, 'carol', room='games')
@@ -43,7 +45,7 @@ def test_notify_room_reaches_every_member_of_that_room():
 
 
 def test_notify_room_survives_and_prunes_a_dead_member():
-    clients = []
+    clients = ConnectionRegistry()
     alice, alice_peer = make_client(clients, 'alice', room='general')
     zombie, _ = make_client(clients, 'zombie', room='general')
     zombie.conn.close()  # server-side fd is gone; sending to it raises EBADF
@@ -54,10 +56,11 @@ def test_notify_room_survives_and_prunes_a_dead_member():
 
     # ...and the unreachable client should be pruned from the connection list.
     assert zombie not in clients
+    assert zombie not in clients.rooms
 
 
 def test_broadcast_survives_and_prunes_a_dead_member():
-    clients = []
+    clients = ConnectionRegistry()
     alice, alice_peer = make_client(clients, 'alice', room='general')
     zombie, _ = make_client(clients, 'zombie', room='general')
     zombie.conn.close()
@@ -65,3 +68,37 @@ def test_broadcast_survives_and_prunes_a_dead_member():
     alice.broadcast(protocol.encode({'type': 'MESSAGE', 'content': 'hi'}))
     assert protocol.read_message(alice_peer)['content'] == 'hi'
     assert zombie not in clients
+
+
+def test_nickname_changes_are_indexed():
+    clients = ConnectionRegistry()
+    alice, _ = make_client(clients, 'alice')
+    alice.nickname = 'alicia'
+    assert clients.with_nickname('alicia') == (alice,)
+    assert clients.with_nickname('alice') == ()
+
+
+def test_presence_members_get_a_delta_and_legacy_members_a_full_list():
+    clients = ConnectionRegistry()
+    alice, alice_peer = make_client(clients, 'alice', room='general')
+    alice.features = frozenset({constants.Features.PRESENCE})
+    bob, bob_peer = make_client(clients, 'bob', room='general')
+    carol, carol_peer = make_client(clients, 'carol', room='general')
+
+    alice_peer.settimeout(0.5)
+    bob_peer.settimeout(0.5)
+    carol_peer.settimeout(0.5)
+
+    clients.remove(carol)
+    carol.announce_leave('general')
+    delta = protocol.read_message(alice_peer)
+    assert delta['type'] == constants.Types.USER_LEFT and delta['id'] == carol.id
+    full = protocol.read_message(bob_peer)
+    assert full['type'] == constants.Types.USER_LIST
+
+    clients.add(carol)
+    carol.announce_join('general')
+    assert protocol.read_message(carol_peer)['type'] == constants.Types.USER_LIST
+    joined = protocol.read_message(alice_peer)
+    assert joined['type'] == constants.Types.USER_JOINED
+    assert joined['user'] == carol.user_entry()
@@ -177,3 +177,99 @@ def test_tls_negotiation_upgrades_both_ends(self_signed):
     assert client.ok and box['result'].ok
     assert box['message']['content'] == 'secret'
     assert isinstance(client.sock, ssl.SSLSocket)  # the channel was really upgraded
+
+
+def test_only_features_both_sides_support_are_agreed():
+    a, b = socket.socketpair()
+    thread, box = _run_server(
+        lambda: handshake.negotiate_server(
+            a, require_tls=False, supports_tls=False, version=1, features={'presence'}
+        )
+    )
+    client = handshake.negotiate_client(b, want_tls=False, version=1, features={'presence', 'x'})
+    thread.join()
+
+    assert client.features == {'presence'}
+    assert box['result'].features == {'presence'}
+
+
+def test_a_hello_without_features_agrees_to_none():
+    a, b = socket.socketpair()
+    thread, box = _run_server(
+        lambda: handshake.negotiate_server(
+            a, require_tls=False, supports_tls=False, version=1, features={'presence'}
+        )
+    )
+    client = handshake.negotiate_client(b, want_tls=False, version=1)
+    thread.join()
+
+    assert client.ok and client.features == frozenset()
+    assert box['result'].features == frozenset()
+
+
+@pytest.mark.parametrize('offered', protocol.SUPPORTED_VERSIONS)
+def test_server_continues_in_any_supported_version_offered(offered):
+    a, b = socket.socketpair()
+    thread, box = _run_server(
+        lambda: handshake.negotiate_server(
+            a, require_tls=False, supports_tls=False, version=protocol.PROTOCOL_VERSION
+        )
+    )
+    client = handshake.negotiate_client(b, want_tls=False, version=offered)
+    thread.join()
+
+    assert client.ok and client.version == offered
+    assert box['result'].version == offered
+
+
+def test_server_picks_a_serializer_only_for_v3():
+    for offered, expected in ((2, protocol.JSON), (3, protocol.serializers()[0])):
+        a, b = socket.socketpair()
+        thread, box = _run_server(
+            lambda: handshake.negotiate_server(
+                a, require_tls=False, supports_tls=False, version=protocol.PROTOCOL_VERSION
+            )
+        )
+        client = handshake.negotiate_client(b, want_tls=False, version=offered)
+        thread.join()
+
+        assert client.serializer == box['result'].serializer == expected
+
+
+def test_a_hello_offering_no_serializers_gets_json():
+    a, b = socket.socketpair()
+    thread, box = _run_server(
+        lambda: handshake.negotiate_server(
+            a, require_tls=False, supports_tls=False, version=protocol.PROTOCOL_VERSION
+        )
+    )
+    client = handshake.negotiate_client(b, want_tls=False, version=3, serializers=())
+    thread.join()
+
+    assert client.ok and client.serializer == protocol.JSON
+
+
+@pytest.mark.parametrize(
+    'offered, asked, supported, expected',
+    [
+        (3, True, True, True),
+        (3, False, True, False),
+        (3, True, False, False),
+        (2, True, True, False),
+    ],
+)
+def test_compression_needs_v3_and_both_sides(offered, asked, supported, expected):
+    a, b = socket.socketpair()
+    thread, box = _run_server(
+        lambda: handshake.negotiate_server(
+            a,
+            require_tls=False,
+            supports_tls=False,
+            version=protocol.PROTOCOL_VERSION,
+            supports_compression=supported,
+        )
+    )
+    client = handshake.negotiate_client(b, want_tls=False, version=offered, want_compression=asked)
+    thread.join()
+
+    assert client.compressed == box['result'].compressed == expected
@@ -7,11 +7,12 @@ from shared import constants
 from shared import protocol
 from shared.exceptions import DataReceptionException
 from server.handler import Client
+from server.registry import ConnectionRegistry
 
 
 def make_client():
     server_end, peer = socket.socketpair()
-    return Client(server_end, ('127.0.0.1', 5555), [], lambda: False), peer
+    return Client(server_end, ('127.0.0.1', 5555), ConnectionRegistry(), lambda: False), peer
 
 
 def test_heartbeat_pings_a_quiet_client():
@@ -37,3 +38,61 @@ def test_heartbeat_drops_a_stale_client():
     client.last_seen = time.time() - constants.PING_TIMEOUT - 1
     with pytest.raises(DataReceptionException):
         client.heartbeat()
+
+
+class Recorder:
+    """Stands in for a client: records when it was checked and asks to come back."""
+
+    def __init__(self, delays):
+        self.delays = list(delays)
+        self.fired = []
+
+    def keep_alive(self):
+        self.fired.append(time.monotonic())
+        return self.delays.pop(0) if self.delays else None
+
+
+def test_scheduler_runs_each_deadline_once_and_reschedules():
+    from server.heartbeat import HeartbeatScheduler
+
+    wheel = HeartbeatScheduler(tick=0.02, slots=8).start()
+    try:
+        early, late = Recorder([0.05]), Recorder([])
+        started = time.monotonic()
+        wheel.add(late, 0.3)  # further than one turn of the 8-slot wheel
+        wheel.add(early, 0.05)
+        time.sleep(0.5)
+        assert len(early.fired) == 2
+        assert len(late.fired) == 1
+        assert late.fired[0] - started >= 0.3
+        assert len(wheel) == 0
+    finally:
+        wheel.stop()
+
+
+def test_keep_alive_wakes_the_handler_of_a_stale_client():
+    import threading
+
+    client, peer = make_client()
+    client.registry.add(client)
+    errors = []
+
+    def read():
+        try:
+            client.receive()
+        except DataReceptionException as e:
+            errors.append(str(e))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    client.last_seen = time.time() - constants.PING_TIMEOUT - 1
+    assert client.keep_alive() is None
+    reader.join(2.0)
+    assert errors == ['The client stopped responding.']
+
+
+def test_keep_alive_reports_when_a_healthy_client_is_next_due():
+    client, peer = make_client()
+    client.registry.add(client)
+    client.last_seen = time.time()
+    assert constants.PING_INTERVAL - 1 < client.keep_alive() <= constants.PING_INTERVAL
@@ -0,0 +1,136 @@
+import json
+import socket
+import time
+
+from shared import protocol
+from server import db
+from server.handler import Client
+from server.history import RoomHistory
+from server.registry import ConnectionRegistry
+
+
+def row(message_id, timestamp, message='hi'):
+    return (message_id, 'alice', '#000000', message, timestamp)
+
+
+def warmed(capacity=3):
+    history = RoomHistory(capacity)
+    history._warm = True  # as if warmed from an empty database
+    return history
+
+
+def test_nothing_is_answered_before_warming():
+    history = RoomHistory()
+    history.record('general', row(1, 100))
+    assert history.recent('general', 0, 10) is None
+    assert history.counters['misses'] == 1
+
+
+def test_recent_messages_come_from_memory_oldest_first():
+    history = warmed()
+    history.record('general', row(1, 100, 'first'))
+    history.record('games', row(2, 101, 'elsewhere'))
+    history.record('general', row(3, 102, 'second'))
+    assert [r[3] for r in history.recent('general', 100, 10)] == ['first', 'second']
+    assert [r[3] for r in history.recent('general', 101, 10)] == ['second']
+    assert [r[3] for r in history.recent('general', 0, 1)] == ['first']
+    assert history.recent('lobby', 0, 10) == []
+    assert history.counters['hits'] == 4
+
+
+def test_late_arrivals_are_kept_in_id_order():
+    history = warmed()
+    history.record('general', row(2, 100, 'second'))
+    history.record('general', row(1, 100, 'first'))
+    assert [r[3] for r in history.recent('general', 0, 10)] == ['first', 'second']
+
+
+def test_requests_reaching_past_evicted_messages_go_to_the_database():
+    history = warmed(capacity=2)
+    for n in range(1, 4):
+        history.record('general', row(n, 100 + n))
+    assert history.recent('general', 101, 10) is None  # message 1 was evicted
+    assert [r[0] for r in history.recent('general', 102, 10)] == [2, 3]
+
+
+def test_warming_loads_the_newest_messages_of_each_room(tmp_path):
+    database = db.ServerDatabase(str(tmp_path / 'server.db'))
+    try:
+        for n in range(5):
+            database.add_message('alice', 'a', '#000000', f'general {n}', 100 + n)
+        database.add_message('bob', 'b', '#000000', 'games 0', 100, 'games')
+        history = RoomHistory(capacity=3)
+        assert history.warm(database) == 4
+    finally:
+        database.close()
+        db.close_writers()
+        db.close_pools()
+
+    assert [r[3] for r in history.recent('general', 102, 10)] == [
+        'general 2',
+        'general 3',
+        'general 4',
+    ]
+    assert history.recent('general', 101, 10) is None  # 'general 1' wasn't loaded
+    assert [r[3] for r in history.recent('games', 0, 10)] == ['games 0']
+
+
+def test_history_requests_are_served_without_a_database():
+    clients = ConnectionRegistry(history=warmed(capacity=10))
+    server_end, peer = socket.socketpair()
+    client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False)
+    client.nickname = 'alice'
+    client.room = 'general'
+    clients.add(client)
+    clients.history.record('general', row(7, int(time.time()), 'still here'))
+
+    assert client.db is None
+    client.send_message_history(100, 60)
+    messages = protocol.read_message(peer)['messages']
+    assert [(m['id'], m['content']) for m in messages] == [(7, 'still here')]
+
+
+def test_a_reconnect_wave_encodes_the_history_once():
+    history = warmed(capacity=10)
+    history.record('general', row(1, 100, 'first'))
+    frames = {history.encoded('general', 50, 100) for _ in range(50)}
+    assert len(frames) == 1 and history.counters['encodes'] == 1
+
+    history.record('general', row(2, 101, 'second'))
+    frame = history.encoded('general', 50, 100)
+    assert frame not in frames and history.counters['encodes'] == 2
+    assert [m['content'] for m in json.loads(frame[protocol.HEADER_LENGTH :])['messages']] == [
+        'first',
+        'second',
+    ]
+
+
+def test_history_pages_stream_as_bounded_frames(tmp_path):
+    path = str(tmp_path / 'server.db')
+    clients = ConnectionRegistry(history=warmed())
+    server_end, peer = socket.socketpair()
+    client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False)
+    client.room = 'general'
+    client.db = db.MessageStore(path)
+    try:
+        ids = [client.db.add_message('alice', 'a', '#000000', f'm{n}', n) for n in range(5)]
+        client.dispatch(
+            {
+                'type': 'REQUEST',
+                'request': 'GET_HISTORY_PAGE',
+                'before_id': ids[-1],
+                'page_size': 2,
+                'pages': 5,
+                'ref': 'r1',
+            }
+        )
+        frames = [protocol.read_message(peer) for _ in range(2)]
+        assert [[m['content'] for m in frame['messages']] for frame in frames] == [
+            ['m2', 'm3'],
+            ['m0', 'm1'],
+        ]
+        assert [frame['more'] for frame in frames] == [True, False]
+        assert {frame['ref'] for frame in frames} == {'r1'}
+    finally:
+        db.close_writers()
+        db.close_pools()
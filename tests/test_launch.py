@@ -1,3 +1,5 @@
+import pytest
+
 import launch
 
 
@@ -28,3 +30,41 @@ def test_a_role_is_required():
 
     with pytest.raises(SystemExit):
         launch.build_parser().parse_args([])
+
+
+def test_engine_choice_parses():
+    args = launch.build_parser().parse_args(['server', '--engine', 'asyncio'])
+    assert args.engine == 'asyncio'
+    assert launch.build_parser().parse_args(['server']).engine is None
+
+
+def test_a_bad_send_queue_policy_stops_the_server_at_startup(tmp_path, monkeypatch):
+    config = tmp_path / 'tcp-chat.toml'
+    config.write_text('[server]\nsend_queue_policy = "shrug"\n')
+    monkeypatch.setattr('server.main.serve', lambda *a, **k: pytest.fail('server started'))
+    with pytest.raises(SystemExit, match='unknown send queue policy'):
+        launch.main(['--config', str(config), 'server'])
+
+
+def test_a_bad_durability_stops_the_server_at_startup(tmp_path, monkeypatch):
+    config = tmp_path / 'tcp-chat.toml'
+    config.write_text('[server]\ndurability = "eventually"\n')
+    monkeypatch.setattr('server.main.serve', lambda *a, **k: pytest.fail('server started'))
+    with pytest.raises(SystemExit, match='unknown durability'):
+        launch.main(['--config', str(config), 'server'])
+
+
+def test_a_bad_retention_stops_the_server_at_startup(tmp_path, monkeypatch):
+    config = tmp_path / 'tcp-chat.toml'
+    config.write_text('[server.retention.rooms.games]\nmax_rows = -5\n')
+    monkeypatch.setattr('server.main.serve', lambda *a, **k: pytest.fail('server started'))
+    with pytest.raises(SystemExit, match='must not be negative'):
+        launch.main(['--config', str(config), 'server'])
+
+
+def test_an_unknown_storage_backend_stops_the_server_at_startup(tmp_path, monkeypatch):
+    config = tmp_path / 'tcp-chat.toml'
+    config.write_text('[server]\nstorage = "redis"\n')
+    monkeypatch.setattr('server.main.serve', lambda *a, **k: pytest.fail('server started'))
+    with pytest.raises(SystemExit, match='unknown storage backend'):
+        launch.main(['--config', str(config), 'server'])
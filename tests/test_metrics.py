@@ -0,0 +1,26 @@
+import threading
+
+from server import metrics
+
+
+def test_counters_add_and_snapshot():
+    counters = metrics.Counters('a', 'b')
+    assert counters.incr('a') == 1
+    assert counters.incr('a', 2) == 3
+    counters.incr('b', -1)
+    assert counters.snapshot() == {'a': 3, 'b': -1}
+
+
+def test_counters_are_safe_across_threads():
+    counters = metrics.Counters('hits')
+
+    def bump():
+        for _ in range(1000):
+            counters.incr('hits')
+
+    threads = [threading.Thread(target=bump) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counters['hits'] == 8000
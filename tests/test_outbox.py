@@ -0,0 +1,219 @@
+import asyncio
+import socket
+import time
+
+import pytest
+
+from shared import protocol
+from server import outbox
+from server.handler import Client
+from server.registry import ConnectionRegistry
+
+
+def _wait_for(predicate, deadline=2.0):
+    end = time.time() + deadline
+    while not predicate() and time.time() < end:
+        time.sleep(0.01)
+    return predicate()
+
+
+class StalledSocket:
+    """A socket whose peer never reads: every send times out."""
+
+    def send(self, data):
+        time.sleep(0.01)
+        raise socket.timeout()
+
+
+def test_frames_are_written_in_order():
+    server_end, peer = socket.socketpair()
+    box = outbox.Outbox(server_end)
+    for n in range(20):
+        box.put(protocol.encode({'n': n}))
+    assert [protocol.read_message(peer)['n'] for _ in range(20)] == list(range(20))
+    box.close()
+
+
+def test_large_frames_survive_partial_writes():
+    server_end, peer = socket.socketpair()
+    server_end.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    box = outbox.Outbox(server_end)
+    box.put(protocol.encode({'content': 'x' * 500_000}))
+    assert protocol.read_message(peer)['content'] == 'x' * 500_000
+    box.close()
+
+
+def test_drop_oldest_keeps_the_newest_frames():
+    box = outbox.Outbox(StalledSocket(), outbox.QueuePolicy(size=2, on_full=outbox.DROP_OLDEST))
+    for n in range(10):
+        box.put(b'frame %d' % n)  # never raises
+    assert len(box) <= 2
+    assert box.dropped >= 6  # the stalled writer holds a batch of at most two
+    box.close()
+
+
+def test_drop_oldest_passes_over_frames_that_must_be_kept():
+    box = outbox.Outbox(StalledSocket(), outbox.QueuePolicy(size=2, on_full=outbox.DROP_OLDEST))
+    with box._ready:  # hold the writer back, so everything stays queued
+        box.put(b'roster', droppable=False)
+        for n in range(10):
+            box.put(b'frame %d' % n)
+        box.put(b'delta', droppable=False)
+        assert [frame for frame, _ in box._frames] == [b'roster', b'delta']
+    assert box.dropped == 10
+    box.close()
+
+
+def test_disconnect_policy_raises_when_full():
+    box = outbox.Outbox(StalledSocket(), outbox.QueuePolicy(size=1, on_full=outbox.DISCONNECT))
+    with pytest.raises(outbox.OutboxFull):
+        for n in range(10):
+            box.put(b'frame %d' % n)
+    box.close()
+
+
+def test_block_policy_gives_up_after_its_deadline():
+    policy = outbox.QueuePolicy(size=1, on_full=outbox.BLOCK, deadline=0.1)
+    box = outbox.Outbox(StalledSocket(), policy)
+    started = time.time()
+    with pytest.raises(outbox.OutboxFull):
+        for n in range(10):
+            box.put(b'frame %d' % n)
+    assert time.time() - started >= 0.1
+    box.close()
+
+
+def test_put_after_close_raises():
+    server_end, _ = socket.socketpair()
+    box = outbox.Outbox(server_end)
+    box.close()
+    with pytest.raises(ConnectionError):
+        box.put(b'late')
+
+
+def test_unknown_policy_is_rejected():
+    server_end, _ = socket.socketpair()
+    with pytest.raises(ValueError):
+        outbox.Outbox(server_end, outbox.QueuePolicy(on_full='shrug'))
+
+
+@pytest.mark.parametrize(
+    'policy', [outbox.QueuePolicy(size=0), outbox.QueuePolicy(on_full='block', deadline=-1)]
+)
+def test_unusable_sizes_and_deadlines_are_rejected(policy):
+    with pytest.raises(ValueError):
+        outbox.check_policy(policy)
+
+
+def test_the_server_refuses_to_start_with_a_bad_policy():
+    from server.main import serve
+
+    with pytest.raises(ValueError, match='unknown send queue policy'):
+        serve('127.0.0.1', 0, send_queue=outbox.QueuePolicy(on_full='shrug'))
+
+
+class _StalledWriter:
+    """An asyncio writer whose peer never reads: drain() never returns."""
+
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writelines(self, data):
+        self.written.extend(data)
+
+    async def drain(self):
+        await asyncio.Event().wait()
+
+
+def test_async_outbox_drops_the_oldest_frames_of_a_stalled_reader():
+    async def scenario():
+        writer = _StalledWriter()
+        box = outbox.AsyncOutbox(writer, outbox.QueuePolicy(size=2))
+        await asyncio.sleep(0)
+        for n in range(5):
+            box.put(bytes([n]))
+            await asyncio.sleep(0)
+        box.close()
+        return writer.written, box.dropped
+
+    written, dropped = asyncio.run(scenario())
+    assert written == [b'\x00']  # the first frame went out, then drain() stalled
+    assert dropped == 2 and len(written) + dropped + 2 == 5
+
+
+def test_async_outbox_gives_up_on_a_stalled_reader_under_disconnect():
+    async def scenario():
+        box = outbox.AsyncOutbox(_StalledWriter(), outbox.QueuePolicy(size=2, on_full='disconnect'))
+        await asyncio.sleep(0)
+        box.put(b'a')
+        await asyncio.sleep(0)  # 'a' is written and the writer stalls in drain()
+        box.put(b'b')
+        box.put(b'c')
+        with pytest.raises(outbox.OutboxFull):
+            box.put(b'd')
+        box.close()
+
+    asyncio.run(scenario())
+
+
+def make_client(clients, nickname, policy=None):
+    server_end, peer = socket.socketpair()
+    client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False, policy)
+    client.nickname = nickname
+    clients.add(client)
+    return client, peer
+
+
+def test_broadcast_does_not_wait_for_a_slow_member():
+    clients = ConnectionRegistry()
+    alice, alice_peer = make_client(clients, 'alice')
+    slow, _ = make_client(clients, 'slow', outbox.QueuePolicy(size=4))
+    slow.conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    # 'slow' never reads; its queue fills and drops, but alice keeps receiving.
+    started = time.time()
+    for n in range(50):
+        alice.broadcast(protocol.encode({'type': 'MESSAGE', 'content': 'y' * 4000, 'n': n}))
+    assert time.time() - started < 1.0
+    assert [protocol.read_message(alice_peer)['n'] for _ in range(50)] == list(range(50))
+    assert slow in clients
+
+
+def test_an_overflowing_member_is_pruned_under_the_disconnect_policy():
+    clients = ConnectionRegistry()
+    alice, _ = make_client(clients, 'alice')
+    slow, _ = make_client(clients, 'slow', outbox.QueuePolicy(size=2, on_full=outbox.DISCONNECT))
+    slow.conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+
+    for n in range(50):
+        alice.broadcast(protocol.encode({'type': 'MESSAGE', 'content': 'y' * 4000}))
+    assert _wait_for(lambda: slow not in clients)
+
+
+def test_frames_are_compressed_as_they_are_written():
+    server_end, peer = socket.socketpair()
+    compressor = protocol.Compressor(threshold=0)
+    box = outbox.Outbox(server_end, outbox.QueuePolicy(size=4), compressor=compressor)
+    for n in range(50):  # some of these are dropped while queued, never compressed
+        box.put(protocol.encode({'n': n, 'padding': 'x' * 100}, version=3))
+    assert _wait_for(lambda: not len(box))
+    decompressor = protocol.Decompressor()
+    peer.settimeout(2.0)
+    received = [protocol.read_message(peer, 3, decompressor)['n'] for _ in range(50 - box.dropped)]
+    assert received == sorted(received) and received[-1] == 49
+    box.close()
+
+
+def test_queued_frames_are_written_together():
+    server_end, peer = socket.socketpair()
+    box = outbox.Outbox(server_end)
+    with box._ready:  # hold the writer back until all ten are queued
+        for n in range(10):
+            box._frames.append((protocol.encode({'n': n}), True))
+        box._ready.notify_all()
+    assert [protocol.read_message(peer)['n'] for _ in range(10)] == list(range(10))
+    assert box.writer.sends == 1
+    box.close()
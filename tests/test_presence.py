@@ -0,0 +1,173 @@
+import socket
+from concurrent.futures import Future
+
+import pytest
+
+from shared import constants
+from shared import protocol
+from server.handler import Client
+from server.registry import ConnectionRegistry
+
+
+class ManualScheduler:
+    """Holds scheduled flushes until the test runs them."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, delay, callback):
+        self.calls.append(callback)
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for callback in calls:
+            callback()
+
+
+def make_client(clients, nickname, presence=False):
+    server_end, peer = socket.socketpair()
+    features = [constants.Features.PRESENCE] if presence else []
+    client = Client(server_end, ('127.0.0.1', 5555), clients, lambda: False, features=features)
+    client.nickname = nickname
+    clients.add(client)
+    peer.settimeout(0.5)
+    return client, peer
+
+
+def drain(peer):
+    """Every frame waiting on ``peer``."""
+    frames = []
+    peer.settimeout(0.2)
+    try:
+        while True:
+            frames.append(protocol.read_message(peer))
+    except socket.timeout:
+        return frames
+
+
+def test_a_join_storm_reaches_each_member_in_one_window():
+    schedule = ManualScheduler()
+    clients = ConnectionRegistry(presence_window=1.0, schedule=schedule)
+    alice, alice_peer = make_client(clients, 'alice', presence=True)
+    bob, bob_peer = make_client(clients, 'bob')
+
+    arrivals = []
+    for n in range(5):
+        # Registered then announced straight away, as the accept path does.
+        client, peer = make_client(clients, f'user{n}')
+        client.announce_join(client.room)
+        arrivals.append((client, peer))
+    assert len(schedule.calls) == 1  # one window for the room, however many changes
+    assert drain(alice_peer) == []
+
+    schedule.run()
+    # alice speaks presence deltas: one per arrival, not the whole roster.
+    deltas = drain(alice_peer)
+    assert [frame['type'] for frame in deltas] == [constants.Types.USER_JOINED] * 5
+    assert [frame['user']['nickname'] for frame in deltas] == [f'user{n}' for n in range(5)]
+    # bob does not, and the arrivals need the roster they entered.
+    for peer in [bob_peer] + [peer for _, peer in arrivals]:
+        (frame,) = drain(peer)
+        assert frame['type'] == constants.Types.USER_LIST
+        assert len(frame['users']) == 7
+
+    counters = clients.presence.counters
+    assert counters['changes'] == 5
+    assert counters['updates_sent'] == 5 + 6
+    # Announced one by one, the arrivals would have cost 3 + 4 + 5 + 6 + 7 frames.
+    assert counters['updates_saved'] == 25 - 11
+
+
+def test_a_lone_change_still_goes_out_as_a_delta():
+    schedule = ManualScheduler()
+    clients = ConnectionRegistry(presence_window=1.0, schedule=schedule)
+    alice, alice_peer = make_client(clients, 'alice', presence=True)
+    bob, bob_peer = make_client(clients, 'bob')
+
+    clients.remove(bob)
+    bob.announce_leave(bob.room)
+    schedule.run()
+
+    (delta,) = drain(alice_peer)
+    assert delta['type'] == constants.Types.USER_LEFT and delta['id'] == bob.id
+
+
+def test_joining_and_leaving_within_a_window_announces_nothing():
+    schedule = ManualScheduler()
+    clients = ConnectionRegistry(presence_window=1.0, schedule=schedule)
+    alice, alice_peer = make_client(clients, 'alice', presence=True)
+    ghost, _ = make_client(clients, 'ghost')
+
+    ghost.announce_join(ghost.room)
+    clients.remove(ghost)
+    ghost.announce_leave(ghost.room)
+    schedule.run()
+
+    assert drain(alice_peer) == []
+    assert clients.presence.counters['updates_sent'] == 0
+
+
+@pytest.mark.parametrize('presence', [True, False])
+def test_a_zero_window_announces_immediately(presence):
+    clients = ConnectionRegistry()
+    alice, alice_peer = make_client(clients, 'alice', presence=presence)
+    bob, _ = make_client(clients, 'bob')
+
+    bob.nickname = 'robert'
+    bob.announce_rename()
+
+    frame = protocol.read_message(alice_peer)
+    if presence:
+        assert frame['type'] == constants.Types.USER_RENAMED
+        assert frame['nickname'] == 'robert'
+    else:
+        assert {u['nickname'] for u in frame['users']} == {'alice', 'robert'}
+
+
+def test_join_notices_in_one_window_are_recorded_and_sent_once():
+    schedule = ManualScheduler()
+    recorded = []
+
+    def persist(room, message, timestamp):
+        assert room == constants.DEFAULT_ROOM
+        recorded.append(message)
+        written = Future()
+        written.set_result(len(recorded))
+        return written
+
+    clients = ConnectionRegistry(presence_window=1.0, schedule=schedule, persist=persist)
+    alice, alice_peer = make_client(clients, 'alice')
+    for name in ['ann', 'bo', 'cy', 'di']:
+        newcomer, _ = make_client(clients, name)
+        clients.presence.notice(newcomer, newcomer.room, 'joined')
+    schedule.run()
+
+    assert recorded == ['ann, bo and 2 others joined!']
+    (notice,) = drain(alice_peer)
+    assert notice['type'] == constants.Types.MESSAGE
+    assert notice['content'] == 'ann, bo and 2 others joined!'
+
+
+def test_a_notice_is_sent_once_its_write_completes_without_blocking_the_flush():
+    schedule = ManualScheduler()
+    pending = Future()
+    callbacks = []
+    clients = ConnectionRegistry(
+        presence_window=1.0,
+        schedule=schedule,
+        persist=lambda room, message, timestamp: pending,
+        when_done=lambda future, callback: callbacks.append((future, callback)),
+    )
+    clients.history._warm = True
+    alice, alice_peer = make_client(clients, 'alice')
+    newcomer, _ = make_client(clients, 'ann')
+    clients.presence.notice(newcomer, newcomer.room, 'joined')
+    schedule.run()  # returns although the write has not completed
+    assert drain(alice_peer) == []
+
+    pending.set_result(42)
+    for future, callback in callbacks:
+        callback(future)
+    (notice,) = drain(alice_peer)
+    assert (notice['id'], notice['content']) == (42, 'ann joined!')
+    assert [row[0] for row in clients.history.recent(constants.DEFAULT_ROOM, 0, 10)] == [42]
@@ -1,3 +1,4 @@
+import itertools
 import json
 
 import pytest
@@ -23,6 +24,11 @@ class FakeSocket:
         self.position = end
         return chunk
 
+    def recv_into(self, buffer) -> int:
+        chunk = self.recv(len(buffer))
+        buffer[: len(chunk)] = chunk
+        return len(chunk)
+
 
 def test_encode_uses_byte_length_header():
     framed = protocol.encode({'content': 'hello'})
@@ -61,3 +67,170 @@ def test_read_message_round_trips_through_a_chunked_socket():
     decoded = protocol.read_message(sock)
     assert decoded['type'] == payload['type']
     assert decoded['content'] == payload['content']
+
+
+def test_v3_frames_carry_a_binary_header():
+    framed = protocol.encode({'content': 'hello'}, version=3)
+    length, kind = protocol.BINARY_HEADER.unpack(framed[: protocol.header_length(3)])
+    assert kind == protocol.FRAME_JSON
+    assert length == len(framed) - protocol.header_length(3)
+    assert protocol.read_message(FakeSocket(framed, chunk_size=2), version=3)['content'] == 'hello'
+
+
+def test_reframe_matches_encoding_for_the_version():
+    frame = protocol.encode({'type': 'MESSAGE', 'content': 'hi'})
+    assert protocol.reframe(frame, 2) is frame
+    assert protocol.reframe(frame, 3) == protocol.encode({'type': 'MESSAGE', 'content': 'hi'}, 3)
+
+
+def test_unknown_frame_type_is_rejected():
+    with pytest.raises(ValueError):
+        protocol.parse_header(protocol.BINARY_HEADER.pack(2, 99), 3)
+
+
+@pytest.fixture
+def reversed_json(monkeypatch):
+    """A throwaway serializer (JSON, backwards) so non-JSON paths run without extra packages."""
+    monkeypatch.setattr(protocol, '_serializers', dict(protocol._serializers))
+    monkeypatch.setattr(protocol, '_by_frame_type', dict(protocol._by_frame_type))
+    protocol.register(
+        protocol.Serializer(
+            'reversed',
+            100,
+            lambda obj: json.dumps(obj).encode('utf-8')[::-1],
+            lambda body: json.loads(body[::-1]),
+        )
+    )
+    return 'reversed'
+
+
+@pytest.mark.parametrize('serializer', protocol.serializers())
+def test_every_available_serializer_round_trips(serializer):
+    payload = {'type': 'USER_LIST', 'users': [{'nickname': 'ann', 'color': '#000000'}] * 3}
+    framed = protocol.encode(payload, version=3, serializer=serializer)
+    assert protocol.read_message(FakeSocket(framed, chunk_size=5), version=3)['users'] == (
+        payload['users']
+    )
+
+
+def test_reframe_serializes_the_remembered_object_once(reversed_json):
+    frame = protocol.encode({'type': 'MESSAGE', 'content': 'hi'})
+    converted = protocol.reframe(frame, 3, reversed_json)
+    assert protocol.BINARY_HEADER.unpack(converted[:5])[1] == 100
+    assert protocol.read_message(FakeSocket(converted), version=3)['content'] == 'hi'
+    assert protocol.reframe(frame, 3, reversed_json) is converted
+
+
+def test_choose_serializer_falls_back_to_json(reversed_json):
+    assert protocol.choose_serializer(['nonsense', 'reversed']) == 'reversed'
+    assert protocol.choose_serializer(['nonsense']) == protocol.JSON
+    assert protocol.choose_serializer(None) == protocol.JSON
+
+
+def test_v2_frames_are_always_json():
+    with pytest.raises(ValueError):
+        protocol.encode({'content': 'hello'}, version=2, serializer='msgpack')
+
+
+def test_compressed_frames_share_one_stream():
+    compressor, decompressor = protocol.Compressor(threshold=64), protocol.Decompressor()
+    roster = {'type': 'USER_LIST', 'users': [{'nickname': 'ann', 'color': '#000000'}] * 20}
+    frames = [protocol.encode(roster, version=3) for _ in range(2)]
+    frames.append(protocol.encode({'type': 'PING'}, version=3))
+    packed = [compressor.compress(frame) for frame in frames]
+
+    assert len(packed[1]) < len(packed[0]) < len(frames[0])  # the second refers to the first
+    assert packed[2] == frames[2]  # under the threshold, sent as it is
+    sock = FakeSocket(b''.join(packed), chunk_size=3)
+    assert [protocol.read_message(sock, 3, decompressor)['type'] for _ in packed] == [
+        'USER_LIST',
+        'USER_LIST',
+        'PING',
+    ]
+    assert (compressor.raw, compressor.wire) == (
+        sum(map(len, frames)),
+        sum(map(len, packed)),
+    )
+
+
+def test_a_compressed_frame_needs_a_decompressor():
+    packed = protocol.Compressor(threshold=0).compress(protocol.encode({'n': 1}, version=3))
+    with pytest.raises(ValueError):
+        protocol.read_message(FakeSocket(packed), version=3)
+
+
+@pytest.mark.parametrize(
+    'header, version',
+    [
+        (protocol.BINARY_HEADER.pack(2**32 - 1, protocol.FRAME_JSON), 3),
+        (b'9999999999', 2),
+        (b'-000000005', 2),
+    ],
+)
+def test_out_of_range_frame_lengths_are_refused(header, version):
+    with pytest.raises(ValueError, match='out of range'):
+        protocol.parse_header(header, version)
+    reader = protocol.FrameReader(FakeSocket(header + b'{}' * 8, chunk_size=64), version)
+    with pytest.raises(ValueError):
+        reader.read_frame()
+    assert len(reader._buffer) < 1 << 20  # nothing was reserved for the announced body
+
+
+@pytest.mark.parametrize('version', protocol.SUPPORTED_VERSIONS)
+def test_frame_reader_hands_out_a_burst_from_one_recv(version):
+    burst = b''.join(protocol.encode({'n': n}, version) for n in range(10))
+    reader = protocol.FrameReader(FakeSocket(burst, chunk_size=len(burst)), version)
+    assert [
+        protocol.decode(body, kind)['n'] for kind, body in itertools.islice(reader.frames(), 10)
+    ] == (list(range(10)))
+    assert reader.recvs == 1 and reader.buffered == 0
+
+
+def test_frame_reader_reassembles_frames_across_reads():
+    frames = [protocol.encode({'content': 'x' * n}, 3) for n in (1, 300, 5)]
+    reader = protocol.FrameReader(FakeSocket(b''.join(frames), chunk_size=7), 3, size=64)
+    assert [len(protocol.decode(reader.read_frame()[1])['content']) for _ in frames] == [1, 300, 5]
+    assert len(reader._buffer) == 64  # grown for the long frame, then given back
+
+
+def test_frame_reader_reports_a_frame_cut_short():
+    frame = protocol.encode({'content': 'hello'}, 3)
+    reader = protocol.FrameReader(FakeSocket(frame[:-2], chunk_size=4), 3)
+    with pytest.raises(ConnectionError):
+        reader.read_frame()
+    assert reader.buffered == len(frame) - 2
+
+
+class TrickleSocket:
+    """A stand-in socket without sendmsg that takes at most ``limit`` bytes per send."""
+
+    def __init__(self, limit: int):
+        self.limit, self.data = limit, b''
+
+    def send(self, data) -> int:
+        taken = bytes(data[: self.limit])
+        self.data += taken
+        return len(taken)
+
+
+class GatheringTrickleSocket(TrickleSocket):
+    def sendmsg(self, buffers) -> int:
+        return self.send(b''.join(buffers))
+
+
+def test_frame_writer_gathers_frames_into_one_sendmsg():
+    frames = [protocol.encode({'n': n}, 3) for n in range(10)]
+    sock = GatheringTrickleSocket(limit=1 << 20)
+    writer = protocol.FrameWriter(sock)
+    writer.write(frames)
+    assert sock.data == b''.join(frames) and writer.sends == 1
+
+
+@pytest.mark.parametrize('kind', [TrickleSocket, GatheringTrickleSocket])
+def test_frame_writer_resumes_after_partial_writes(kind):
+    frames = [protocol.encode({'content': 'x' * n}, 3) for n in (1, 300, 5, 40)]
+    sock = kind(limit=7)
+    writer = protocol.FrameWriter(sock)
+    writer.write(frames)
+    assert sock.data == b''.join(frames)
+    assert writer.sends == -(-len(sock.data) // 7)
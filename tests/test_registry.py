@@ -0,0 +1,82 @@
+import threading
+
+from server.registry import ConnectionRegistry
+
+
+class FakeClient:
+    def __init__(self, client_id, nickname='anon', room='general'):
+        self.id, self.nickname, self.room = client_id, nickname, room
+
+
+def test_add_indexes_by_id_nickname_and_room():
+    registry = ConnectionRegistry()
+    alice = FakeClient('a', 'alice', 'games')
+    registry.add(alice)
+    assert alice in registry
+    assert registry.get('a') is alice
+    assert registry.with_nickname('alice') == (alice,)
+    assert registry.rooms.members('games') == (alice,)
+    assert len(registry) == 1
+
+
+def test_remove_forgets_every_index_and_reports_repeats():
+    registry = ConnectionRegistry()
+    alice = FakeClient('a', 'alice')
+    registry.add(alice)
+    assert registry.remove(alice) is True
+    assert registry.remove(alice) is False
+    assert alice not in registry
+    assert registry.get('a') is None
+    assert registry.with_nickname('alice') == ()
+    assert registry.rooms.counts() == {}
+
+
+def test_nicknames_may_be_shared_and_renamed():
+    registry = ConnectionRegistry()
+    one, two = FakeClient('1', 'sam'), FakeClient('2', 'sam')
+    registry.add(one)
+    registry.add(two)
+    assert set(registry.with_nickname('sam')) == {one, two}
+
+    registry.rename(two, 'sam', 'samantha')
+    assert registry.with_nickname('sam') == (one,)
+    assert registry.with_nickname('samantha') == (two,)
+
+
+def test_an_unregistered_lookalike_is_not_contained():
+    registry = ConnectionRegistry()
+    registry.add(FakeClient('a'))
+    assert FakeClient('a') not in registry
+    assert object() not in registry
+
+
+def test_snapshot_is_reused_until_membership_changes():
+    registry = ConnectionRegistry()
+    a, b = FakeClient('a'), FakeClient('b')
+    registry.add(a)
+    first = registry.snapshot()
+    assert registry.snapshot() is first  # no copy between changes
+    registry.add(b)
+    assert first == (a,)
+    assert list(registry) == [a, b]
+
+
+def test_concurrent_adds_and_removes():
+    registry = ConnectionRegistry()
+    clients = [FakeClient(str(n)) for n in range(400)]
+
+    def churn(chunk):
+        for client in chunk:
+            registry.add(client)
+        for client in chunk[::2]:
+            registry.remove(client)
+
+    threads = [threading.Thread(target=churn, args=(clients[k::4],)) for k in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(registry) == 200
+    assert len(registry.snapshot()) == 200
+    assert sum(registry.rooms.counts().values()) == 200
@@ -3,6 +3,7 @@ import socket
 from shared import helpers
 from server import resilience
 from server.handler import Client
+from server.registry import ConnectionRegistry
 
 
 def test_is_stale():
@@ -21,9 +22,20 @@ def test_should_ping():
 
 def test_receive_refreshes_last_seen():
     server_end, peer = socket.socketpair()
-    client = Client(server_end, ('127.0.0.1', 5555), [], lambda: False)
+    client = Client(server_end, ('127.0.0.1', 5555), ConnectionRegistry(), lambda: False)
     client.last_seen = 0
     peer.sendall(helpers.prepare_pong())
     data = client.receive()
     assert data['type'] == 'PONG'
     assert client.last_seen > 0
+
+
+def test_seconds_until_due_sleeps_until_the_next_deadline():
+    # Heard from at 0: a PING is due at the interval, well before it goes stale.
+    assert resilience.seconds_until_due(0, 0, now=5, interval=20, timeout=60) == 15
+    # Just probed: the next PING waits a full interval from the probe...
+    assert resilience.seconds_until_due(0, 30, now=30, interval=20, timeout=60) == 20
+    # ...unless going stale comes first.
+    assert resilience.seconds_until_due(0, 50, now=50, interval=20, timeout=60) == 10
+    # Overdue deadlines never go negative.
+    assert resilience.seconds_until_due(0, 0, now=99, interval=20, timeout=60) == 0
@@ -0,0 +1,123 @@
+import sqlite3
+
+import pytest
+
+from server import db
+from server.history import RoomHistory
+from server.retention import Pruner, Retention, RetentionPolicy, parse_retention
+
+
+def test_rooms_inherit_the_default_limits_they_leave_out():
+    retention = parse_retention(
+        {'max_age': 3600, 'rooms': {'games': {'max_rows': 10}, 'news': {'max_age': 60}}}
+    )
+    assert retention.for_room('general') == RetentionPolicy(3600, 0)
+    assert retention.for_room('games') == RetentionPolicy(3600, 10)
+    assert retention.for_room('news') == RetentionPolicy(60, 0)
+    assert not retention.keeps_everything
+    assert parse_retention(None).keeps_everything
+
+
+@pytest.mark.parametrize(
+    'data, error',
+    [
+        ({'max_days': 3}, 'unknown retention setting'),
+        ({'rooms': {'games': {'max_rows': -1}}}, 'must not be negative'),
+    ],
+)
+def test_a_bad_retention_table_is_refused(data, error):
+    with pytest.raises(ValueError, match=error):
+        parse_retention(data)
+
+
+def fill(conn, room, count, first_timestamp=0):
+    with conn:
+        conn.executemany(
+            'INSERT INTO message (nickname, connection_hash, message, timestamp, room) '
+            'VALUES (?, ?, ?, ?, ?)',
+            [('alice', 'a', 'x' * 500, first_timestamp + n, room) for n in range(count)],
+        )
+
+
+def remaining(conn, room):
+    return [
+        row[0]
+        for row in conn.execute(
+            'SELECT timestamp FROM message WHERE room = ? ORDER BY timestamp', [room]
+        )
+    ]
+
+
+def test_pruning_enforces_each_rooms_limits_in_batches(tmp_path):
+    database = db.ServerDatabase(str(tmp_path / 'server.db'))
+    try:
+        fill(database.conn, 'general', 100)
+        fill(database.conn, 'games', 100)
+        fill(database.conn, 'news', 100)
+        retention = Retention(
+            RetentionPolicy(max_age=30),
+            {'games': RetentionPolicy(max_rows=25), 'news': RetentionPolicy()},
+        )
+        pruner = Pruner(retention, batch=7)
+
+        assert pruner.prune(database.conn, now=100) == 70 + 75
+        assert remaining(database.conn, 'general') == list(range(70, 100))
+        assert remaining(database.conn, 'games') == list(range(75, 100))
+        assert len(remaining(database.conn, 'news')) == 100
+        assert pruner.counters['deleted'] == 145
+        assert pruner.prune(database.conn, now=100) == 0  # nothing more to do
+    finally:
+        database.close()
+
+
+def test_pruned_messages_leave_the_history_buffers(tmp_path):
+    database = db.ServerDatabase(str(tmp_path / 'server.db'))
+    try:
+        fill(database.conn, 'general', 20)
+        history = RoomHistory(capacity=10)
+        history.warm(database)
+        assert len(history.recent('general', 10, 100)) == 10
+        assert history.encoded('general', 10, 100) is not None  # a frame is cached now
+
+        Pruner(Retention(RetentionPolicy(max_rows=5)), batch=2, history=history).prune(
+            database.conn
+        )
+        assert [row[4] for row in history.recent('general', 15, 100)] == list(range(15, 20))
+        assert history.recent('general', 10, 100) is None  # the database has the rest
+        assert history.encoded('general', 10, 100) is None
+    finally:
+        database.close()
+
+
+def test_pruned_space_is_given_back(tmp_path):
+    path = str(tmp_path / 'server.db')
+    database = db.ServerDatabase(path)
+    try:
+        fill(database.conn, 'general', 2000)
+        pages = database.conn.execute('PRAGMA page_count').fetchone()[0]
+        pruner = Pruner(Retention(RetentionPolicy(max_rows=10)), vacuum_pages=16)
+        pruner.prune(database.conn)
+        assert database.conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+        assert database.conn.execute('PRAGMA page_count').fetchone()[0] < pages / 10
+        assert pruner.counters['pages_freed'] > 0
+    finally:
+        database.close()
+
+
+def test_an_old_file_is_converted_to_incremental_vacuum(tmp_path):
+    path = str(tmp_path / 'server.db')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        '''CREATE TABLE message (id INTEGER PRIMARY KEY, nickname TEXT NOT NULL,
+           connection_hash TEXT NOT NULL, color TEXT DEFAULT '#000000',
+           message TEXT DEFAULT '', timestamp INTEGER NOT NULL)'''
+    )
+    conn.execute('PRAGMA user_version = 1')
+    conn.close()
+
+    database = db.ServerDatabase(path)
+    try:
+        assert database.conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+        assert database.conn.execute('PRAGMA user_version').fetchone()[0] == db.SCHEMA_VERSION
+    finally:
+        database.close()
@@ -1,24 +1,95 @@
+import threading
+
 from server import rooms
 from shared import constants
 
 
 class FakeClient:
-    def __init__(self, room):
-        self.room = room
+    pass
+
+
+def test_members_are_indexed_by_room():
+    registry = rooms.RoomRegistry()
+    a, b, c = FakeClient(), FakeClient(), FakeClient()
+    registry.add(a, 'general')
+    registry.add(b, 'games')
+    registry.add(c, 'general')
+    assert registry.members('general') == (a, c)
+    assert registry.members('games') == (b,)
+    assert registry.members('empty') == ()
+    assert registry.room_of(b) == 'games'
+
+
+def test_add_defaults_to_the_default_room():
+    registry = rooms.RoomRegistry()
+    client = FakeClient()
+    registry.add(client)
+    assert registry.members(constants.DEFAULT_ROOM) == (client,)
+
+
+def test_move_updates_both_directions():
+    registry = rooms.RoomRegistry()
+    a, b = FakeClient(), FakeClient()
+    registry.add(a, 'general')
+    registry.add(b, 'general')
+    assert registry.move(a, 'games') == 'general'
+    assert registry.members('general') == (b,)
+    assert registry.members('games') == (a,)
+    assert registry.room_of(a) == 'games'
+
+
+def test_move_ignores_an_unregistered_client():
+    registry = rooms.RoomRegistry()
+    stranger = FakeClient()
+    assert registry.move(stranger, 'games') is None
+    assert stranger not in registry
+    assert registry.members('games') == ()
+
+
+def test_remove_forgets_the_client_and_empty_rooms():
+    registry = rooms.RoomRegistry()
+    a = FakeClient()
+    registry.add(a, 'games')
+    assert registry.remove(a) == 'games'
+    assert registry.remove(a) is None
+    assert a not in registry
+    assert registry.counts() == {}
+
+
+def test_counts_tallies_occupied_rooms():
+    registry = rooms.RoomRegistry()
+    for room in ('general', 'general', 'games'):
+        registry.add(FakeClient(), room)
+    assert registry.counts() == {'general': 2, 'games': 1}
+    assert len(registry) == 3
+
 
+def test_snapshots_are_stable_while_the_room_changes():
+    registry = rooms.RoomRegistry()
+    a, b = FakeClient(), FakeClient()
+    registry.add(a, 'general')
+    snapshot = registry.members('general')
+    registry.add(b, 'general')
+    assert snapshot == (a,)  # an iteration in progress is unaffected
+    assert registry.members('general') == (a, b)
 
-def test_members_in_filters_by_room():
-    a, b, c = FakeClient('general'), FakeClient('games'), FakeClient('general')
-    assert rooms.members_in([a, b, c], 'general') == [a, c]
-    assert rooms.members_in([a, b, c], 'games') == [b]
-    assert rooms.members_in([a, b, c], 'empty') == []
 
+def test_concurrent_moves_keep_the_index_consistent():
+    registry = rooms.RoomRegistry()
+    clients = [FakeClient() for _ in range(50)]
+    for client in clients:
+        registry.add(client, 'general')
 
-def test_members_in_defaults_missing_room():
-    client = object()  # no room attribute
-    assert rooms.members_in([client], constants.DEFAULT_ROOM) == [client]
+    def shuffle(offset):
+        for n in range(200):
+            registry.move(clients[(n + offset) % 50], f'room{n % 5}')
 
+    threads = [threading.Thread(target=shuffle, args=(k,)) for k in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-def test_room_counts_tallies_occupied_rooms():
-    clients = [FakeClient('general'), FakeClient('general'), FakeClient('games')]
-    assert rooms.room_counts(clients) == {'general': 2, 'games': 1}
+    assert sum(registry.counts().values()) == 50
+    for client in clients:
+        assert client in registry.members(registry.room_of(client))
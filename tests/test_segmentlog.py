@@ -0,0 +1,140 @@
+import os
+
+import pytest
+
+from server import segmentlog
+from server import storage
+from server.segmentlog import INDEX_ENTRY, LogStore, SegmentLog
+
+
+def row(message, timestamp, room='general', nickname='alice'):
+    return (nickname, 'hash', '#000000', message, timestamp, room)
+
+
+@pytest.fixture
+def log(tmp_path):
+    log = SegmentLog(str(tmp_path), durability='none')
+    yield log
+    log.close()
+
+
+def test_recent_reads_one_room_from_a_timestamp_on(log):
+    for n in range(10):
+        log.append(row(f'g{n}', 100 + n))
+        log.append(row(f'o{n}', 100 + n, room='other'))
+    assert [message for _, _, _, message, _ in log.recent('general', 105, 3)] == [
+        'g5',
+        'g6',
+        'g7',
+    ]
+    assert log.recent('general', 200, 10) == []
+    assert log.recent('nowhere', 0, 10) == []
+
+
+def test_ids_are_consecutive_and_rows_are_history_rows(log):
+    assert [log.append(row('hi', 1)), log.append(row('héllo', 2))] == [1, 2]
+    assert log.recent('general', 0, 10) == [
+        (1, 'alice', '#000000', 'hi', 1),
+        (2, 'alice', '#000000', 'héllo', 2),
+    ]
+
+
+def test_full_segments_are_sealed_and_still_read(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=512, index_every=128, durability='none')
+    for n in range(100):
+        log.append(row(f'message {n}', n))
+    segments = sorted(name for name in os.listdir(tmp_path) if name.endswith('.seg'))
+    assert len(segments) > 1
+    assert all(os.path.getsize(tmp_path / name) <= 512 for name in segments)
+    assert [message for _, _, _, message, _ in log.recent('general', 95, 10)] == [
+        f'message {n}' for n in range(95, 100)
+    ]
+    log.close()
+
+
+def test_the_sparse_index_starts_a_read_past_older_records(tmp_path):
+    log = SegmentLog(str(tmp_path), index_every=256, durability='none')
+    for n in range(200):
+        log.append(row('x' * 40, n))
+    segment = log._segments[-1]
+    assert len(segment.entries) > 10
+    start = segment.start(150)
+    assert 0 < start < segment.size
+    # Nothing skipped is as new as the timestamp asked for.
+    skipped = list(segmentlog._records(segment.view(start), 0))
+    assert skipped and max(timestamp for _, timestamp, *_ in skipped) < 150
+    log.close()
+
+
+def test_latest_keeps_each_rooms_newest_messages(log):
+    for n in range(5):
+        log.append(row(f'g{n}', n))
+    log.append(row('o0', 2, room='other'))
+    latest = log.latest(2)
+    assert [message for _, _, _, message, _ in latest['general']] == ['g3', 'g4']
+    assert [message for _, _, _, message, _ in latest['other']] == ['o0']
+
+
+def test_reopening_cuts_off_a_torn_record_and_carries_on(tmp_path):
+    log = SegmentLog(str(tmp_path), index_every=64, durability='none')
+    for n in range(20):
+        log.append(row(f'message {n}', n))
+    log.close()
+    path = log._segments[-1].path
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as handle:
+        handle.truncate(size - 3)  # the last record only half made it
+    with open(log._segments[-1].index_path, 'ab') as handle:
+        handle.write(INDEX_ENTRY.pack(19, size))  # an entry for a record never written
+
+    reopened = SegmentLog(str(tmp_path), index_every=64, durability='none')
+    assert os.path.getsize(path) < size - 3
+    assert [message for _, _, _, message, _ in reopened.recent('general', 0, 100)] == [
+        f'message {n}' for n in range(19)
+    ]
+    assert reopened.append(row('again', 30)) == 20
+    assert reopened.recent('general', 30, 10) == [(20, 'alice', '#000000', 'again', 30)]
+    reopened.close()
+
+
+def test_the_log_backend_serves_handlers_through_the_storage_interface(tmp_path, monkeypatch):
+    monkeypatch.setattr('shared.constants.SEGMENT_LOG_DIR', str(tmp_path))
+    monkeypatch.setattr(storage, '_backend', storage.SQLITE)  # put back afterwards
+    storage.prepare(storage.LOG, 'none')
+    try:
+        store = storage.open_store()
+        assert isinstance(store, LogStore)
+        message_id = store.add_message('alice', 'hash', '#000000', 'hi', 10, 'games')
+        assert store.recent_messages('games', 0, 10) == [(message_id, 'alice', '#000000', 'hi', 10)]
+    finally:
+        storage.close_all()
+
+
+def test_pages_walk_a_room_by_id_across_segments(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=256, durability='none')
+    for n in range(30):
+        log.append(row(f'g{n}', n))
+        log.append(row(f'o{n}', n, room='other'))
+
+    def page(before_id, after_id, limit):
+        return [message for _, _, _, message, _ in log.page('general', before_id, after_id, limit)]
+
+    assert len(log._segments) > 3
+    assert page(None, None, 3) == ['g27', 'g28', 'g29']
+    assert page(21, None, 3) == ['g7', 'g8', 'g9']  # g10 has id 21
+    assert page(None, 21, 2) == ['g11', 'g12']
+    assert page(9, 3, 10) == ['g2', 'g3']
+    assert page(1, None, 10) == []
+    log.close()
+
+
+def test_search_scans_the_room_newest_first(log):
+    log.append(row('Deploy failed', 1))
+    log.append(row('deploy worked', 2))
+    log.append(row('deploy failed again', 3))
+    log.append(row('deploy failed elsewhere', 4, room='other'))
+    assert [m for _, _, _, m, _ in log.search('general', ['deploy', 'FAILED'], 0, 10)] == [
+        'deploy failed again',
+        'Deploy failed',
+    ]
+    assert [m for _, _, _, m, _ in log.search('general', ['deploy'], 1, 1)] == ['deploy worked']
@@ -0,0 +1,265 @@
+import sqlite3
+import threading
+
+import pytest
+
+from server import db
+
+
+def _rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute('SELECT id, nickname, message FROM message ORDER BY id').fetchall()
+    finally:
+        conn.close()
+
+
+def test_writer_commits_queued_messages_together(tmp_path):
+    path = str(tmp_path / 'server.db')
+    writer = db.MessageWriter(path, max_batch=50, max_delay=0.2)
+    futures = [writer.submit('alice', 'a', '#000000', f'm{n}', n) for n in range(10)]
+    ids = [future.result(timeout=5) for future in futures]
+    writer.close()
+
+    assert ids == sorted(ids) and len(set(ids)) == 10
+    assert [message for _, _, message in _rows(path)] == [f'm{n}' for n in range(10)]
+    stats = writer.stats()
+    assert stats.rows == 10
+    assert stats.batches == 1 and stats.largest_batch == 10
+    assert stats.max_commit >= stats.mean_commit > 0
+
+
+def test_writer_hands_each_caller_its_own_id(tmp_path):
+    path = str(tmp_path / 'server.db')
+    writer = db.MessageWriter(path)
+    results = {}
+
+    def post(n):
+        results[n] = writer.add_message(f'user{n}', str(n), '#000000', f'from {n}', n)
+
+    threads = [threading.Thread(target=post, args=(n,)) for n in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+
+    by_id = {row_id: message for row_id, _, message in _rows(path)}
+    assert all(by_id[results[n]] == f'from {n}' for n in range(20))
+
+
+def test_a_failed_batch_fails_its_callers(tmp_path):
+    path = str(tmp_path / 'server.db')
+    writer = db.MessageWriter(path)
+    with pytest.raises(sqlite3.IntegrityError):
+        writer.add_message(None, 'a', '#000000', 'no nickname', 0)  # nickname is NOT NULL
+    assert writer.add_message('alice', 'a', '#000000', 'still writing', 0) > 0
+    writer.close()
+
+
+def test_close_flushes_and_refuses_more(tmp_path):
+    path = str(tmp_path / 'server.db')
+    writer = db.MessageWriter(path, max_delay=10.0)
+    future = writer.submit('alice', 'a', '#000000', 'last words', 0)
+    writer.close()
+    assert future.result(timeout=0) > 0
+    with pytest.raises(RuntimeError):
+        writer.submit('alice', 'a', '#000000', 'too late', 0)
+
+
+def test_server_database_inserts_through_the_shared_writer(tmp_path):
+    path = str(tmp_path / 'server.db')
+    database = db.ServerDatabase(path)
+    try:
+        message_id = database.add_message('alice', 'a', '#000000', 'hello', 0)
+        assert _rows(path) == [(message_id, 'alice', 'hello')]
+        assert db.shared_writer(path).stats().rows == 1
+    finally:
+        database.close()
+        db.close_writers()
+        db.close_pools()
+
+
+def test_an_old_message_table_is_migrated_once(tmp_path):
+    path = str(tmp_path / 'server.db')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        '''CREATE TABLE message (id INTEGER PRIMARY KEY, nickname TEXT NOT NULL,
+           connection_hash TEXT NOT NULL, color TEXT DEFAULT '#000000',
+           message TEXT DEFAULT '', timestamp INTEGER NOT NULL)'''
+    )
+    conn.execute("INSERT INTO message VALUES (1, 'alice', 'a', '#000000', 'before', 100)")
+    conn.commit()
+    conn.close()
+
+    database = db.ServerDatabase(path)
+    try:
+        assert database.conn.execute('PRAGMA user_version').fetchone()[0] == db.SCHEMA_VERSION
+        assert database.recent_messages('general', 0, 10) == [
+            (1, 'alice', '#000000', 'before', 100)
+        ]
+        plan = database.conn.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM message WHERE room = ? AND timestamp >= ? '
+            'ORDER BY timestamp',
+            ['general', 0],
+        ).fetchall()
+        assert 'message_room_time' in ' '.join(str(step) for step in plan)
+        assert database.search_messages('general', ['before'], 0, 10) == [
+            (1, 'alice', '#000000', 'before', 100)
+        ]  # indexed for search as it was migrated
+    finally:
+        database.close()
+        db.close_pools()
+    db.ServerDatabase(path).close()  # already current: nothing to do
+
+
+def test_history_is_kept_per_room(tmp_path):
+    path = str(tmp_path / 'server.db')
+    database = db.ServerDatabase(path)
+    try:
+        database.add_message('alice', 'a', '#000000', 'in general', 100)
+        database.add_message('bob', 'b', '#000000', 'in lobby', 101, 'lobby')
+        database.add_message('bob', 'b', '#000000', 'too old', 10, 'lobby')
+        assert [row[3] for row in database.recent_messages('lobby', 50, 10)] == ['in lobby']
+        assert [row[3] for row in database.recent_messages('general', 0, 10)] == ['in general']
+    finally:
+        database.close()
+        db.close_writers()
+        db.close_pools()
+
+
+def test_history_reads_take_no_lock_and_see_committed_messages(tmp_path):
+    path = str(tmp_path / 'server.db')
+    database = db.ServerDatabase(path)
+    try:
+        assert database.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        database.add_message('alice', 'a', '#000000', 'hello', 100)
+        read = []
+        with db.lock:  # as if the writer were mid-commit
+            reader = threading.Thread(
+                target=lambda: read.extend(database.recent_messages('general', 0, 10))
+            )
+            reader.start()
+            reader.join(timeout=5)
+        assert [row[3] for row in read] == ['hello']
+        with pytest.raises(sqlite3.OperationalError):
+            with db.shared_pool(path).borrow() as conn:
+                conn.execute("DELETE FROM message")  # read-only
+    finally:
+        database.close()
+        db.close_writers()
+        db.close_pools()
+
+
+def test_the_pool_prepares_the_schema_and_lends_a_fixed_number_of_connections(tmp_path):
+    path = str(tmp_path / 'server.db')
+    pool = db.ConnectionPool(path, size=2)
+    try:
+        with pool.borrow() as first, pool.borrow() as second:
+            assert first is not second
+            assert first.execute('PRAGMA user_version').fetchone()[0] == db.SCHEMA_VERSION
+            waiting = threading.Thread(target=lambda: pool.borrow().__enter__())
+            waiting.start()
+            waiting.join(timeout=0.2)
+            assert waiting.is_alive()  # both connections are out
+        waiting.join(timeout=5)
+        assert not waiting.is_alive() and pool._opened == 2
+    finally:
+        pool.close()
+
+
+def test_message_stores_open_no_connection(tmp_path):
+    path = str(tmp_path / 'server.db')
+    stores = [db.MessageStore(path) for _ in range(50)]
+    try:
+        stores[0].add_message('alice', 'a', '#000000', 'hello', 100)
+        assert all(store.recent_messages('general', 0, 10)[0][3] == 'hello' for store in stores)
+        assert db.shared_pool(path)._opened == 1
+    finally:
+        db.close_writers()
+        db.close_pools()
+
+
+def test_ids_continue_from_the_largest_already_recorded(tmp_path):
+    path = str(tmp_path / 'server.db')
+    writer = db.MessageWriter(path)
+    assert writer.add_message('alice', 'a', '#000000', 'first', 0) == 1
+    writer.close()
+    writer = db.MessageWriter(path)
+    assert writer.add_message('alice', 'a', '#000000', 'second', 0) == 2
+    writer.close()
+
+
+@pytest.mark.parametrize('durability', ['async', 'none'])
+def test_write_behind_hands_out_ids_before_committing(tmp_path, durability):
+    path = str(tmp_path / 'server.db')
+    writer = db.MessageWriter(path, max_delay=10.0, durability=durability)
+    futures = [writer.submit('alice', 'a', '#000000', f'm{n}', n) for n in range(3)]
+    assert [future.result(timeout=0) for future in futures] == [1, 2, 3]
+    assert _rows(path) == []  # still waiting to fill its batch
+    writer.close()
+    assert [row_id for row_id, _, _ in _rows(path)] == [1, 2, 3]
+
+
+def test_an_unknown_durability_is_refused(tmp_path):
+    with pytest.raises(ValueError, match='unknown durability'):
+        db.check_durability('eventually')
+
+
+def test_history_pages_walk_a_room_by_id_off_an_index(tmp_path):
+    path = str(tmp_path / 'server.db')
+    database = db.ServerDatabase(path)
+    try:
+        ids = [database.add_message('alice', 'a', '#000000', f'm{n}', 100 + n) for n in range(7)]
+        database.add_message('bob', 'b', '#000000', 'elsewhere', 200, 'lobby')
+
+        def page(before_id, after_id, limit):
+            return [row[3] for row in database.page_messages('general', before_id, after_id, limit)]
+
+        assert page(None, None, 3) == ['m4', 'm5', 'm6']
+        assert page(ids[4], None, 3) == ['m1', 'm2', 'm3']
+        assert page(None, ids[4], 3) == ['m5', 'm6']
+        assert page(ids[5], ids[1], 10) == ['m2', 'm3', 'm4']
+        plan = database.conn.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM message WHERE room = ? AND id < ? '
+            'ORDER BY id DESC LIMIT 3',
+            ['general', 5],
+        ).fetchall()
+        assert 'message_room_id' in ' '.join(str(step) for step in plan)
+    finally:
+        database.close()
+        db.close_writers()
+        db.close_pools()
+
+
+def test_search_ranks_one_rooms_matches_and_forgets_deleted_ones(tmp_path):
+    path = str(tmp_path / 'server.db')
+    database = db.ServerDatabase(path)
+    try:
+        for message in [
+            'the deploy failed again',
+            'lunch?',
+            'deploy deploy deploy: failed, failed',
+            'it "failed" (quotes) OR worse',
+        ]:
+            database.add_message('alice', 'a', '#000000', message, 100)
+        database.add_message('bob', 'b', '#000000', 'deploy failed in the lobby', 100, 'lobby')
+
+        def search(*terms, offset=0):
+            return [row[3] for row in database.search_messages('general', list(terms), offset, 10)]
+
+        assert search('deploy', 'failed') == [
+            'deploy deploy deploy: failed, failed',
+            'the deploy failed again',
+        ]
+        assert search('deploy', 'failed', offset=1) == ['the deploy failed again']
+        assert search('"failed"', 'OR') == ['it "failed" (quotes) OR worse']  # no query syntax
+        assert search('nothing') == []
+
+        with database.conn:
+            database.conn.execute("DELETE FROM message WHERE message = 'the deploy failed again'")
+        assert search('again') == []
+    finally:
+        database.close()
+        db.close_writers()
+        db.close_pools()
@@ -65,8 +65,85 @@ def test_serve_survives_a_bad_handshake(self_signed, monkeypatch):
         server_hostname='localhost',
     )
     assert result.ok
-    message = protocol.read_message(result.sock)
+    message = protocol.read_message(result.sock, result.version)
     result.sock.close()
 
     assert thread.is_alive()
     assert message['type'] == constants.Types.REQUEST
+
+
+def test_a_silent_peer_does_not_stall_other_handshakes(boot_server):
+    boot_server(55734, max_handshakes=4)
+
+    # Connects but never sends a HELLO, pinning one handshake worker.
+    silent = socket.create_connection(('127.0.0.1', 55734))
+    try:
+        started = time.time()
+        raw = socket.create_connection(('127.0.0.1', 55734))
+        result = handshake.negotiate_client(
+            raw, want_tls=False, version=protocol.PROTOCOL_VERSION, timeout=3.0
+        )
+        assert result.ok
+        assert protocol.read_message(result.sock, result.version)['type'] == constants.Types.REQUEST
+        assert time.time() - started < handshake.HANDSHAKE_TIMEOUT / 2
+        result.sock.close()
+    finally:
+        silent.close()
+
+
+def test_timed_out_handshakes_are_counted(boot_server, monkeypatch):
+    from server import metrics
+
+    monkeypatch.setattr(handshake, 'HANDSHAKE_TIMEOUT', 0.2)
+    counters = metrics.handshake_counters()
+    boot_server(55735, handshakes=counters)
+
+    silent = socket.create_connection(('127.0.0.1', 55735))
+    try:
+        end = time.time() + 3.0
+        while counters['timed_out'] == 0 and time.time() < end:
+            time.sleep(0.05)
+        assert counters['timed_out'] == 1
+        assert counters['in_flight'] == 0
+    finally:
+        silent.close()
+
+
+def test_silent_peers_beyond_the_worker_count_do_not_stall_a_client(boot_server):
+    boot_server(55736, max_handshakes=1)
+
+    # More silent peers than workers: none of them may occupy a worker.
+    silent = [socket.create_connection(('127.0.0.1', 55736)) for _ in range(4)]
+    try:
+        started = time.time()
+        raw = socket.create_connection(('127.0.0.1', 55736))
+        result = handshake.negotiate_client(
+            raw, want_tls=False, version=protocol.PROTOCOL_VERSION, timeout=3.0
+        )
+        assert result.ok
+        assert time.time() - started < 2.0
+        result.sock.close()
+    finally:
+        for peer in silent:
+            peer.close()
+
+
+def test_connections_beyond_the_pending_limit_are_shed(boot_server):
+    from server import metrics
+
+    counters = metrics.handshake_counters()
+    boot_server(55737, max_pending=1, handshakes=counters)
+    time.sleep(0.3)  # let the readiness check's own connection clear the queue
+
+    first = socket.create_connection(('127.0.0.1', 55737))
+    second = socket.create_connection(('127.0.0.1', 55737))
+    try:
+        end = time.time() + 3.0
+        while counters['shed'] == 0 and time.time() < end:
+            time.sleep(0.05)
+        assert counters['shed'] == 1
+        second.settimeout(1.0)
+        assert second.recv(1) == b''  # closed without a word, so the client retries
+    finally:
+        first.close()
+        second.close()